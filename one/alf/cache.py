@@ -17,22 +17,38 @@ Examples
 # -------------------------------------------------------------------------------------------------
 
 import datetime
+import hashlib
+import json
+import os
+import pickle
+import threading
+import time
 import uuid
+import re
+from collections import defaultdict
 from functools import partial
+from itertools import chain
 from pathlib import Path
 import warnings
 import logging
+import multiprocessing
+from multiprocessing import shared_memory, resource_tracker
 
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 from iblutil.io import parquet
 from iblutil.io.hashfile import md5
 
-from one.alf.io import iter_sessions, iter_datasets
-from one.alf.path import session_path_parts, get_alf_path
+from one.alf.io import iter_sessions, iter_datasets, md5_files, file_sizes, map_threads
+from one.alf.path import session_path_parts, get_alf_path, rel_path_parts
 from one.converters import session_record2path
-from one.util import QC_TYPE, patch_cache
+from one.util import QC_TYPE, patch_cache, file_lock
 
-__all__ = ['make_parquet_db', 'remove_missing_datasets', 'DATASETS_COLUMNS', 'SESSIONS_COLUMNS']
+__all__ = ['make_parquet_db', 'remove_missing_datasets', 'DatasetIndex', 'FileHashCache',
+           'load_table', 'table_revision', 'delta_files', 'save_delta', 'load_deltas',
+           'remove_deltas', 'snapshot_key', 'save_snapshot', 'load_snapshot', 'share_tables',
+           'attach_tables', 'DATASETS_COLUMNS', 'SESSIONS_COLUMNS']
 _logger = logging.getLogger(__name__)
 
 # -------------------------------------------------------------------------------------------------
@@ -49,6 +65,28 @@ SESSIONS_COLUMNS = (
     'projects',         # str
 )
 
+MANIFEST_FILENAME = '.cache_manifest.json'
+"""str: The file name of the session folder signatures saved alongside the cache tables."""
+
+DELTAS_DIR = '.deltas'
+"""str: The folder, alongside the cache tables, containing the table modification files."""
+
+MAX_DELTAS = 16
+"""int: The number of modification files of a table above which the table is rewritten."""
+
+SNAPSHOT_FILENAME = '.cache_snapshot.pkl'
+"""str: The file name of the processed cache tables saved alongside the table files."""
+
+INDEX_KEY = '.?id'
+"""str: A regular expression matching the ID columns of the cache tables."""
+
+_created_memory = set()
+"""set of str: The names of the shared memory blocks created by share_tables in this process."""
+
+_attached_memory = {}
+"""dict of str: The shared memory blocks attached by attach_tables, kept open as the tables view
+them."""
+
 DATASETS_COLUMNS = (
     'id',               # int64
     'eid',              # int64
@@ -96,20 +134,65 @@ def _get_dataset_info(full_ses_path, rel_dset_path, ses_eid=None, compute_hash=F
     }
 
 
+def _namespace(origin):
+    """uuid.UUID: The namespace of the session and dataset UUIDs generated for a cache origin."""
+    return uuid.uuid3(uuid.NAMESPACE_URL, str(origin))
+
+
+def _uuid3(names, ns) -> np.ndarray:
+    """
+    Vectorized uuid.uuid3.
+
+    Parameters
+    ----------
+    names : iterable of str
+        The names to convert.
+    ns : uuid.UUID
+        The namespace UUID.
+
+    Returns
+    -------
+    numpy.ndarray
+        An array of UUID strings, equivalent to `str(uuid.uuid3(ns, name))` for each name.
+    """
+    prefix = ns.bytes
+    digests = b''.join(hashlib.md5(prefix + x.encode()).digest() for x in names)
+    b = np.frombuffer(digests, dtype=np.uint8).reshape(-1, 16).copy()
+    b[:, 6] = (b[:, 6] & 0x0F) | 0x30  # version 3
+    b[:, 8] = (b[:, 8] & 0x3F) | 0x80  # RFC 4122 variant
+    hex_ = np.frombuffer(b.tobytes().hex().encode(), dtype=np.uint8).reshape(-1, 32)
+    out = np.full((len(b), 36), ord('-'), dtype=np.uint8)
+    # Insert a hyphen after each group of hex digits (8-4-4-4-12)
+    for i, (start, stop) in enumerate(((0, 8), (8, 12), (12, 16), (16, 20), (20, 32))):
+        out[:, start + i:stop + i] = hex_[:, start:stop]
+    return out.view('S36').ravel().astype(str)
+
+
 def _rel_path_to_uuid(df, id_key='rel_path', base_id=None, keep_old=False):
     base_id = base_id or uuid.uuid1()  # Base hash based on system by default
-    toUUID = partial(uuid.uuid3, base_id)  # MD5 hash from base uuid and rel session path string
     if keep_old:
         df[f'{id_key}_'] = df[id_key].copy()
-    df[id_key] = df[id_key].apply(lambda x: str(toUUID(x)))
+    # MD5 hash from base uuid and rel session path string
+    df[id_key] = _uuid3(df[id_key], base_id)
     assert len(df[id_key].unique()) == len(df[id_key])  # WARNING This fails :(
     return df
 
 
-def _ids_to_uuid(df_ses, df_dsets):
-    ns = uuid.uuid1()
-    df_dsets = _rel_path_to_uuid(df_dsets, id_key='id', base_id=ns)
+def _ids_to_uuid(df_ses, df_dsets, ids=None, ns=None):
+    """Replace the session and dataset string IDs with UUIDs.
+
+    If a map of string IDs to existing IDs is given, existing IDs are reused and the map is
+    updated with the newly generated IDs.  If no namespace is given, a random one is used.
+    """
+    ns = ns or uuid.uuid1()
+    df_dsets = _rel_path_to_uuid(df_dsets, id_key='id', base_id=ns, keep_old=ids is not None)
     df_ses = _rel_path_to_uuid(df_ses, id_key='id', base_id=ns, keep_old=True)
+    if ids is not None:  # Reuse existing IDs
+        for df in (df_ses, df_dsets):
+            old_ids = df['id_'].map(ids)
+            df['id'] = old_ids.where(old_ids.notna(), df['id'])
+            ids.update(zip(df['id_'], df['id']))
+        df_dsets.drop('id_', axis=1, inplace=True)
     # Copy new eids into datasets frame
     df_dsets['eid_'] = df_dsets['eid'].copy()
     df_dsets['eid'] = (df_ses
@@ -130,6 +213,803 @@ def _ids_to_uuid(df_ses, df_dsets):
     return df_ses, df_dsets
 
 
+# -------------------------------------------------------------------------------------------------
+# Datasets table index
+# -------------------------------------------------------------------------------------------------
+
+class DatasetIndex:
+    """An inverted index of the relative paths in a datasets cache table.
+
+    A datasets table typically contains millions of rows but only a few thousand unique relative
+    paths.  This index stores each unique path once, along with maps of ALF part tokens
+    (collection, revision, object, attribute and extension) to the paths containing them.  Exact
+    part queries are resolved by set intersection and any remaining pattern is then applied to
+    these candidate paths only, rather than to every row of the table.  The result for a given
+    pattern is memoized until new paths are added.
+
+    Paths absent from the index are always matched directly, therefore a stale index may be slow
+    but never returns a different result to a regular expression match on the table.
+
+    Examples
+    --------
+    >>> index = DatasetIndex(one._cache['datasets']['rel_path'])
+    >>> pattern = one.alf.spec.regex('^alf/' + one.alf.spec.FILE_SPEC, object='trials')
+    >>> mask = index.match(datasets['rel_path'], pattern, collection='alf', object='trials')
+    """
+    parts = ('collection', 'revision', 'object', 'attribute', 'extension')
+    """tuple of str: The ALF parts that are indexed."""
+
+    fields = ('collection', 'revision', 'namespace', 'object',
+              'attribute', 'timescale', 'extra', 'extension')
+    """tuple of str: The ALF parts returned by the `decompose` method."""
+
+    _max_memo = 1024
+    """int: The maximum number of query results to memoize."""
+
+    # Any string preceding an object name in a filename, i.e. the optional namespace
+    _NAMESPACE_PREFIX = re.compile(r'_?(?:(?<=_)[a-zA-Z0-9]+)?_?')
+    _WORD = re.compile(r'\w+')
+
+    def __init__(self, rel_paths=()):
+        """An inverted index of dataset relative paths.
+
+        Parameters
+        ----------
+        rel_paths : pandas.Series, iterable of str
+            The relative dataset paths to index, e.g. the 'rel_path' column of a datasets table.
+        """
+        self._paths = []  # Unique relative paths
+        self._ids = {}  # Map of relative path to position in self._paths
+        self._tokens = {part: defaultdict(set) for part in self.parts}
+        self._memo = {}
+        self._decomposed = {}  # Map of path position to parsed ALF parts
+        self.update(rel_paths)
+
+    def __len__(self):
+        return len(self._paths)
+
+    def __contains__(self, rel_path):
+        return rel_path in self._ids
+
+    def update(self, rel_paths):
+        """Add relative paths to the index.
+
+        Parameters
+        ----------
+        rel_paths : pandas.Series, iterable of str
+            The relative dataset paths to index.  Paths already indexed are ignored.
+
+        Returns
+        -------
+        int
+            The number of new paths added.
+        """
+        new = [x for x in pd.unique(pd.Series(rel_paths, dtype=object))
+               if isinstance(x, str) and x not in self._ids]
+        for rel_path in new:
+            i = self._ids[rel_path] = len(self._paths)
+            self._paths.append(rel_path)
+            for part, values in self._tokenize(rel_path).items():
+                for value in values:
+                    self._tokens[part][value].add(i)
+        if new:
+            self._memo.clear()
+        return len(new)
+
+    @classmethod
+    def _tokenize(cls, rel_path):
+        """Return the part values for which an exact query may match a given relative path.
+
+        NB: The object and attribute parts are ambiguous; for example '_ibl_trials' matches both
+        object 'trials' and 'ibl_trials'.  All valid values are returned so that token lookups
+        return a superset of the regular expression matches.
+        """
+        folder, _, filename = rel_path.rpartition('/')
+        collection, revision = folder, ''
+        if (m := re.search(r'(?:^|/)#([^/#]+)#$', folder)) is not None:
+            collection, revision = folder[:m.start()], m.group(1)
+        tokens = {'collection': {collection}, 'revision': {revision}}
+        segments = filename.split('.')
+        if len(segments) < 3:
+            return tokens  # Not a valid ALF filename
+        stem, attribute, extension = segments[0], segments[1], segments[-1]
+        tokens['extension'] = {extension}
+        tokens['object'] = {stem[i:] for i in range(len(stem))
+                            if cls._WORD.fullmatch(stem[i:])
+                            and cls._NAMESPACE_PREFIX.fullmatch(stem[:i])}
+        # The attribute may be followed by an underscore and timescale
+        tokens['attribute'] = {attribute} | {
+            attribute[:i] for i, c in enumerate(attribute)
+            if c == '_' and i > 0 and cls._WORD.fullmatch(attribute[i + 1:])}
+        return tokens
+
+    @staticmethod
+    def _exact(part, value, wildcards=True):
+        """Return the value(s) as a set if the query is an exact match, otherwise None."""
+        values = {value} if isinstance(value, str) else set(value)
+        if part == 'collection':
+            literal = r'[^*?\[\]#]*' if wildcards else r'[\w/-]*'
+        elif part == 'revision':
+            literal = r'[^*?\[\]#/]*' if wildcards else r'[\w-]*'
+        else:
+            literal = r'\w+'
+        if all(isinstance(x, str) and re.fullmatch(literal, x) for x in values):
+            return values
+
+    def _candidates(self, wildcards=True, **parts):
+        """Return the indices of paths containing all exact part values, or None if unknown."""
+        parts = {k: v for k, v in parts.items() if v is not None}
+        exact = {k: self._exact(k, v, wildcards) for k, v in parts.items()}
+        if any(values is None for values in exact.values()):
+            return  # A pattern may match across parts so can only be resolved by regex
+        candidates = None
+        for part, values in exact.items():
+            if part not in self.parts:
+                continue
+            # The object and attribute tokens assume the default namespace and timescale patterns
+            if part == 'object' and 'namespace' in parts:
+                continue
+            if part == 'attribute' and 'timescale' in parts:
+                continue
+            ids = set().union(*(self._tokens[part].get(x, ()) for x in values))
+            candidates = ids if candidates is None else candidates & ids
+        return candidates
+
+    def _memoize(self, key, func):
+        """Return the memoized result for a given key, otherwise compute and store it."""
+        if key not in self._memo:
+            if len(self._memo) >= self._max_memo:
+                self._memo.clear()
+            self._memo[key] = func()
+        return self._memo[key]
+
+    def _apply(self, rel_paths, hits, test):
+        """Return a boolean Series of rel_paths that are in hits, or unindexed and pass test."""
+        unindexed = (x for x in pd.unique(rel_paths) if isinstance(x, str) and x not in self._ids)
+        return rel_paths.isin(hits.union(filter(test, unindexed)))
+
+    def match(self, rel_paths, pattern, wildcards=True, **parts):
+        """Match relative paths against a compiled regular expression.
+
+        Equivalent to `rel_paths.str.match(pattern)`.
+
+        Parameters
+        ----------
+        rel_paths : pandas.Series
+            The relative paths to match, e.g. the 'rel_path' column of a datasets table.
+        pattern : re.Pattern
+            A compiled regular expression, e.g. from one.alf.spec.regex.
+        wildcards : bool
+            If true, the part values are unix shell style patterns, otherwise regular
+            expressions.
+        **parts
+            The ALF part values used to build the pattern.  Exact values are used to narrow down
+            the paths tested against the pattern.
+
+        Returns
+        -------
+        pandas.Series
+            A boolean Series the length of rel_paths.
+        """
+        def _match():
+            candidates = self._candidates(wildcards=wildcards, **parts)
+            paths = self._paths if candidates is None else map(self._paths.__getitem__, candidates)
+            return frozenset(filter(pattern.match, paths))
+
+        hits = self._memoize(('match', pattern.pattern, pattern.flags), _match)
+        return self._apply(rel_paths, hits, pattern.match)
+
+    def contains(self, rel_paths, pattern, regex=True):
+        """Test whether a pattern is contained within relative paths.
+
+        Equivalent to `rel_paths.str.contains(pattern, regex=regex)`.
+
+        Parameters
+        ----------
+        rel_paths : pandas.Series
+            The relative paths to test, e.g. the 'rel_path' column of a datasets table.
+        pattern : str
+            A character sequence or regular expression.
+        regex : bool
+            If true, the pattern is a regular expression, otherwise a literal string.
+
+        Returns
+        -------
+        pandas.Series
+            A boolean Series the length of rel_paths.
+        """
+        test = re.compile(pattern).search if regex else (lambda x: pattern in x)
+        hits = self._memoize(
+            ('contains', pattern, regex), lambda: frozenset(filter(test, self._paths)))
+        return self._apply(rel_paths, hits, test)
+
+    def _parse(self, rel_path):
+        """Return the ALF parts of a relative path as a tuple of str, parsing it only once."""
+        if not isinstance(rel_path, str):
+            return ('',) * len(self.fields)
+        if (i := self._ids.get(rel_path)) is not None and i in self._decomposed:
+            return self._decomposed[i]
+        parsed = tuple(x or '' for x in rel_path_parts(rel_path, assert_valid=False))
+        if i is not None:
+            self._decomposed[i] = parsed
+        return parsed
+
+    def decompose(self, rel_paths):
+        """Decompose relative paths into their ALF parts.
+
+        Each unique relative path is parsed once, and the parts of indexed paths are kept for
+        subsequent calls.  The parts are returned as Categorical columns so that values repeated
+        across sessions are stored once.
+
+        Parameters
+        ----------
+        rel_paths : pandas.Series
+            The relative paths to decompose, e.g. the 'rel_path' column of a datasets table.
+
+        Returns
+        -------
+        pandas.DataFrame
+            A table with the index of rel_paths and a Categorical column for each ALF part in
+            `fields`.  Absent parts, and the parts of invalid paths, are empty strings.
+
+        Examples
+        --------
+        >>> parts = index.decompose(datasets['rel_path'])
+        >>> collections = parts['collection'].unique()
+        """
+        rel_paths = pd.Series(rel_paths, dtype=object)
+        codes, uniques = pd.factorize(rel_paths, use_na_sentinel=False)
+        parsed = list(zip(*map(self._parse, uniques))) or [()] * len(self.fields)
+        columns = {}
+        for field, values in zip(self.fields, parsed):
+            categorical = pd.Categorical(values)
+            columns[field] = pd.Categorical.from_codes(
+                categorical.codes[codes], dtype=categorical.dtype)
+        return pd.DataFrame(columns, index=rel_paths.index)
+
+
+class FileHashCache:
+    """A persistent cache of local file MD5 hashes.
+
+    Each hash is stored along with the size, modification time (in nanoseconds) and inode of the
+    file when it was hashed.  A file is only re-hashed if any of these have changed, therefore
+    verifying an unchanged file costs a single stat call instead of reading the whole file.
+
+    Examples
+    --------
+    >>> hashes = FileHashCache(Path(one.cache_dir, FileHashCache.filename))
+    >>> hashes.md5(file) == one.list_datasets(details=True).loc[...]['hash']
+    >>> hashes.save()
+    """
+    filename = '.file_hashes.json'
+    """str: The default file name of the hash cache, saved alongside the cache tables."""
+
+    def __init__(self, path=None):
+        """A persistent cache of local file MD5 hashes.
+
+        Parameters
+        ----------
+        path : str, pathlib.Path, optional
+            The JSON file in which to persist the hashes.  If None, the hashes are not persisted.
+        """
+        self.path = Path(path) if path else None
+        self._hashes = None  # map of file path to (size, mtime_ns, inode, md5)
+        self._updated = set()  # paths hashed since the last save
+        self._lock = threading.Lock()
+
+    def _load(self):
+        """Load the hashes from disk, if not already loaded."""
+        if self._hashes is not None:
+            return
+        self._hashes = {}
+        if self.path and self.path.exists():
+            try:
+                self._hashes = json.loads(self.path.read_text())
+            except (ValueError, OSError) as ex:
+                _logger.debug('Failed to load file hash cache %s: %s', self.path, ex)
+
+    @staticmethod
+    def _signature(stat):
+        """list: The fields of a stat result that determine whether a file has changed."""
+        return [stat.st_size, stat.st_mtime_ns, stat.st_ino]
+
+    def md5(self, file):
+        """Return the MD5 hash of a file, re-hashing it only if it has changed.
+
+        Parameters
+        ----------
+        file : str, pathlib.Path
+            The file to hash.
+
+        Returns
+        -------
+        str
+            The MD5 hash of the file.
+        """
+        key = str(file)
+        signature = self._signature(os.stat(file))
+        cached = self._cached(key, signature)
+        if cached:
+            return cached
+        file_hash = md5(file)
+        with self._lock:
+            self._hashes[key] = [*signature, file_hash]
+            self._updated.add(key)
+        return file_hash
+
+    def _cached(self, key, signature):
+        """str: The cached hash of a file, or None if the file has changed since hashing."""
+        with self._lock:
+            self._load()
+            cached = self._hashes.get(key)
+        return cached[-1] if cached and cached[:-1] == signature else None
+
+    def md5_files(self, files, **kwargs):
+        """Return the MD5 hashes of multiple files, hashing changed files concurrently.
+
+        Parameters
+        ----------
+        files : list of str, pathlib.Path
+            The files to hash.
+        n_threads : int, optional
+            The maximum number of files to hash at once.
+        max_bytes : int, optional
+            The maximum total size of the files hashed concurrently.
+
+        Returns
+        -------
+        list of str
+            The MD5 hash of each file, in input order.
+        """
+        files = list(files)
+        hashes = [self._cached(str(f), self._signature(os.stat(f))) for f in files]
+        stale = [i for i, h in enumerate(hashes) if h is None]
+        new_hashes = md5_files([files[i] for i in stale], hash_func=self.md5, **kwargs)
+        for i, file_hash in zip(stale, new_hashes):
+            hashes[i] = file_hash
+        return hashes
+
+    def save(self):
+        """Save the hashes added since the last save, if any.
+
+        The file is locked while the new hashes are merged with those saved by other processes,
+        and entries for files that no longer exist are removed.
+        """
+        with self._lock:
+            if not (self.path and self._updated):
+                return
+            tmp = self.path.with_name(f'{self.path.name}.{os.getpid()}.tmp')
+            try:
+                with file_lock(self.path.with_name(self.path.name + '.lock')):
+                    hashes = {}
+                    if self.path.exists():
+                        try:
+                            hashes = json.loads(self.path.read_text())
+                        except ValueError as ex:
+                            _logger.debug('Overwriting invalid file hash cache: %s', ex)
+                    hashes.update({k: self._hashes[k] for k in self._updated})
+                    for key, size in zip(list(hashes), file_sizes(list(hashes))):
+                        if size < 0:
+                            del hashes[key]
+                    tmp.write_text(json.dumps(hashes))
+                    tmp.replace(self.path)
+                self._hashes = hashes
+                self._updated.clear()
+            except OSError as ex:  # e.g. read-only tables directory
+                _logger.debug('Failed to save file hash cache %s: %s', self.path, ex)
+
+
+# -------------------------------------------------------------------------------------------------
+# Cache table modifications
+# -------------------------------------------------------------------------------------------------
+
+def load_table(filename, columns=None, exclude=None):
+    """
+    Load a cache table, optionally reading only some of its columns.
+
+    The ID columns, i.e. the table index, are always loaded.
+
+    Parameters
+    ----------
+    filename : str, pathlib.Path
+        The cache table file path.
+    columns : list of str, optional
+        The columns to load.  Columns absent from the file are ignored.  If None, all columns
+        not excluded are loaded.
+    exclude : list of str, optional
+        The columns not to load.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The loaded table.
+    dict
+        The table metadata.
+
+    Examples
+    --------
+    Load the datasets table without the file hashes
+
+    >>> datasets, metadata = load_table('path/to/datasets.pqt', exclude=['hash'])
+    """
+    if columns is None and not exclude:
+        return parquet.load(filename)
+    exclude = set(exclude or ())
+    names = [x for x in pq.read_schema(filename).names if re.search(INDEX_KEY, x) or
+             (x not in exclude and (columns is None or x in columns))]
+    table = pq.read_table(filename, columns=names, use_pandas_metadata=True)
+    metadata = (table.schema.metadata or {}).get(b'one_metadata')
+    return table.to_pandas(), json.loads(metadata) if metadata else {}
+
+
+def table_revision(filename):
+    """
+    Read the revision of a cache table file without loading the table.
+
+    Parameters
+    ----------
+    filename : str, pathlib.Path
+        The cache table file path.
+
+    Returns
+    -------
+    str, None
+        The table revision, or its creation date if it has none, or None if the file does not
+        exist.
+    """
+    try:
+        metadata = (pq.read_schema(filename).metadata or {}).get(b'one_metadata')
+    except (OSError, ValueError):  # Missing or invalid file
+        return
+    metadata = json.loads(metadata) if metadata else {}
+    return metadata.get('revision') or metadata.get('date_created')
+
+
+def delta_files(tables_dir, table) -> list:
+    """
+    List the modification files of a cache table in the order they were saved.
+
+    Parameters
+    ----------
+    tables_dir : str, pathlib.Path
+        The directory containing the cache tables.
+    table : str
+        The table name, e.g. 'datasets'.
+
+    Returns
+    -------
+    list of pathlib.Path
+        The sorted modification files.
+    """
+    return sorted(Path(tables_dir, DELTAS_DIR).glob(f'{table}.*.pqt'))
+
+
+def save_delta(tables_dir, table, rows, revision, metadata=None) -> Path:
+    """
+    Save modified rows of a cache table to a new modification file.
+
+    Parameters
+    ----------
+    tables_dir : str, pathlib.Path
+        The directory containing the cache tables.
+    table : str
+        The table name, e.g. 'datasets'.
+    rows : pandas.DataFrame
+        The modified (or new) table rows.
+    revision : str
+        The revision of the table file to which the modifications apply.
+    metadata : dict, optional
+        Further metadata to save with the modifications, e.g. the time the table was synchronized
+        with the database ('date_synced').
+
+    Returns
+    -------
+    pathlib.Path
+        The saved modification file.
+    """
+    deltas_dir = Path(tables_dir, DELTAS_DIR)
+    deltas_dir.mkdir(exist_ok=True)
+    # The nanosecond timestamp has a fixed width so the files sort in the order saved
+    filename = deltas_dir / f'{table}.{time.time_ns()}.{os.getpid()}.pqt'
+    tmp_file = filename.with_name(f'.{filename.name}.tmp')
+    parquet.save(tmp_file, rows, {**(metadata or {}), 'revision': revision})
+    os.replace(tmp_file, filename)
+    return filename
+
+
+def load_deltas(tables_dir, table, revision, files=None):
+    """
+    Load the modifications of a cache table.
+
+    Modification files saved for a different table revision, e.g. one since replaced by a newly
+    downloaded table, are ignored.
+
+    Parameters
+    ----------
+    tables_dir : str, pathlib.Path
+        The directory containing the cache tables.
+    table : str
+        The table name, e.g. 'datasets'.
+    revision : str
+        The revision of the loaded table file.
+    files : list of pathlib.Path, optional
+        The modification files to load, in the order saved.  Defaults to all those of the table.
+
+    Returns
+    -------
+    pandas.DataFrame, None
+        The modified rows, with the most recent modification of each row, or None if there are
+        no modifications.
+    dict
+        The metadata of the modification files, that of the most recent taking precedence.
+    """
+    deltas, merged = [], {}
+    for file in delta_files(tables_dir, table) if files is None else files:
+        try:
+            rows, metadata = parquet.load(file)
+        except (OSError, ValueError) as ex:  # e.g. removed during compaction
+            _logger.debug('Failed to load %s: %s', file, ex)
+            continue
+        if metadata.get('revision') == revision:
+            deltas.append(rows)
+            merged.update(metadata)
+        else:
+            _logger.debug('Ignoring %s of table revision %s', file, metadata.get('revision'))
+    if not deltas:
+        return None, merged
+    rows = pd.concat(deltas)
+    return rows[~rows.index.duplicated(keep='last')], merged
+
+
+def remove_deltas(tables_dir, table):
+    """
+    Remove the modification files of a cache table.
+
+    Parameters
+    ----------
+    tables_dir : str, pathlib.Path
+        The directory containing the cache tables.
+    table : str
+        The table name, e.g. 'datasets'.
+    """
+    for file in delta_files(tables_dir, table):
+        file.unlink(missing_ok=True)
+
+
+def snapshot_key(tables_dir, *args) -> str:
+    """
+    Compute a key identifying the current state of the cache table files.
+
+    The key changes whenever a table file or its modification files are written.
+
+    Parameters
+    ----------
+    tables_dir : str, pathlib.Path
+        The directory containing the cache tables.
+    *args
+        Further JSON serializable values that the processed tables depend on, e.g. the ONE
+        version.
+
+    Returns
+    -------
+    str
+        The key of the cache tables.
+    """
+    tables_dir = Path(tables_dir)
+    files = chain(tables_dir.glob('*.pqt'), tables_dir.joinpath(DELTAS_DIR).glob('*.pqt'))
+    stats = []
+    for file in sorted(files):
+        try:
+            stat = file.stat()
+        except FileNotFoundError:  # e.g. removed during compaction
+            continue
+        stats.append((file.relative_to(tables_dir).as_posix(), stat.st_size, stat.st_mtime_ns))
+    return hashlib.md5(json.dumps([stats, *args]).encode()).hexdigest()
+
+
+def save_snapshot(tables_dir, key, tables, metadata=None):
+    """
+    Save processed cache tables for fast loading.
+
+    The snapshot is written to a temporary file that atomically replaces any previous one.
+    Failure to save, e.g. in a read-only directory, is logged and ignored.
+
+    Parameters
+    ----------
+    tables_dir : str, pathlib.Path
+        The directory containing the cache tables.
+    key : str
+        The key of the cache table files the tables were loaded from (see snapshot_key).
+    tables : dict of pandas.DataFrame
+        The processed tables.
+    metadata : any
+        Any other data to save with the tables, e.g. the table file metadata.
+
+    Returns
+    -------
+    pathlib.Path, None
+        The snapshot file path, or None if it failed to save.
+    """
+    filename = Path(tables_dir, SNAPSHOT_FILENAME)
+    tmp_file = filename.with_name(f'{filename.name}.{os.getpid()}.tmp')
+    try:
+        with open(tmp_file, 'wb') as fp:
+            pickle.dump(key, fp, protocol=5)
+            pickle.dump((tables, metadata), fp, protocol=5)
+        os.replace(tmp_file, filename)
+        return filename
+    except OSError as ex:
+        _logger.debug('Failed to save %s: %s', filename, ex)
+    finally:
+        tmp_file.unlink(missing_ok=True)
+
+
+def load_snapshot(tables_dir, key):
+    """
+    Load processed cache tables saved by save_snapshot.
+
+    NB: The snapshot is a pickle file and should only be loaded from a trusted location.
+
+    Parameters
+    ----------
+    tables_dir : str, pathlib.Path
+        The directory containing the cache tables.
+    key : str
+        The key of the current cache table files (see snapshot_key).
+
+    Returns
+    -------
+    dict of pandas.DataFrame, None
+        The processed tables, or None if there is no snapshot or if it is out of date.
+    any
+        The other data saved with the tables.
+    """
+    filename = Path(tables_dir, SNAPSHOT_FILENAME)
+    try:
+        with open(filename, 'rb') as fp:
+            if pickle.load(fp) != key:
+                _logger.debug('%s out of date', filename)
+                return None, None
+            return pickle.load(fp)
+    except FileNotFoundError:
+        return None, None
+    except Exception as ex:  # e.g. truncated file or incompatible pandas version
+        _logger.debug('Failed to load %s: %s', filename, ex)
+        return None, None
+
+
+def _aligned(n_bytes, alignment=64):
+    """int: The number of bytes rounded up to a multiple of the alignment."""
+    return -(-n_bytes // alignment) * alignment
+
+
+def share_tables(key, tables, metadata=None):
+    """
+    Copy processed cache tables into a new block of shared memory.
+
+    The tables are pickled with out-of-band buffers so that numerical columns and index codes
+    are mapped by attach_tables without copying.  Other columns, e.g. strings, are unpickled
+    upon attaching.
+
+    NB: The caller must keep a reference to the returned shared memory and unlink it once no
+    longer required.
+
+    Parameters
+    ----------
+    key : str
+        The key of the cache table files the tables were loaded from (see snapshot_key).
+    tables : dict of pandas.DataFrame
+        The processed tables.
+    metadata : any
+        Any other data to share with the tables, e.g. the table file metadata.
+
+    Returns
+    -------
+    multiprocessing.shared_memory.SharedMemory
+        The shared memory containing the tables.
+    """
+    buffers = []
+    data = pickle.dumps((tables, metadata), protocol=5, buffer_callback=buffers.append)
+    views = [memoryview(pickle.dumps(key)), memoryview(data), *(x.raw() for x in buffers)]
+    # The header holds the number of sections followed by the offset and size of each
+    offsets, size = [], _aligned(8 * (2 * len(views) + 1))
+    for view in views:
+        offsets.append(size)
+        size += _aligned(view.nbytes)
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    _created_memory.add(shm.name)
+    header = np.ndarray(2 * len(views) + 1, dtype='<u8', buffer=shm.buf)
+    header[0] = len(views)
+    header[1::2] = offsets
+    header[2::2] = [x.nbytes for x in views]
+    del header  # release the buffer
+    for offset, view in zip(offsets, views):
+        shm.buf[offset:offset + view.nbytes] = view.cast('B')
+    return shm
+
+
+class _AttachedMemory(shared_memory.SharedMemory):
+    """Shared memory viewed by attached tables, which may outlive it at interpreter shutdown."""
+
+    def __del__(self):
+        # Closing fails while the memory is viewed; it is unmapped once no longer referenced
+        pass
+
+
+def _open_shared_memory(name):
+    """
+    Open a block of shared memory created by another process.
+
+    The memory is removed from the resource tracker of this process, if any, so that it is not
+    unlinked when this process exits.  A multiprocessing child shares the resource tracker of its
+    parent, in which case the memory remains registered by the process that created it.
+
+    Parameters
+    ----------
+    name : str
+        The name of the shared memory block.
+
+    Returns
+    -------
+    multiprocessing.shared_memory.SharedMemory
+        The shared memory.
+    """
+    try:  # Python >= 3.13
+        return _AttachedMemory(name=name, track=False)
+    except TypeError:
+        shm = _AttachedMemory(name=name)
+    shared_tracker = multiprocessing.parent_process() is not None or name in _created_memory
+    if os.name == 'posix' and not shared_tracker:
+        resource_tracker.unregister(f'/{name}', 'shared_memory')
+    return shm
+
+
+def attach_tables(name, key):
+    """
+    Attach to cache tables shared by another process.
+
+    The shared memory remains mapped until this process exits, as the tables may be referenced
+    anywhere.  Attaching to the same block again does not map it again.
+
+    Parameters
+    ----------
+    name : str
+        The name of the shared memory block returned by share_tables.
+    key : str
+        The key of the current cache table files (see snapshot_key).
+
+    Returns
+    -------
+    dict of pandas.DataFrame, None
+        The tables, whose numerical data are read-only views of the shared memory, or None if the
+        shared tables are out of date.
+    any
+        The other data shared with the tables.
+
+    Raises
+    ------
+    FileNotFoundError
+        No shared memory block with the given name exists.
+    """
+    if (shm := _attached_memory.get(name)) is None:
+        shm = _open_shared_memory(name)
+    buf = shm.buf.toreadonly()
+    n_views = int.from_bytes(buf[:8], 'little')
+    header = np.frombuffer(buf, dtype='<u8', count=2 * n_views + 1)
+    views = [buf[int(i):int(i + n)] for i, n in zip(header[1::2], header[2::2])]
+    del header
+    if pickle.loads(views[0]) != key:
+        _logger.debug('Shared cache tables %s out of date', name)
+        del buf, views
+        if name not in _attached_memory:
+            shm.close()
+        return None, None
+    tables, metadata = pickle.loads(views[1], buffers=views[2:])
+    # The tables are views of the memory so it must remain open for the lifetime of the process
+    _attached_memory[name] = shm
+    return tables, metadata
+
+
 # -------------------------------------------------------------------------------------------------
 # Main functions
 # -------------------------------------------------------------------------------------------------
@@ -149,7 +1029,17 @@ def _metadata(origin):
     }
 
 
-def _make_sessions_df(root_dir) -> pd.DataFrame:
+def _session_signature(session_path):
+    """list: The number of folders and latest folder modification time (ns) within a session.
+
+    Adding, removing or renaming a file changes the modification time of its parent folder,
+    therefore a session folder need only be re-indexed if its signature has changed.
+    """
+    mtimes = [os.stat(folder).st_mtime_ns for folder, *_ in os.walk(session_path)]
+    return [len(mtimes), max(mtimes)]
+
+
+def _make_sessions_df(root_dir, session_paths=None) -> pd.DataFrame:
     """
     Given a root directory, recursively finds all sessions and returns a sessions DataFrame.
 
@@ -157,6 +1047,8 @@ def _make_sessions_df(root_dir) -> pd.DataFrame:
     ----------
     root_dir : str, pathlib.Path
         The folder to look for sessions.
+    session_paths : list of pathlib.Path, optional
+        The session paths to index.  If None, all sessions within root_dir are indexed.
 
     Returns
     -------
@@ -164,7 +1056,9 @@ def _make_sessions_df(root_dir) -> pd.DataFrame:
         A pandas DataFrame of session info.
     """
     rows = []
-    for full_path in iter_sessions(root_dir):
+    if session_paths is None:
+        session_paths = iter_sessions(root_dir)
+    for full_path in session_paths:
         # Get the lab/Subjects/subject/date/number part of a file path
         rel_path = get_alf_path(full_path)
         # A dict of session info extracted from path
@@ -175,7 +1069,8 @@ def _make_sessions_df(root_dir) -> pd.DataFrame:
     return df
 
 
-def _make_datasets_df(root_dir, hash_files=False) -> pd.DataFrame:
+def _make_datasets_df(root_dir, hash_files=False, session_paths=None,
+                      file_hashes=None) -> pd.DataFrame:
     """
     Given a root directory, recursively finds all datasets and returns a datasets DataFrame.
 
@@ -185,29 +1080,44 @@ def _make_datasets_df(root_dir, hash_files=False) -> pd.DataFrame:
         The folder to look for sessions.
     hash_files : bool
         If True, an MD5 is computed for each file and stored in the 'hash' column.
+    session_paths : list of pathlib.Path, optional
+        The session paths to index.  If None, all sessions within root_dir are indexed.
+    file_hashes : FileHashCache, optional
+        A file hash cache used to avoid re-hashing unchanged files.
 
     Returns
     -------
     pandas.DataFrame
         A pandas DataFrame of dataset info.
     """
-    df = pd.DataFrame([], columns=DATASETS_COLUMNS).astype({'qc': QC_TYPE})
-    # Go through sessions and append datasets
-    for session_path in iter_sessions(root_dir):
-        rows = []
-        for rel_dset_path in iter_datasets(session_path):
-            file_info = _get_dataset_info(session_path, rel_dset_path, compute_hash=hash_files)
-            assert set(file_info.keys()) <= set(DATASETS_COLUMNS)
-            rows.append(file_info)
-        df = pd.concat((df, pd.DataFrame(rows, columns=DATASETS_COLUMNS)),
-                       ignore_index=True, verify_integrity=True)
+    if session_paths is None:
+        session_paths = iter_sessions(root_dir)
+
+    def _session_datasets(session_path):
+        return [(session_path, _get_dataset_info(session_path, x))
+                for x in iter_datasets(session_path)]
+
+    # Index sessions concurrently and accumulate rows to build the frame once
+    rows = list(chain.from_iterable(map_threads(_session_datasets, list(session_paths))))
+    if hash_files and rows:
+        files = [Path(session_path, x['rel_path']) for session_path, x in rows]
+        hashes = file_hashes.md5_files(files) if file_hashes else md5_files(files)
+        for (_, file_info), file_hash in zip(rows, hashes):
+            file_info['hash'] = file_hash
+    df = pd.DataFrame([x for _, x in rows], columns=DATASETS_COLUMNS)
     return df.astype({'qc': QC_TYPE})
 
 
-def make_parquet_db(root_dir, out_dir=None, hash_ids=True, hash_files=False, lab=None):
+def make_parquet_db(root_dir, out_dir=None, hash_ids=True, hash_files=False, lab=None,
+                    incremental=False, origin=None):
     """
     Given a data directory, index the ALF datasets and save the generated cache tables.
 
+    Along with the tables, a manifest of each session's folder signature is saved.  In incremental
+    mode this is used to re-index only the sessions whose folders have changed since the tables
+    were last made; the table rows of unchanged sessions are kept as-is.  If the tables were made
+    with a different hash_files option, all sessions are re-indexed.
+
     Parameters
     ----------
     root_dir : str, pathlib.Path
@@ -216,14 +1126,24 @@ def make_parquet_db(root_dir, out_dir=None, hash_ids=True, hash_files=False, lab
         Optional output directory to save cache tables.  If None, the files are saved into the
         root directory.
     hash_ids : bool
-        If True, experiment and dataset IDs will be UUIDs generated from the system and relative
-        paths (required for use with ONE API).
+        If True, experiment and dataset IDs will be UUIDs generated from the origin and relative
+        paths (required for use with ONE API).  The IDs are the same each time the tables are
+        made for a given origin.
     hash_files : bool
         If True, an MD5 hash is computed for each dataset and stored in the datasets table.
-        This will substantially increase cache generation time.
+        This will substantially increase cache generation time.  Hashes are stored in a file
+        hash cache in the output directory so that unchanged files are not re-hashed.
     lab : str
         An optional lab name to associate with the data.  If the folder structure
         contains 'lab/Subjects', the lab name will be taken from the folder name.
+    incremental : bool
+        If True and the cache tables already exist in the output directory, only sessions that
+        were added or whose folders have changed are re-indexed.  The IDs of previously indexed
+        sessions and datasets are preserved.  NB: A file modified in place does not change the
+        signature of its session folder and therefore is not re-indexed.
+    origin : str, optional
+        The name of the data origin, e.g. a computer or database name, stored in the table
+        metadata and used to generate the UUIDs.  Defaults to the root directory path.
 
     Returns
     -------
@@ -231,44 +1151,143 @@ def make_parquet_db(root_dir, out_dir=None, hash_ids=True, hash_files=False, lab
         The full path of the saved sessions parquet table.
     pathlib.Path
         The full path of the saved datasets parquet table.
+
+    Examples
+    --------
+    Update the cache tables after adding new sessions
+
+    >>> make_parquet_db(cache_dir, hash_files=True, incremental=True)
     """
     root_dir = Path(root_dir).resolve()
 
-    # Make the dataframes.
-    df_ses = _make_sessions_df(root_dir)
-    df_dsets = _make_datasets_df(root_dir, hash_files=hash_files)
+    # Output directory.
+    out_dir = Path(out_dir or root_dir)
+    assert out_dir.is_dir()
+    assert out_dir.exists()
 
-    # Add integer id columns
-    if hash_ids and len(df_ses) > 0:
-        df_ses, df_dsets = _ids_to_uuid(df_ses, df_dsets)
+    # Parquet files to save.
+    fn_ses = out_dir / 'sessions.pqt'
+    fn_dsets = out_dir / 'datasets.pqt'
+    fn_manifest = out_dir / MANIFEST_FILENAME
+
+    # Determine which sessions have changed since the tables were made
+    session_paths = {get_alf_path(x): x for x in iter_sessions(root_dir)}
+    manifest = {}
+    if incremental and all(x.exists() for x in (fn_ses, fn_dsets, fn_manifest)):
+        manifest = json.loads(fn_manifest.read_text())
+    signatures = dict(zip(session_paths, map_threads(_session_signature, session_paths.values())))
+    saved = manifest.get('sessions', {})
+    # The rows of sessions indexed with a different hashing option can not be reused
+    unchanged = set()
+    if manifest.get('hash_files') == hash_files:
+        unchanged = {k for k, v in signatures.items() if saved.get(k, [])[:-1] == v}
+    changed = [v for k, v in session_paths.items() if k not in unchanged]
+    _logger.debug('Indexing %i of %i sessions', len(changed), len(session_paths))
+
+    # Make the dataframes.
+    file_hashes = FileHashCache(out_dir / FileHashCache.filename) if hash_files else None
+    df_ses = _make_sessions_df(root_dir, changed)
+    df_dsets = _make_datasets_df(root_dir, hash_files=hash_files,
+                                 session_paths=changed, file_hashes=file_hashes)
+    if file_hashes:
+        file_hashes.save()
 
     if lab:  # Fill in lab name field
         assert not df_ses['lab'].any() or (df_ses['lab'] == 'lab').all(), 'lab name conflict'
         df_ses['lab'] = lab
 
+    origin = origin or root_dir
+    ns = _namespace(origin)
+    # Map of session and dataset string IDs to their existing IDs
+    ids = {_ses_str_id(k): v[-1] for k, v in saved.items() if k in session_paths}
+    if manifest:
+        df_ses, df_dsets = _merge_tables(df_ses, df_dsets, fn_ses, fn_dsets, saved,
+                                         unchanged, ids, ns if hash_ids else None)
+    elif hash_ids and len(df_ses) > 0:  # Add UUID id columns
+        df_ses, df_dsets = _ids_to_uuid(df_ses, df_dsets, ids, ns)
+
     # Check any files were found
     if df_ses.empty or df_dsets.empty:
         warnings.warn(f'No {"sessions" if df_ses.empty else "datasets"} found', RuntimeWarning)
 
-    # Output directory.
-    out_dir = Path(out_dir or root_dir)
-    assert out_dir.is_dir()
-    assert out_dir.exists()
-
-    # Parquet files to save.
-    fn_ses = out_dir / 'sessions.pqt'
-    fn_dsets = out_dir / 'datasets.pqt'
-
     # Parquet metadata.
-    metadata = _metadata(root_dir)
+    metadata = _metadata(origin)
 
     # Save the Parquet files.
     parquet.save(fn_ses, df_ses, metadata)
     parquet.save(fn_dsets, df_dsets, metadata)
 
+    # Save the session folder signatures along with the session IDs
+    manifest = {
+        'hash_files': hash_files,
+        'sessions': {
+            k: [*v, ids.get(_ses_str_id(k), _ses_str_id(k))] for k, v in signatures.items()}
+    }
+    try:
+        fn_manifest.write_text(json.dumps(manifest))
+    except OSError as ex:
+        _logger.warning('Failed to save cache manifest: %s', ex)
+
     return fn_ses, fn_dsets
 
 
+def _merge_tables(df_ses, df_dsets, fn_ses, fn_dsets, manifest, unchanged, ids, ns=None):
+    """
+    Merge newly indexed sessions and datasets with the existing cache tables.
+
+    Parameters
+    ----------
+    df_ses, df_dsets : pandas.DataFrame
+        The sessions and datasets tables of the re-indexed sessions, with string IDs.
+    fn_ses, fn_dsets : pathlib.Path
+        The existing cache table files.
+    manifest : dict
+        The saved map of session relative paths to their folder signatures and IDs.
+    unchanged : set of str
+        The relative paths of sessions whose rows are kept from the existing tables.
+    ids : dict
+        A map of session string IDs to existing IDs.  Dataset IDs of re-indexed sessions are
+        added to this map.
+    ns : uuid.UUID, optional
+        The namespace of new session and dataset UUIDs.  If None, new IDs are not converted to
+        UUIDs.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The merged sessions table.
+    pandas.DataFrame
+        The merged datasets table.
+    """
+    old_ses, old_dsets = (parquet.load(x)[0] for x in (fn_ses, fn_dsets))
+    old_ses, old_dsets = (x if isinstance(x.index, pd.RangeIndex) else x.reset_index()
+                          for x in (old_ses, old_dsets))
+    # Map the existing dataset IDs of re-indexed sessions
+    rel_paths = {v[-1]: k for k, v in manifest.items() if k not in unchanged}
+    reindexed = old_dsets[old_dsets['eid'].isin(rel_paths.keys())]
+    str_ids = (f'{rel_paths[eid]}/{rel_path}' for eid, rel_path in
+               zip(reindexed['eid'], reindexed['rel_path']))
+    ids.update(zip(str_ids, reindexed['id']))
+
+    if ns and len(df_ses) > 0:
+        df_ses, df_dsets = _ids_to_uuid(df_ses, df_dsets, ids, ns)
+        df_ses, df_dsets = df_ses.reset_index(), df_dsets.reset_index()
+    else:
+        df_ses['id'] = df_ses['id'].map(lambda x: ids.get(x, x))
+        df_dsets['eid'] = df_dsets['eid'].map(lambda x: ids.get(x, x))
+        df_dsets['id'] = df_dsets['id'].map(lambda x: ids.get(x, x))
+
+    # Keep the rows of unchanged sessions
+    eids = [manifest[k][-1] for k in unchanged]
+    df_ses = pd.concat([old_ses[old_ses['id'].isin(eids)], df_ses], ignore_index=True)
+    df_dsets = pd.concat([old_dsets[old_dsets['eid'].isin(eids)], df_dsets], ignore_index=True)
+    df_dsets = df_dsets.astype({'qc': QC_TYPE})
+    if ns:
+        df_ses = df_ses.set_index('id').sort_index()
+        df_dsets = df_dsets.set_index(['eid', 'id']).sort_index()
+    return df_ses, df_dsets
+
+
 def remove_missing_datasets(cache_dir, tables=None, remove_empty_sessions=True, dry=True):
     """
     Remove dataset files and session folders that are not in the provided cache.
@@ -8,9 +8,12 @@ https://int-brain-lab.github.io/ONE/alf_intro.html
 
 import json
 import copy
+import concurrent.futures
 import logging
 import os
 import re
+import threading
+from collections.abc import Iterator, Sized
 from fnmatch import fnmatch
 from pathlib import Path
 from typing import Union
@@ -24,12 +27,16 @@ import yaml
 
 from iblutil.util import Bunch
 from iblutil.io import parquet
-from iblutil.io import jsonable
+from iblutil.io import jsonable, hashfile
 from .exceptions import ALFObjectNotFound
 from . import spec, path as files
 from .spec import FILE_SPEC
 
 _logger = logging.getLogger(__name__)
+N_THREADS = int(os.environ.get('ONE_LOAD_THREADS', 4))
+"""int: The default number of threads used to load files concurrently."""
+HASH_BUDGET = 2 ** 30
+"""int: The maximum total size in bytes of the files being hashed concurrently."""
 
 
 class AlfBunch(Bunch):
@@ -207,9 +214,10 @@ def _ensure_flat(arr):
     Returns
     -------
     numpy.ndarray
-        A vector with shape (n,)
+        A vector with shape (n,).  This is a view of the input array, therefore memory-mapped
+        arrays are not read into memory.
     """
-    return arr.flatten() if arr.ndim == 2 and arr.shape[1] == 1 else arr
+    return arr.reshape(-1) if arr.ndim == 2 and arr.shape[1] == 1 else arr
 
 
 def ts2vec(ts: np.ndarray, n_samples: int) -> np.ndarray:
@@ -231,7 +239,7 @@ def ts2vec(ts: np.ndarray, n_samples: int) -> np.ndarray:
     if len(ts.shape) == 1:
         return ts
     elif ts.ndim == 2 and ts.shape[1] == 1:
-        return ts.flatten()  # Deal with MATLAB single column array
+        return ts.reshape(-1)  # Deal with MATLAB single column array
     if ts.ndim > 2 or ts.shape[1] != 2:
         raise ValueError('Array shape should be (2, 2)')
     # Linearly interpolate the times
@@ -276,7 +284,7 @@ def check_dimensions(dico):
     return int(ok is False)
 
 
-def load_file_content(fil):
+def load_file_content(fil, mmap_mode=None):
     """
     Returns content of files. Designed for very generic file formats:
     so far supported contents are `json`, `npy`, `csv`, `(h)tsv`, `ssv`, `jsonable`
@@ -285,6 +293,10 @@ def load_file_content(fil):
     ----------
     fil : str, pathlib.Path
         File to read
+    mmap_mode : {None, 'r+', 'r', 'w+', 'c'}
+        If not None, npy files are memory-mapped using the given mode (see numpy.load), so only
+        the parts of the array that are accessed are read from disk.  Arrays of Python objects
+        and other file types are always read into memory.
 
     Returns
     -------
@@ -308,7 +320,13 @@ def load_file_content(fil):
     if fil.suffix == '.jsonable':
         return jsonable.read(fil)
     if fil.suffix == '.npy':
-        return _ensure_flat(np.load(file=fil, allow_pickle=True))
+        try:
+            arr = np.load(file=fil, allow_pickle=True, mmap_mode=mmap_mode)
+        except ValueError:
+            if mmap_mode is None:
+                raise
+            arr = np.load(file=fil, allow_pickle=True)  # Object arrays can't be memory-mapped
+        return _ensure_flat(arr)
     if fil.suffix == '.npz':
         arr = np.load(file=fil)
         # If single array with the default name ('arr_0') return individual array
@@ -332,6 +350,134 @@ def load_file_content(fil):
     return Path(fil)
 
 
+def map_threads(func, items, n_threads=None) -> list:
+    """
+    Apply a function to each item using a pool of threads.
+
+    The output order matches the input order and, as with a regular loop, the first exception
+    raised (in input order) is propagated.  If iterating over the items raises, the items not
+    yet started are cancelled.
+
+    Parameters
+    ----------
+    func : function
+        A function taking a single item.
+    items : iterable
+        The items to process.  If an iterator, each item is submitted as soon as it is yielded.
+    n_threads : int, optional
+        The maximum number of threads.  Defaults to N_THREADS.  If 1, the items are processed
+        serially in the calling thread.
+
+    Returns
+    -------
+    list
+        The function output for each item.
+    """
+    n_threads = N_THREADS if n_threads is None else n_threads
+    if isinstance(items, Sized):
+        n_threads = min(n_threads, len(items))
+    if n_threads <= 1:
+        return list(map(func, items))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        futures = []
+        try:
+            for item in items:
+                futures.append(executor.submit(func, item))
+        except BaseException:
+            for future in futures:
+                future.cancel()
+            raise
+        return [future.result() for future in futures]
+
+
+def md5_files(files, n_threads=None, max_bytes=None, hash_func=None) -> list:
+    """
+    Compute the MD5 hash of multiple files using a pool of threads.
+
+    Hashing releases the GIL so several files are read and hashed at once.  To avoid thrashing
+    the disks with many large files, a new file is only submitted once the total size of the
+    files being hashed is within a byte budget.  A file larger than the budget is hashed alone.
+
+    Parameters
+    ----------
+    files : list of str, pathlib.Path
+        The files to hash.
+    n_threads : int, optional
+        The maximum number of threads.  Defaults to N_THREADS.  If 1, the files are hashed
+        serially in the calling thread.
+    max_bytes : int, optional
+        The maximum total size of the files hashed concurrently.  Defaults to HASH_BUDGET.
+    hash_func : function, optional
+        The function that returns the hash of a single file.  Defaults to
+        iblutil.io.hashfile.md5.
+
+    Returns
+    -------
+    list of str
+        The hash of each file, in input order.
+
+    Examples
+    --------
+    >>> hashes = md5_files(sorted(Path(session_path).rglob('*.*')), n_threads=8)
+    """
+    files = list(files)
+    hash_func = hash_func or hashfile.md5
+    n_threads = min(N_THREADS if n_threads is None else n_threads, len(files))
+    if n_threads <= 1:
+        return list(map(hash_func, files))
+    max_bytes = HASH_BUDGET if max_bytes is None else max_bytes
+    in_flight = 0  # total size of the files currently being hashed
+    available = threading.Condition()
+
+    def _hash(file, size):
+        nonlocal in_flight
+        try:
+            return hash_func(file)
+        finally:
+            with available:
+                in_flight -= size
+                available.notify_all()
+
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+        for file in files:
+            size = min(os.stat(file).st_size, max_bytes)
+            with available:
+                available.wait_for(lambda: in_flight + size <= max_bytes)
+                in_flight += size
+            futures.append(executor.submit(_hash, file, size))
+        return [future.result() for future in futures]
+
+
+def load_file_contents(files, n_threads=None, **kwargs) -> list:
+    """
+    Returns content of multiple files, loading them concurrently.
+
+    Overlapping file reads substantially reduces the load time on network file systems where
+    per-file latency dominates.
+
+    Parameters
+    ----------
+    files : iterable of str, pathlib.Path
+        The files to read.  None values are returned as None.  If an iterator, each file is
+        loaded as soon as it is yielded.
+    n_threads : int, optional
+        The maximum number of threads.  Defaults to N_THREADS.
+    **kwargs
+        Optional arguments to pass to load_file_content, e.g. mmap_mode.
+
+    Returns
+    -------
+    list
+        The content of each file, in the same order as the input.
+
+    Examples
+    --------
+    >>> times, clusters = load_file_contents(['spikes.times.npy', 'spikes.clusters.npy'])
+    """
+    return map_threads(partial(load_file_content, **kwargs), files, n_threads)
+
+
 def _ls(alfpath, object=None, **kwargs) -> (list, tuple):
     """
     Given a path, an object and a filter, returns all files and associated attributes
@@ -381,17 +527,83 @@ def _ls(alfpath, object=None, **kwargs) -> (list, tuple):
     return [alfpath.joinpath(f) for f in files_alf], attributes
 
 
-def iter_sessions(root_dir, pattern='*'):
+def _scan_folder(folder):
+    """
+    List the session folders and the other sub-folders of a folder.
+
+    Parameters
+    ----------
+    folder : str
+        The folder to scan.
+
+    Returns
+    -------
+    list of str
+        The session folders within the folder.
+    list of str
+        The sub-folders within the folder, including session folders but excluding symlinks.
+    """
+    sessions, folders = [], []
+    try:
+        with os.scandir(folder) as it:
+            for entry in it:
+                if not entry.is_dir():
+                    continue
+                if spec.is_session_path(entry.path):
+                    sessions.append(entry.path)
+                if not entry.is_symlink():
+                    folders.append(entry.path)
+    except OSError as ex:  # e.g. permission denied
+        _logger.debug('Failed to scan %s: %s', folder, ex)
+    return sessions, folders
+
+
+def _match_parts(parts, pattern, partial=False):
+    """
+    Match the parts of a relative path against those of a glob pattern.
+
+    Parameters
+    ----------
+    parts : tuple of str
+        The relative path parts.
+    pattern : tuple of str
+        The glob pattern parts.  A '**' part matches zero or more path parts.
+    partial : bool
+        If True, return whether the path may be extended by one or more parts to match the
+        pattern, i.e. whether its sub-folders could match.
+
+    Returns
+    -------
+    bool
+        True if the path matches.
+    """
+    if not pattern:
+        return not (parts or partial)
+    if pattern[0] == '**':
+        return partial or any(
+            _match_parts(parts[i:], pattern[1:]) for i in range(len(parts) + 1))
+    if not parts:
+        return partial
+    return fnmatch(parts[0], pattern[0]) and _match_parts(parts[1:], pattern[1:], partial)
+
+
+def iter_sessions(root_dir, pattern='**', n_threads=None):
     """
     Recursively iterate over session paths in a given directory.
 
+    The folder tree is crawled by a pool of threads, each listing a single folder with
+    `os.scandir`.  Folders that can not contain a path matching the pattern are not scanned.
+
     Parameters
     ----------
     root_dir : str, pathlib.Path
         The folder to look for sessions.
     pattern : str
-        Glob pattern to use. Default searches all folders.  Providing a more specific pattern makes
-        this more performant (see examples).
+        Glob pattern that the session path (relative to root_dir) must match, where '**' matches
+        any number of folders. Default searches all folders.  Providing a more specific pattern
+        makes this more performant (see examples).
+    n_threads : int, optional
+        The maximum number of folders to scan at once.  Defaults to N_THREADS.
 
     Yields
     -------
@@ -410,9 +622,23 @@ def iter_sessions(root_dir, pattern='*'):
     """
     if spec.is_session_path(root_dir):
         yield root_dir
-    for path in sorted(Path(root_dir).rglob(pattern)):
-        if path.is_dir() and spec.is_session_path(path):
-            yield path
+    root_dir = Path(root_dir)
+    pattern = Path(pattern).parts
+    sessions = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads or N_THREADS) as executor:
+        pending = {executor.submit(_scan_folder, os.fspath(root_dir))}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                found, folders = future.result()
+                sessions.extend(
+                    x for x in found if _match_parts(Path(x).relative_to(root_dir).parts, pattern))
+                # Only scan the folders whose sub-folders could match the pattern
+                pending.update(
+                    executor.submit(_scan_folder, x) for x in folders
+                    if _match_parts(Path(x).relative_to(root_dir).parts, pattern, partial=True))
+    yield from sorted(map(Path, sessions))
 
 
 def iter_datasets(session_path):
@@ -429,9 +655,51 @@ def iter_datasets(session_path):
     pathlib.Path
         The next dataset path (relative to the session path) in lexicographical order.
     """
-    for p in sorted(Path(session_path).rglob('*.*')):
-        if not p.is_dir() and spec.is_valid(p.name):
-            yield p.relative_to(session_path)
+    datasets = []
+    for folder, _, filenames in os.walk(session_path):
+        datasets.extend(os.path.join(folder, x) for x in filenames if spec.is_valid(x))
+    for path in sorted(map(Path, datasets)):
+        yield path.relative_to(session_path)
+
+
+def file_sizes(paths) -> np.ndarray:
+    """
+    Return the size of multiple files, listing each parent directory only once.
+
+    Files are grouped by parent folder and each folder is scanned with a single `os.scandir`
+    call, which yields existence and size together without a `stat` call per missing file.
+
+    Parameters
+    ----------
+    paths : list of str, pathlib.Path
+        The file paths to check.
+
+    Returns
+    -------
+    numpy.ndarray
+        The size of each file in bytes, or -1 where the file does not exist.
+
+    Examples
+    --------
+    >>> sizes = file_sizes(['/data/subject/2020-01-01/001/alf/trials.table.pqt'])
+    >>> exists = sizes >= 0
+    """
+    sizes = np.full(len(paths), -1, dtype=np.int64)
+    by_folder = {}
+    for i, path in enumerate(map(os.fspath, paths)):
+        folder, name = os.path.split(path)
+        by_folder.setdefault(folder, []).append((i, name))
+    for folder, items in by_folder.items():
+        try:
+            with os.scandir(folder or os.curdir) as it:
+                entries = {entry.name: entry for entry in it}
+        except (FileNotFoundError, NotADirectoryError):
+            continue  # None of these files exist
+        for i, name in items:
+            entry = entries.get(name)
+            if entry is not None and entry.is_file():
+                sizes[i] = entry.stat().st_size
+    return sizes
 
 
 def exists(alfpath, object, attributes=None, **kwargs) -> bool:
@@ -474,7 +742,8 @@ def exists(alfpath, object, attributes=None, **kwargs) -> bool:
     return set(attributes).issubset(attributes_found)
 
 
-def load_object(alfpath, object=None, short_keys=False, **kwargs):
+def load_object(alfpath, object=None, short_keys=False, mmap_mode=None, n_threads=None,
+                **kwargs):
     """Reads all files sharing the same object name.
 
     For example, if the file provided to the function is `spikes.times`, the function will
@@ -487,8 +756,9 @@ def load_object(alfpath, object=None, short_keys=False, **kwargs):
 
     Parameters
     ----------
-    alfpath : str, pathlib.Path, list
-        Any ALF path pertaining to the object OR directory containing ALFs OR list of paths.
+    alfpath : str, pathlib.Path, list, iterator
+        Any ALF path pertaining to the object OR directory containing ALFs OR list of paths.  If
+        an iterator of paths, each file is loaded as soon as it is yielded.
     object : str, list, None
         The ALF object(s) to filter by.  If a directory is provided and object is None, all valid
         ALF files returned.
@@ -496,6 +766,10 @@ def load_object(alfpath, object=None, short_keys=False, **kwargs):
         By default, the output dictionary keys will be compounds of attributes, timescale and
         any eventual parts separated by a dot. Use True to shorten the keys to the attribute
         and timescale.
+    mmap_mode : {None, 'r+', 'r', 'w+', 'c'}
+        If not None, npy files are memory-mapped using the given mode (see numpy.load).
+    n_threads : int, optional
+        The maximum number of threads used to load the files.  Defaults to N_THREADS.
     wildcards : bool
         If true uses unix shell style pattern matching, otherwise uses regular expressions.
     kwargs
@@ -515,12 +789,31 @@ def load_object(alfpath, object=None, short_keys=False, **kwargs):
         Load 'trials' object under the 'ibl' namespace
 
         >>> trials = load_object('/subject/2021-01-01/001', 'trials', namespace='ibl')
+
+        Memory-map the 'spikes' arrays instead of reading them into memory
+
+        >>> spikes = load_object('full/path/to/my/alffolder/', 'spikes', mmap_mode='r')
     """
+    def _load(fil):
+        """Load a file and any corresponding metadata file."""
+        # if there is a corresponding metadata file, read it:
+        meta_data_file = _find_metadata(fil)
+        # if this is the actual meta-data file, skip and it will be read later
+        if meta_data_file == fil:
+            return fil, meta_data_file, None, None
+        content = load_file_content(fil, mmap_mode=mmap_mode)
+        return fil, meta_data_file, content, load_file_content(meta_data_file)
+
+    loaded = None
     if isinstance(alfpath, (Path, str)):
         if Path(alfpath).is_dir() and object is None:
             raise ValueError('If a directory is provided, the object name should be provided too')
         files_alf, parts = _ls(alfpath, object, **kwargs)
     else:  # A list of paths allows us to load an object from different revisions
+        if isinstance(alfpath, Iterator):
+            # Load files as they are yielded, then sort them for a deterministic key order
+            loaded = sorted(map_threads(_load, alfpath, n_threads), key=lambda x: str(x[0]))
+            alfpath = [x[0] for x in loaded]
         files_alf = alfpath
         parts = [files.filename_parts(x.name) for x in files_alf]
         assert len(set(p[1] for p in parts)) == 1
@@ -534,16 +827,14 @@ def load_object(alfpath, object=None, short_keys=False, **kwargs):
         f'multiple object {object} with the same attribute in {alfpath}, restrict parts/namespace')
     out = AlfBunch({})
 
-    # load content for each file
-    for fil, att in zip(files_alf, attributes):
-        # if there is a corresponding metadata file, read it:
-        meta_data_file = _find_metadata(fil)
-        # if this is the actual meta-data file, skip and it will be read later
+    # load content for each file concurrently
+    if loaded is None:
+        loaded = map_threads(_load, files_alf, n_threads)
+    for fil, att, (_, meta_data_file, content, meta) in zip(files_alf, attributes, loaded):
         if meta_data_file == fil:
             continue
-        out[att] = load_file_content(fil)
+        out[att] = content
         if meta_data_file:
-            meta = load_file_content(meta_data_file)
             # the columns keyword splits array along the last dimension
             if 'columns' in meta.keys():
                 out.update({v: out[att][::, k] for k, v in enumerate(meta['columns'])})
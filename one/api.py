@@ -1,18 +1,21 @@
 """Classes for searching, listing and (down)loading ALyx Files."""
 import collections.abc
+import copy
+import os
 import urllib.parse
 import warnings
 import logging
 from datetime import datetime, timedelta
 from functools import lru_cache, partial
+from itertools import chain
 from inspect import unwrap
 from pathlib import Path, PurePosixPath
 from typing import Any, Union, Optional, List
-from uuid import UUID
+from uuid import UUID, uuid4
 from urllib.error import URLError
-import time
 import threading
-import os
+import queue
+import weakref
 
 import pandas as pd
 import numpy as np
@@ -27,7 +30,11 @@ import one.webclient as wc
 import one.alf.io as alfio
 import one.alf.path as alfiles
 import one.alf.exceptions as alferr
-from .alf.cache import make_parquet_db, DATASETS_COLUMNS, SESSIONS_COLUMNS
+from .alf.cache import (
+    make_parquet_db, DatasetIndex, FileHashCache, DATASETS_COLUMNS, SESSIONS_COLUMNS,
+    INDEX_KEY, MAX_DELTAS, load_table, table_revision, delta_files, save_delta, load_deltas,
+    remove_deltas,
+    snapshot_key, save_snapshot, load_snapshot, share_tables, attach_tables)
 from .alf.spec import is_uuid_string, QC, to_alf
 from . import __version__
 from one.converters import ConversionMixin, session_record2path
@@ -35,8 +42,14 @@ from one import util
 
 _logger = logging.getLogger(__name__)
 __all__ = ['ONE', 'One', 'OneAlyx']
-N_THREADS = os.environ.get('ONE_HTTP_DL_THREADS', 4)
+N_THREADS = wc.N_THREADS
 """int: The number of download threads."""
+SYNC_MAX_RECORDS = 10_000
+"""int: The number of modified datasets above which the full cache tables are downloaded instead
+of synchronized."""
+SYNC_MARGIN = timedelta(hours=1)
+"""datetime.timedelta: How long before the creation of the cache tables to synchronize datasets
+from, as modifications made while the tables were being generated may be missing from them."""
 
 
 class One(ConversionMixin):
@@ -49,6 +62,24 @@ class One(ConversionMixin):
     uuid_filenames = None
     """bool: whether datasets on disk have a UUID in their filename."""
 
+    index_datasets = True
+    """bool: whether to filter datasets via an in-memory index of the datasets table."""
+
+    lazy_columns = ()
+    """tuple of str: datasets table columns, e.g. ('hash', 'file_size'), loaded upon first use."""
+
+    snapshot_tables = False
+    """bool: whether to save the loaded cache tables as a snapshot that is faster to load."""
+
+    background_refresh = False
+    """bool: whether to reload expired cache tables on a background thread, using the current
+    tables until the new ones are loaded."""
+
+    int_ids = False
+    """bool: whether to index the datasets and sessions tables by 128-bit integer UUIDs, which
+    use less memory than strings.  UUIDs are converted to and from strings by the methods that
+    take or return them, e.g. One.to_eid, One.list_datasets and One.load_dataset_from_id."""
+
     def __init__(self, cache_dir=None, mode='auto', wildcards=True, tables_dir=None):
         """An API for searching and loading data on a local filesystem
 
@@ -79,6 +110,8 @@ class One(ConversionMixin):
         self.record_loaded = False
         # assign property here as different instances may work on separate filesystems
         self.uuid_filenames = False
+        self._refresh_thread = None  # background cache refresh (see background_refresh)
+        self._cache_lock = threading.RLock()  # held while modifying or replacing _cache
         # init the cache file
         self._reset_cache()
         self.load_cache()
@@ -91,6 +124,39 @@ class One(ConversionMixin):
         """bool: True if mode is local or no Web client set."""
         return self.mode == 'local' or not getattr(self, '_web_client', False)
 
+    @property
+    def _index(self):
+        """one.alf.cache.DatasetIndex: The datasets table index, built upon first access."""
+        if not self.index_datasets or 'datasets' not in self._cache:
+            return
+        if self._cache.get('_index') is None:
+            self._cache['_index'] = DatasetIndex(self._cache['datasets']['rel_path'])
+        return self._cache['_index']
+
+    @property
+    def _file_hashes(self):
+        """one.alf.cache.FileHashCache: The hashes of local files, saved with the cache tables."""
+        path = Path(self._tables_dir or self.cache_dir, FileHashCache.filename)
+        if getattr(self, '_hash_cache', None) is None or self._hash_cache.path != path:
+            self._hash_cache = FileHashCache(path)
+        return self._hash_cache
+
+    def _decompose(self, rel_paths):
+        """Decompose relative paths into their ALF parts, parsing each unique path once.
+
+        Parameters
+        ----------
+        rel_paths : pandas.Series
+            The relative paths to decompose, e.g. the 'rel_path' column of a datasets table.
+
+        Returns
+        -------
+        pandas.DataFrame
+            A table of Categorical ALF part columns with the index of rel_paths.
+        """
+        index = self._index
+        return (DatasetIndex() if index is None else index).decompose(rel_paths)
+
     @util.refresh
     def search_terms(self, query_type=None) -> tuple:
         """List the search term keyword args for use in the search method."""
@@ -104,6 +170,10 @@ class One(ConversionMixin):
             'loaded_time': None,
             'modified_time': None,
             'saved_time': None,
+            'modified_tables': {},  # map of tables to IDs modified since loading or saving
+            'unloaded_columns': {},  # map of tables to columns not yet loaded from file
+            'delta_files': {},  # map of tables to the names of the modification files applied
+            'shared_tables': set(),  # tables attached read-only from shared memory
             'raw': {}  # map of original table metadata
         }})
 
@@ -118,33 +188,47 @@ class One(ConversionMixin):
         """
         self._reset_cache()
         meta = self._cache['_meta']
-        INDEX_KEY = '.?id'
         self._tables_dir = Path(tables_dir or self._tables_dir or self.cache_dir)
-        for cache_file in self._tables_dir.glob('*.pqt'):
-            table = cache_file.stem
-            # we need to keep this part fast enough for transient objects
-            cache, meta['raw'][table] = parquet.load(cache_file)
-            if 'date_created' not in meta['raw'][table]:
-                _logger.warning(f"{cache_file} does not appear to be a valid table. Skipping")
-                continue
+        key = tables = None
+        if shared := os.environ.get('ONE_SHARED_CACHE'):
+            tables, snapshot_meta = self._attach_cache(shared)
+        if self.snapshot_tables and not tables:
+            key = self._snapshot_key()
+            tables, snapshot_meta = load_snapshot(self._tables_dir, key)
+        if tables:
+            _logger.debug('Loaded cache tables from %s', 'shared memory' if shared else 'snapshot')
+            self._cache.update(tables)
+            meta['raw'], meta['unloaded_columns'] = snapshot_meta
             meta['loaded_time'] = datetime.now()
-
-            # Set the appropriate index if none already set
-            if isinstance(cache.index, pd.RangeIndex):
-                idx_columns = sorted(cache.filter(regex=INDEX_KEY).columns)
-                if len(idx_columns) == 0:
-                    raise KeyError('Failed to set index')
-                cache.set_index(idx_columns, inplace=True)
-
-            # Patch older tables
-            cache = util.patch_cache(cache, meta['raw'][table].get('min_api_version'), table)
-
-            # Check sorted
-            # Sorting makes MultiIndex indexing O(N) -> O(1)
-            if not cache.index.is_monotonic_increasing:
-                cache.sort_index(inplace=True)
-
-            self._cache[table] = cache
+            # The tables were saved with all modification files present, as the key depends on them
+            meta['delta_files'] = {
+                table: {x.name for x in delta_files(self._tables_dir, table)} for table in tables}
+        else:
+            for cache_file in self._tables_dir.glob('*.pqt'):
+                table = cache_file.stem
+                # we need to keep this part fast enough for transient objects
+                lazy = self.lazy_columns if table == 'datasets' else ()
+                cache, meta['raw'][table] = load_table(cache_file, exclude=lazy)
+                if 'date_created' not in meta['raw'][table]:
+                    _logger.warning(f"{cache_file} does not appear to be a valid table. Skipping")
+                    continue
+                meta['loaded_time'] = datetime.now()
+                if unloaded := [x for x in lazy if x not in cache.columns]:
+                    meta['unloaded_columns'][table] = unloaded
+                # Apply any modifications saved since the table file was written
+                files = delta_files(self._tables_dir, table)
+                deltas, metadata = load_deltas(
+                    self._tables_dir, table, self._revision(table), files=files)
+                meta['delta_files'][table] = {x.name for x in files}
+                if 'date_synced' in metadata:  # Rows were synchronized with the database
+                    meta['raw'][table]['date_synced'] = metadata['date_synced']
+                if deltas is not None:
+                    deltas = deltas.drop(columns=unloaded, errors='ignore')
+                self._cache[table] = self._prepare_table(table, cache, deltas)
+            if key and len(self._cache) > 1:
+                tables = {k: v for k, v in self._cache.items() if not k.startswith('_')}
+                snapshot_meta = (meta['raw'], meta['unloaded_columns'])
+                save_snapshot(self._tables_dir, key, tables, snapshot_meta)
 
         if len(self._cache) == 1:
             # No tables present
@@ -155,7 +239,8 @@ class One(ConversionMixin):
                 'sessions': pd.DataFrame(columns=SESSIONS_COLUMNS).set_index('id')})
             if self.offline:  # In online mode, the cache tables should be downloaded later
                 warnings.warn(f'No cache tables found in {self._tables_dir}')
-        created = [datetime.fromisoformat(x['date_created'])
+        # Tables synchronized with the database are as recent as the remote ones
+        created = [datetime.fromisoformat(x.get('date_synced', x['date_created']))
                    for x in meta['raw'].values() if 'date_created' in x]
         if created:
             meta['created_time'] = min(created)
@@ -163,6 +248,186 @@ class One(ConversionMixin):
         self._cache['_meta'] = meta
         return self._cache['_meta']['loaded_time']
 
+    def _snapshot_key(self):
+        """str: The key of the table files, ONE version and options the loaded tables depend on."""
+        return snapshot_key(self._tables_dir, __version__, pd.__version__,
+                            str(self._tables_dir), list(self.lazy_columns), self.int_ids)
+
+    def share_cache(self):
+        """
+        Publish the loaded cache tables to One instances in other processes.
+
+        The tables are copied into a block of shared memory whose name is returned.  One instances
+        created in processes whose ONE_SHARED_CACHE environment variable is set to this name
+        (e.g. via a multiprocessing pool initializer or the environment of a subprocess) with the
+        same tables directory attach to these tables instead of loading their own copy.
+        Numerical columns are mapped read-only without copying and are copied by the worker only
+        if it modifies the tables.  The shared tables are ignored once the table files change.
+
+        The shared memory is released when this instance is garbage collected.
+
+        Returns
+        -------
+        str
+            The name of the shared memory block.
+
+        Examples
+        --------
+        >>> one = ONE()
+        >>> name = one.share_cache()
+        >>> env = {'ONE_SHARED_CACHE': name}
+        >>> with multiprocessing.Pool(8, os.environ.update, (env,)) as pool:  # workers call ONE()
+        ...     results = pool.map(my_analysis, eids)
+
+        Run a script that calls ONE() in a subprocess
+
+        >>> subprocess.run(['python', 'my_analysis.py'], env={**os.environ, **env})
+        """
+        meta = self._cache['_meta']
+        tables = {k: v for k, v in self._cache.items() if not k.startswith('_')}
+        shm = share_tables(
+            self._snapshot_key(), tables, (meta['raw'], meta['unloaded_columns']))
+        weakref.finalize(self, _release_shared_memory, shm)
+        _logger.debug(f'Shared cache tables in {shm.name} ({shm.size} bytes)')
+        return shm.name
+
+    def _attach_cache(self, name):
+        """
+        Attach to the cache tables shared by another process.
+
+        Parameters
+        ----------
+        name : str
+            The name of the shared memory block (see One.share_cache).
+
+        Returns
+        -------
+        dict of pandas.DataFrame, None
+            The shared tables, or None if not found or out of date.
+        tuple, None
+            The table file metadata and unloaded columns.
+        """
+        try:
+            tables, metadata = attach_tables(name, self._snapshot_key())
+        except FileNotFoundError:
+            _logger.debug(f'Shared cache tables {name} not found')
+            return None, None
+        if tables:
+            self._cache['_meta']['shared_tables'].update(tables)
+        return tables, metadata
+
+    def _ensure_writable(self, table):
+        """Copy a table attached from shared memory before it is modified in place."""
+        shared = self._cache['_meta']['shared_tables']
+        if table in shared:
+            self._cache[table] = self._cache[table].copy()
+            shared.discard(table)
+
+    def _to_index(self, ids):
+        """Convert one or more UUIDs to the type of the cache table index (see One.int_ids)."""
+        return util.uuid2int(ids) if self.int_ids else ids
+
+    def _from_index(self, ids):
+        """Convert one or more cache table index UUIDs to strings (see One.int_ids)."""
+        return util.int2uuid(ids) if self.int_ids else ids
+
+    def _prepare_table(self, table, cache, deltas=None):
+        """
+        Index, patch and sort a loaded cache table.
+
+        Parameters
+        ----------
+        table : str
+            The table name, e.g. 'datasets'.
+        cache : pandas.DataFrame
+            The table as loaded from file.
+        deltas : pandas.DataFrame, optional
+            The rows modified since the table file was written (see one.alf.cache.load_deltas).
+
+        Returns
+        -------
+        pandas.DataFrame
+            The cache table.
+        """
+        # Set the appropriate index if none already set
+        if isinstance(cache.index, pd.RangeIndex):
+            idx_columns = sorted(cache.filter(regex=INDEX_KEY).columns)
+            if len(idx_columns) == 0:
+                raise KeyError('Failed to set index')
+            cache.set_index(idx_columns, inplace=True)
+
+        # Patch older tables
+        min_api_version = self._cache['_meta']['raw'][table].get('min_api_version')
+        cache = util.patch_cache(cache, min_api_version, table)
+
+        if deltas is not None:
+            cache = pd.concat([cache[~cache.index.isin(deltas.index)], deltas])
+
+        if self.int_ids and table in ('datasets', 'sessions'):
+            cache = util.cache_ids2int(cache)
+
+        # Check sorted
+        # Sorting makes MultiIndex indexing O(N) -> O(1)
+        if not cache.index.is_monotonic_increasing:
+            cache.sort_index(inplace=True)
+        return cache
+
+    def _load_columns(self, table, columns=None):
+        """
+        Load the columns of a cache table that were not loaded with the table.
+
+        Parameters
+        ----------
+        table : str
+            The table name, e.g. 'datasets'.
+        columns : list of str, optional
+            The columns required.  If None, all unloaded columns are loaded.
+
+        See Also
+        --------
+        One.lazy_columns
+        """
+        unloaded = self._cache['_meta']['unloaded_columns'].get(table)
+        to_load = [x for x in unloaded or () if columns is None or x in columns]
+        if not to_load:
+            return
+        cache = self._cache[table]
+        loaded = self._read_columns(table, to_load, cache.index)
+        # Columns missing from the table file are left as they are
+        self._cache[table] = cache.assign(**{x: v.values for x, v in loaded.items()})
+        self._cache['_meta']['unloaded_columns'][table] = [
+            x for x in unloaded if x not in to_load]
+        _logger.debug(f'Loaded {table} table columns {to_load}')
+
+    def _read_columns(self, table, columns, index):
+        """
+        Read columns of a cache table file without loading them into the cache.
+
+        The modifications saved since the table file was written are applied.
+
+        Parameters
+        ----------
+        table : str
+            The table name, e.g. 'datasets'.
+        columns : list of str
+            The columns to read.  Columns absent from the table file are ignored.
+        index : pandas.Index
+            The rows to return.  Rows absent from the table file are filled with NaN.
+
+        Returns
+        -------
+        pandas.DataFrame
+            The table columns.
+        """
+        filename = Path(self._tables_dir, f'{table}.pqt')
+        loaded, metadata = load_table(filename, columns=columns)
+        revision = metadata.get('revision') or metadata.get('date_created')
+        deltas, _ = load_deltas(self._tables_dir, table, revision)
+        if deltas is not None:
+            deltas = deltas[[x for x in deltas.columns if x in loaded.columns]]
+        loaded = self._prepare_table(table, loaded, deltas).filter(items=columns)
+        return loaded[~loaded.index.duplicated()].reindex(index)
+
     def save_cache(self, save_dir=None, force=False):
         """Save One._cache attribute into parquet tables if recently modified.
 
@@ -175,18 +440,36 @@ class One(ConversionMixin):
         """
         threading.Thread(target=lambda: self._save_cache(save_dir=save_dir, force=force)).start()
 
+    def _revision(self, table):
+        """str: The revision of a loaded table file, used to match its modification files."""
+        metadata = self._cache['_meta']['raw'].get(table, {})
+        return metadata.get('revision') or metadata.get('date_created')
+
+    @util.cache_locked
     def _save_cache(self, save_dir=None, force=False):
         """
-        Checks if another process is writing to file, if so waits before saving.
+        Save the modified cache tables, waiting for any other process writing to them.
+
+        When only some rows of a table have been modified, these rows are appended to the
+        table's modification files (see one.alf.cache.save_delta), which are applied when the
+        table is next loaded.  If the table file was rewritten by another process since loading,
+        the rows are saved as modifications of the new table file.  Once there are more than
+        one.alf.cache.MAX_DELTAS of these, or the whole table was modified, or rows were removed,
+        the table file is rewritten and its modification files removed.  Before rewriting, any
+        modifications saved by other processes since loading are applied to the table, except to
+        the rows modified here.
+
+        Each table is written to a temporary file that then atomically replaces the table file,
+        so that other processes never read a partially written table.  Writers are serialized
+        with an OS-level lock on the '.cache.lock' file.
 
         Parameters
         ----------
         save_dir : str, pathlib.Path
             The directory path into which the tables are saved.  Defaults to cache directory.
         force : bool
-            If True, the cache is saved regardless of modification time.
+            If True, all tables are rewritten regardless of modification time.
         """
-        TIMEOUT = 5  # Delete lock file this many seconds after creation/modification or waiting
         lock_file = Path(self.cache_dir).joinpath('.cache.lock')
         save_dir = Path(save_dir or self.cache_dir)
         meta = self._cache['_meta']
@@ -194,26 +477,76 @@ class One(ConversionMixin):
         update_time = max(meta.get(x) or datetime.min for x in ('loaded_time', 'saved_time'))
         if modified < update_time and not force:
             return  # Not recently modified; return
-
-        # Check if in use by another process
-        while lock_file.exists():
-            if time.time() - lock_file.stat().st_ctime > TIMEOUT:
-                lock_file.unlink(missing_ok=True)
-            else:
-                time.sleep(.1)
-
-        _logger.info('Saving cache tables...')
-        lock_file.touch()
-        try:
-            for table in filter(lambda x: not x[0] == '_', self._cache.keys()):
+        tables = [x for x in self._cache.keys() if not x.startswith('_')]
+        modified_tables = meta.get('modified_tables') or {}
+        if modified_tables and not force:
+            tables = [x for x in tables if x in modified_tables]
+        # Modifications may only be appended to the table files they were loaded from
+        same_dir = self._tables_dir is not None and save_dir == Path(self._tables_dir)
+
+        with util.file_lock(lock_file):
+            _logger.info('Saving cache tables...')
+            for table in tables:
+                # Columns not loaded are copied from the table file rather than loaded
+                unloaded = meta['unloaded_columns'].get(table, [])
                 metadata = meta['raw'][table]
                 metadata['date_modified'] = modified.isoformat(sep=' ', timespec='minutes')
                 filename = save_dir.joinpath(f'{table}.pqt')
-                parquet.save(filename, self._cache[table], metadata)
+                ids = None if force else modified_tables.get(table)
+                applied = meta['delta_files'].setdefault(table, set())
+                if (
+                    ids is not None and same_dir and filename.exists() and
+                    len(delta_files(save_dir, table)) < MAX_DELTAS
+                ):
+                    cache = self._cache[table]
+                    rows = cache[cache.index.get_level_values(-1).isin(list(ids))]
+                    # Removed rows can not be saved as modifications; rewrite the table instead
+                    if rows.index.get_level_values(-1).nunique() == len(ids):
+                        revision = table_revision(filename)
+                        if revision != self._revision(table):
+                            _logger.warning(
+                                f'{filename} was rewritten by another process; '
+                                'saving modified rows as modifications of the new table')
+                        if unloaded:
+                            copied = self._read_columns(table, unloaded, rows.index)
+                            rows = rows.assign(**{x: v.values for x, v in copied.items()})
+                        rows = util.cache_ids2str(rows)
+                        synced = {k: metadata[k] for k in ('date_synced',) if k in metadata}
+                        applied.add(save_delta(save_dir, table, rows, revision, synced).name)
+                        _logger.debug(f'Saved {len(rows)} modified rows of {filename}')
+                        continue
+                if same_dir:
+                    # Apply modifications saved by other processes since the table was loaded
+                    files = [x for x in delta_files(save_dir, table) if x.name not in applied]
+                    deltas, _ = load_deltas(save_dir, table, self._revision(table), files=files)
+                    if deltas is not None and self.int_ids:
+                        deltas = util.cache_ids2int(deltas)
+                    if deltas is not None and ids is not None:
+                        deltas = deltas[~deltas.index.get_level_values(-1).isin(list(ids))]
+                    if deltas is not None and not deltas.empty:
+                        _logger.debug(f'Applying {len(deltas)} rows modified by other processes')
+                        deltas = deltas.drop(columns=unloaded, errors='ignore')
+                        cache = self._cache[table]
+                        self._cache[table] = pd.concat(
+                            [cache[~cache.index.isin(deltas.index)], deltas]).sort_index()
+                        meta['shared_tables'].discard(table)
+                metadata['revision'] = uuid4().hex
+                cache = self._cache[table]
+                if unloaded:
+                    copied = self._read_columns(table, unloaded, cache.index)
+                    cache = cache.assign(**{x: v.values for x, v in copied.items()})
+                tmp_file = filename.with_name(f'.{filename.name}.{os.getpid()}.tmp')
+                try:
+                    parquet.save(tmp_file, util.cache_ids2str(cache), metadata)
+                    os.replace(tmp_file, filename)
+                finally:
+                    tmp_file.unlink(missing_ok=True)
+                remove_deltas(save_dir, table)
+                if same_dir:
+                    applied.clear()
                 _logger.debug(f'Saved {filename}')
             meta['saved_time'] = datetime.now()
-        finally:
-            lock_file.unlink()
+            modified_tables.clear()
 
     def refresh_cache(self, mode='auto'):
         """Check and reload cache tables.
@@ -238,7 +571,10 @@ class One(ConversionMixin):
         elif mode == 'auto':
             if datetime.now() - self._cache['_meta']['loaded_time'] >= self.cache_expiry:
                 _logger.info('Cache expired, refreshing')
-                self.load_cache()
+                if self.background_refresh:
+                    self._refresh_in_background()
+                else:
+                    self.load_cache()
         elif mode == 'refresh':
             _logger.debug('Forcing reload of cache')
             self.load_cache(clobber=True)
@@ -246,6 +582,47 @@ class One(ConversionMixin):
             raise ValueError(f'Unknown refresh type "{mode}"')
         return self._cache['_meta']['loaded_time']
 
+    def _refresh_in_background(self):
+        """
+        Reload the cache tables on a background thread.
+
+        The tables are loaded by a copy of this instance with its own cache, hash cache and web
+        client, and swapped in once ready, so that the current tables may be used in the meantime.
+        As with One.load_cache, unsaved modifications to the current tables are discarded.
+
+        Returns
+        -------
+        threading.Thread
+            The refresh thread.  If a refresh is already in progress, its thread is returned.
+        """
+        if self._refresh_thread and self._refresh_thread.is_alive():
+            return self._refresh_thread
+
+        def refresh():
+            try:
+                staging.load_cache()
+            except Exception as ex:
+                _logger.error(f'{type(ex).__name__}: Failed to refresh the cache tables')
+                _logger.debug(ex, exc_info=True)
+                return
+            # Swap in the new tables; the mode may have changed if Alyx could not be reached
+            with self._cache_lock:
+                self._tables_dir, self.mode = staging._tables_dir, staging.mode
+                self._cache = staging._cache
+            _logger.debug('Refreshed cache tables in background')
+
+        staging = copy.copy(self)
+        with self._cache_lock:
+            staging._cache = Bunch({'_meta': copy.deepcopy(self._cache['_meta'])})
+        staging._cache_lock = threading.RLock()
+        staging._hash_cache = None
+        if getattr(self, '_web_client', None) is not None:
+            staging._web_client = copy.copy(self._web_client)
+        self._refresh_thread = threading.Thread(target=refresh, name='refresh_cache', daemon=True)
+        self._refresh_thread.start()
+        return self._refresh_thread
+
+    @util.cache_locked
     def _update_cache_from_records(self, strict=False, **kwargs):
         """
         Update the cache tables with new records.
@@ -284,6 +661,10 @@ class One(ConversionMixin):
                 raise KeyError(f'Table "{table}" not in cache')
             if isinstance(records, pd.Series):
                 records = pd.DataFrame([records])
+            # Only the columns being updated need loading
+            self._load_columns(table, records.columns)
+            if self.int_ids:
+                records = util.cache_ids2int(records)
             if not strict:
                 # Deal with case where there are extra columns in the cache
                 extra_columns = set(self._cache[table].columns) - set(records.columns)
@@ -296,22 +677,81 @@ class One(ConversionMixin):
                 records.drop(to_drop, axis=1, inplace=True)
                 records = records.reindex(columns=self._cache[table].columns)
             assert set(self._cache[table].columns) == set(records.columns)
+            if table == 'datasets' and self._cache.get('_index') is not None:
+                self._cache['_index'].update(records['rel_path'])
             # Update existing rows
             to_update = records.index.isin(self._cache[table].index)
+            self._ensure_writable(table)
             self._cache[table].loc[records.index[to_update], :] = records[to_update]
             # Assign new rows
             to_assign = records[~to_update]
-            if isinstance(self._cache[table].index, pd.MultiIndex) and not to_assign.empty:
-                # Concatenate and sort (no other way for non-unique index within MultiIndex)
-                frames = filter(lambda x: not x.empty, [self._cache[table], to_assign])
-                self._cache[table] = pd.concat(frames).sort_index()
-            else:
-                for index, record in to_assign.iterrows():
-                    self._cache[table].loc[index, :] = record[self._cache[table].columns].values
+            if not to_assign.empty:
+                self._cache[table] = self._insert_rows(self._cache[table], to_assign)
             updated = datetime.now()
+            self._set_modified(table, records.index.get_level_values(-1))
         self._cache['_meta']['modified_time'] = updated
         return updated
 
+    @staticmethod
+    def _insert_rows(table, rows):
+        """
+        Insert new rows into a cache table, keeping the table sorted by index.
+
+        The rows are sorted and their insertion positions found by a binary search of the
+        (already sorted) table index, so that all rows are added with a single concatenation
+        instead of re-sorting the whole table.
+
+        Parameters
+        ----------
+        table : pandas.DataFrame
+            A cache table.
+        rows : pandas.DataFrame
+            The rows to insert, with the same columns as the table.  The index values must not
+            already be in the table.
+
+        Returns
+        -------
+        pandas.DataFrame
+            A new table containing the inserted rows.
+        """
+        rows = rows.sort_index()
+        if rows.index.nlevels == table.index.nlevels:
+            rows = rows.rename_axis(index=table.index.names)
+        if table.empty:
+            return rows
+        if not table.index.is_monotonic_increasing:
+            return pd.concat([table, rows]).sort_index()
+        # Position of each row in the merged table
+        insert_at = table.index.searchsorted(rows.index)
+        n_table, n_rows = len(table), len(rows)
+        new_positions = insert_at + np.arange(n_rows)
+        old_positions = np.arange(n_table) + np.searchsorted(insert_at, np.arange(n_table),
+                                                             side='right')
+        order = np.empty(n_table + n_rows, dtype=int)
+        order[old_positions] = np.arange(n_table)
+        order[new_positions] = np.arange(n_table, n_table + n_rows)
+        return pd.concat([table, rows]).take(order)
+
+    def _set_modified(self, table, ids=None):
+        """
+        Record the modification of cache table rows, to be persisted by the next save.
+
+        Parameters
+        ----------
+        table : str
+            The name of the modified table.
+        ids : iterable, optional
+            The IDs (last index level) of the modified or added rows.  If None, the whole table
+            is considered modified and will be rewritten.
+        """
+        meta = self._cache['_meta']
+        meta['modified_time'] = datetime.now()
+        modified = meta.setdefault('modified_tables', {})
+        if ids is None:
+            modified[table] = None
+        elif modified.get(table, set()) is not None:
+            modified.setdefault(table, set()).update(ids)
+
     def save_loaded_ids(self, sessions_only=False, clear_list=True):
         """
         Save list of UUIDs corresponding to datasets or sessions where datasets were loaded.
@@ -340,6 +780,7 @@ class One(ConversionMixin):
         else:
             name = 'dataset_uuid'
             ids = self._cache['_loaded_datasets']
+        ids = self._from_index(ids)
 
         timestamp = datetime.now().strftime("%Y-%m-%dT%H-%M-%S%z")
         filename = Path(self._tables_dir or self.cache_dir) / f'{timestamp}_loaded_{name}s.csv'
@@ -480,10 +921,6 @@ class One(ConversionMixin):
         - In remote mode regular expressions are only supported using the `django` argument.
         """
 
-        def all_present(x, dsets, exists=True):
-            """Returns true if all datasets present in Series"""
-            return all(any(x.str.contains(y, regex=self.wildcards) & exists) for y in dsets)
-
         # Iterate over search filters, reducing the sessions table
         sessions = self._cache['sessions']
 
@@ -521,17 +958,23 @@ class One(ConversionMixin):
                 has_dset = sessions.index.isin(datasets.index.get_level_values('eid'))
                 datasets = datasets.loc[(sessions.index.values[has_dset], ), :]
                 query = ensure_list(value if key == 'dataset' else '')
-                # For each session check any dataset both contains query and exists
-                mask = (
-                    (datasets
-                        .groupby('eid', sort=False)
-                        .apply(lambda x: all_present(
-                            x['rel_path'], query, x['exists'] & x['qc'].le(qc))
-                        ))
-                )
+                # For each session check any dataset both contains query and exists.  Each
+                # pattern is evaluated once over the whole table, then reduced per session
+                codes, uniques = pd.factorize(datasets.index.get_level_values('eid'))
+                valid = (datasets['exists'] & datasets['qc'].le(qc)).values
+                mask = np.ones(len(uniques), dtype=bool)
+                index = self._index
+                for pattern in query:
+                    if index is None:
+                        matches = datasets['rel_path'].str.contains(
+                            pattern, regex=self.wildcards, na=False)
+                    else:
+                        matches = index.contains(datasets['rel_path'], pattern, self.wildcards)
+                    present = np.bincount(codes[matches.values & valid], minlength=len(uniques))
+                    mask &= present > 0
 
                 # eids of matching dataset records
-                idx = mask[mask].index
+                idx = uniques[mask]
 
                 # Reduce sessions table by datasets mask
                 sessions = sessions.loc[idx]
@@ -540,14 +983,15 @@ class One(ConversionMixin):
         if sessions.size == 0:
             return ([], None) if details else []
         sessions = sessions.sort_values(['date', 'subject', 'number'], ascending=False)
-        eids = sessions.index.to_list()
+        eids = list(self._from_index(sessions.index))
 
         if details:
             return eids, sessions.reset_index(drop=True).to_dict('records', into=Bunch)
         else:
             return eids
 
-    def _check_filesystem(self, datasets, offline=None, update_exists=True, check_hash=True):
+    def _check_filesystem(self, datasets, offline=None, update_exists=True, check_hash=True,
+                          callback=None):
         """Update the local filesystem for the given datasets.
 
         Given a set of datasets, check whether records correctly reflect the filesystem.
@@ -567,6 +1011,9 @@ class One(ConversionMixin):
         check_hash : bool
             Consider dataset missing if local file hash does not match. In online mode, the dataset
             will be re-downloaded.
+        callback : function, optional
+            A function called with the position of the dataset and its local file path as soon as
+            each file is found or downloaded.  NB: This may be called from a download thread.
 
         Returns
         -------
@@ -582,8 +1029,8 @@ class One(ConversionMixin):
             datasets = util.datasets2records(list(datasets))
         else:
             datasets = datasets.copy()
-        indices_to_download = []  # indices of datasets that need (re)downloading
-        files = []  # file path list to return
+        if self.int_ids:
+            datasets = util.cache_ids2int(datasets)
         # If the session_path field is missing from the datasets table, fetch from sessions table
         # Typically only aggregate frames contain this column
         if 'session_path' not in datasets.columns:
@@ -603,43 +1050,68 @@ class One(ConversionMixin):
             datasets.loc[idx, 'session_path'] = \
                 pd.Series(_dsets.index.get_level_values(0)).map(session_path).values
 
+        # Fetch any columns not loaded with the datasets table
+        unloaded = self._cache['_meta']['unloaded_columns'].get('datasets', ())
+        required = ('file_size', 'hash') if check_hash else ('file_size',)
+        if missing := [x for x in required if x in unloaded and x not in datasets.columns]:
+            self._load_columns('datasets', missing)
+            cached = self._cache['datasets'][missing].droplevel('eid')
+            cached = cached[~cached.index.duplicated()]
+            datasets[missing] = cached.reindex(datasets.index.get_level_values('id')).values
+
         # First go through datasets and check if file exists and hash matches
-        for i, rec in datasets.iterrows():
-            file = Path(self.cache_dir, *rec[['session_path', 'rel_path']])
-            if self.uuid_filenames:
-                file = alfiles.add_uuid_string(file, i[1] if isinstance(i, tuple) else i)
-            if file.exists():
-                # Check if there's a hash mismatch
-                # If so, add this index to list of datasets that need downloading
-                if rec['file_size'] and file.stat().st_size != rec['file_size']:
-                    _logger.warning('local file size mismatch on dataset: %s',
-                                    PurePosixPath(rec.session_path, rec.rel_path))
-                    indices_to_download.append(i)
-                elif check_hash and rec['hash'] is not None:
-                    if hashfile.md5(file) != rec['hash']:
-                        _logger.warning('local md5 mismatch on dataset: %s',
-                                        PurePosixPath(rec.session_path, rec.rel_path))
-                        indices_to_download.append(i)
-                files.append(file)  # File exists so add to file list
-            else:
-                # File doesn't exist so add None to output file list
-                files.append(None)
-                # Add this index to list of datasets that need downloading
-                indices_to_download.append(i)
+        download = not (offline or self.offline)
+        paths = self._local_paths(datasets)
+        sizes = alfio.file_sizes(paths)
+        exists = sizes >= 0
+        expected_size = pd.to_numeric(datasets['file_size'], errors='coerce').fillna(0).values
+        # Check if there's a size or hash mismatch
+        # If so, add this index to list of datasets that need downloading
+        mismatch = exists & (expected_size > 0) & (sizes != expected_size)
+        for i in np.flatnonzero(mismatch):
+            _logger.warning('local file size mismatch on dataset: %s',
+                            PurePosixPath(*datasets.iloc[i][['session_path', 'rel_path']]))
+        if check_hash:
+            hashes = datasets['hash'].values
+            to_hash = [i for i in np.flatnonzero(exists & ~mismatch)
+                       if isinstance(hashes[i], str) and hashes[i]]
+            local_hashes = self._file_hashes.md5_files([paths[i] for i in to_hash])
+            for i, local_hash in zip(to_hash, local_hashes):
+                if local_hash != hashes[i]:
+                    _logger.warning(
+                        'local md5 mismatch on dataset: %s',
+                        PurePosixPath(*datasets.iloc[i][['session_path', 'rel_path']]))
+                    mismatch[i] = True
+        # Files that exist are returned; those that are missing or mismatched are downloaded
+        files = [Path(x) if here else None for x, here in zip(paths, exists)]
+        indices_to_download = datasets.index[~exists | mismatch].tolist()
+        if callback:
+            for i in np.flatnonzero(exists & ~mismatch if download else exists):
+                callback(i, files[i])  # File will not be re-downloaded
+
+        if check_hash and to_hash:  # Save the new hashes once for the whole batch
+            self._file_hashes.save()
 
         # If online and we have datasets to download, call download_datasets with these datasets
-        if not (offline or self.offline) and indices_to_download:
-            dsets_to_download = datasets.loc[indices_to_download]
+        if download and indices_to_download:
+            dsets_to_download = util.cache_ids2str(datasets.loc[indices_to_download])
+            kwargs = {}
+            if callback:
+                # Report downloaded files by their position in the input datasets
+                positions = [datasets.index.get_loc(i) for i in indices_to_download]
+                kwargs['callback'] = lambda i, file: callback(positions[i], file)
             # Returns list of local file paths and set to variable
-            new_files = self._download_datasets(dsets_to_download, update_cache=update_exists)
+            new_files = self._download_datasets(
+                dsets_to_download, update_cache=update_exists, **kwargs)
             # Add each downloaded file to the output list of files
             for i, file in zip(indices_to_download, new_files):
                 files[datasets.index.get_loc(i)] = file
 
         # NB: Currently if not offline and a remote file is missing, an exception will be raised
         # before we reach this point. This could change in the future.
-        exists = list(map(bool, files))
-        if not all(datasets['exists'] == exists):
+        exists = np.fromiter(map(bool, files), bool, len(files))
+        changed = datasets['exists'].values != exists
+        if changed.any():
             with warnings.catch_warnings():
                 # Suppress future warning: exist column should always be present
                 msg = '.*indexing on a MultiIndex with a nested sequence of labels.*'
@@ -651,12 +1123,12 @@ class One(ConversionMixin):
                     if i.nlevels == 1:
                         # eid index level missing in datasets input
                         i = pd.IndexSlice[:, i]
+                    self._ensure_writable('datasets')
                     self._cache['datasets'].loc[i, 'exists'] = exists
-                    self._cache['_meta']['modified_time'] = datetime.now()
+                    self._set_modified('datasets', datasets.index.get_level_values(-1)[changed])
 
         if self.record_loaded:
-            loaded = np.fromiter(map(bool, files), bool)
-            loaded_ids = datasets.index.get_level_values('id')[loaded].to_numpy()
+            loaded_ids = datasets.index.get_level_values('id')[exists].to_numpy()
             if '_loaded_datasets' not in self._cache:
                 self._cache['_loaded_datasets'] = np.unique(loaded_ids)
             else:
@@ -666,6 +1138,99 @@ class One(ConversionMixin):
         # Return full list of file paths
         return files
 
+    def _local_paths(self, datasets):
+        """Return the local file path of each dataset.
+
+        The paths are built with vectorized string operations over the session_path and rel_path
+        columns.
+
+        Parameters
+        ----------
+        datasets : pandas.DataFrame
+            A datasets table with a session_path column.
+
+        Returns
+        -------
+        list of str
+            The absolute path of each dataset within the cache directory.
+        """
+        root = Path(self.cache_dir).as_posix().rstrip('/')
+        paths = root + '/' + datasets['session_path'].astype(str) + '/' + datasets['rel_path']
+        if self.uuid_filenames:
+            # Insert the dataset UUID before the extension, e.g. obj.attr.<uuid>.ext
+            ids = np.asarray(self._from_index(datasets.index.get_level_values(-1)), dtype=str)
+            parts = paths.str.rsplit('.', n=1)
+            paths = parts.str[0] + '.' + ids + '.' + parts.str[1]
+        return paths.tolist()
+
+    def _iter_filesystem(self, datasets, offline=None, include_missing=False, **kwargs):
+        """Yield the local file paths of datasets as soon as they are available.
+
+        Unlike One._check_filesystem, in online mode missing datasets are downloaded in a
+        background thread so that the caller may load the files that are present (or have already
+        downloaded) while the others are still downloading.
+
+        Parameters
+        ----------
+        datasets : pandas.Series, pandas.DataFrame, list of dicts
+            A list or DataFrame of dataset records.
+        offline : bool, None
+            If false and Web client present, downloads the missing datasets from a remote
+            repository.
+        include_missing : bool
+            If true, missing datasets are yielded with a None path as soon as they are known to be
+            missing: in offline mode before any other dataset, otherwise once the downloads
+            have finished.
+        **kwargs
+            Optional arguments to pass to One._check_filesystem.
+
+        Yields
+        ------
+        int
+            The position of the dataset in `datasets`.
+        pathlib.Path, None
+            The local file path of the dataset.  Missing datasets are only yielded if
+            include_missing is true.
+        """
+        if offline or self.offline:
+            files = self._check_filesystem(datasets, offline=offline, **kwargs)
+            if include_missing:
+                yield from ((i, None) for i, file in enumerate(files) if not file)
+            yield from ((i, file) for i, file in enumerate(files) if file)
+            return
+
+        available = queue.Queue()
+        done = object()  # Sentinel signalling the filesystem check has finished
+        result = {}
+
+        def check_filesystem():
+            try:
+                result['files'] = self._check_filesystem(
+                    datasets, offline=offline, callback=lambda *x: available.put(x), **kwargs)
+            except Exception as ex:
+                result['error'] = ex
+            finally:
+                available.put(done)
+
+        thread = threading.Thread(target=check_filesystem, daemon=True)
+        thread.start()
+        yielded = set()
+        try:
+            item = available.get()
+            while item is not done:
+                # A dataset may be reported twice if the HTTP download fallback is used
+                if item[0] not in yielded:
+                    yielded.add(item[0])
+                    yield item
+                item = available.get()
+            if 'error' in result:
+                raise result['error']
+            for i, file in enumerate(result['files']):
+                if (file or include_missing) and i not in yielded:
+                    yield i, file
+        finally:
+            thread.join()
+
     @util.refresh
     @util.parse_id
     def get_details(self, eid: Union[str, Path, UUID], full: bool = False):
@@ -686,16 +1251,16 @@ class One(ConversionMixin):
         """
         # Int ids return DataFrame, making str eid a list ensures Series not returned
         try:
-            det = self._cache['sessions'].loc[[eid]]
+            det = self._cache['sessions'].loc[[self._to_index(eid)]]
             assert len(det) == 1
         except KeyError:
             raise alferr.ALFObjectNotFound(eid)
         except AssertionError:
             raise alferr.ALFMultipleObjectsFound(f'Multiple sessions in cache for eid {eid}')
         if not full:
-            return det.iloc[0]
+            return util.cache_ids2str(det).iloc[0]
         # .reset_index('eid', drop=True)
-        return self._cache['datasets'].join(det, on='eid', how='right')
+        return util.cache_ids2str(self._cache['datasets'].join(det, on='eid', how='right'))
 
     @util.refresh
     def list_subjects(self) -> List[str]:
@@ -790,20 +1355,23 @@ class One(ConversionMixin):
         filter_args = dict(
             collection=collection, filename=filename, wildcards=self.wildcards, revision=revision,
             revision_last_before=False, assert_unique=False, qc=qc,
-            ignore_qc_not_set=ignore_qc_not_set)
+            ignore_qc_not_set=ignore_qc_not_set, index=self._index)
         if not eid:
             datasets = util.filter_datasets(datasets, **filter_args)
-            return datasets.copy() if details else datasets['rel_path'].unique().tolist()
+            if details:
+                return util.cache_ids2str(datasets.copy())
+            return datasets['rel_path'].unique().tolist()
         eid = self.to_eid(eid)  # Ensure we have a UUID str list
         if not eid:
             return datasets.iloc[0:0]  # Return empty
         try:
-            datasets = datasets.loc[(eid,), :]
+            datasets = datasets.loc[(self._to_index(eid),), :]
         except KeyError:
             return datasets.iloc[0:0]  # Return empty
 
         datasets = util.filter_datasets(datasets, **filter_args)
         if details:
+            datasets = util.cache_ids2str(datasets)
             if keep_eid_index and datasets.index.nlevels == 1:
                 # Reinstate eid index
                 datasets = pd.concat({str(eid): datasets}, names=['eid'])
@@ -875,9 +1443,8 @@ class One(ConversionMixin):
                              revision=revision, query_type=query_type)
         datasets = self.list_datasets(details=True, **filter_kwargs).copy()
 
-        datasets['collection'] = datasets.rel_path.apply(
-            lambda x: alfiles.rel_path_parts(x, assert_valid=False)[0] or ''
-        )
+        parts = self._decompose(datasets['rel_path'])
+        datasets['collection'] = parts['collection'].to_numpy(object)
         if details:
             return {k: table.drop('collection', axis=1)
                     for k, table in datasets.groupby('collection')}
@@ -938,11 +1505,11 @@ class One(ConversionMixin):
 
         # Call filter util ourselves with the revision_last_before set to False
         kwargs = dict(collection=collection, filename=filename, revision=revision,
-                      revision_last_before=False, wildcards=self.wildcards, assert_unique=False)
+                      revision_last_before=False, wildcards=self.wildcards, assert_unique=False,
+                      index=self._index)
         datasets = util.filter_datasets(datasets, **kwargs)
-        datasets['revision'] = datasets.rel_path.apply(
-            lambda x: (alfiles.rel_path_parts(x, assert_valid=False)[1] or '').strip('#')
-        )
+        parts = self._decompose(datasets['rel_path'])
+        datasets['revision'] = parts['revision'].to_numpy(object)
         if details:
             return {k: table.drop('revision', axis=1)
                     for k, table in datasets.groupby('revision')}
@@ -959,6 +1526,7 @@ class One(ConversionMixin):
                     query_type: Optional[str] = None,
                     download_only: bool = False,
                     check_hash: bool = True,
+                    mmap_mode: Optional[str] = None,
                     **kwargs) -> Union[alfio.AlfBunch, List[Path]]:
         """
         Load all attributes of an ALF object from a Session ID and an object name.
@@ -989,6 +1557,9 @@ class One(ConversionMixin):
         check_hash : bool
             Consider dataset missing if local file hash does not match. In online mode, the dataset
             will be re-downloaded.
+        mmap_mode : {None, 'r+', 'r', 'w+', 'c'}
+            If not None, npy datasets are memory-mapped using the given mode (see numpy.load)
+            instead of being read into memory.
         kwargs
             Additional filters for datasets, including namespace and timescale. For full list
             see the :func:`one.alf.spec.describe` function.
@@ -1020,7 +1591,8 @@ class One(ConversionMixin):
 
         dataset = {'object': obj, **kwargs}
         datasets = util.filter_datasets(datasets, dataset, collection, revision,
-                                        assert_unique=False, wildcards=self.wildcards)
+                                        assert_unique=False, wildcards=self.wildcards,
+                                        index=self._index)
 
         # Validate result before loading
         if len(datasets) == 0:
@@ -1035,15 +1607,22 @@ class One(ConversionMixin):
 
         # For those that don't exist, download them
         offline = None if query_type == 'auto' else self.mode == 'local'
-        files = self._check_filesystem(datasets, offline=offline, check_hash=check_hash)
-        files = [x for x in files if x]
+        if download_only:
+            files = self._check_filesystem(datasets, offline=offline, check_hash=check_hash)
+            files = [x for x in files if x]
+        else:
+            # Load the files as they become available while any others are downloading
+            files = self._iter_filesystem(datasets, offline=offline, check_hash=check_hash)
+            files = (file for _, file in files)
+            first = next(files, None)
+            files = [] if first is None else chain([first], files)
         if not files:
             raise alferr.ALFObjectNotFound(f'ALF object "{obj}" not found on disk')
 
         if download_only:
             return files
 
-        return alfio.load_object(files, wildcards=self.wildcards, **kwargs)
+        return alfio.load_object(files, wildcards=self.wildcards, mmap_mode=mmap_mode, **kwargs)
 
     @util.refresh
     @util.parse_id
@@ -1054,7 +1633,8 @@ class One(ConversionMixin):
                      revision: Optional[str] = None,
                      query_type: Optional[str] = None,
                      download_only: bool = False,
-                     check_hash: bool = True) -> Any:
+                     check_hash: bool = True,
+                     mmap_mode: Optional[str] = None) -> Any:
         """
         Load a single dataset for a given session id and dataset name.
 
@@ -1082,6 +1662,9 @@ class One(ConversionMixin):
         check_hash : bool
             Consider dataset missing if local file hash does not match. In online mode, the dataset
             will be re-downloaded.
+        mmap_mode : {None, 'r+', 'r', 'w+', 'c'}
+            If not None, npy datasets are memory-mapped using the given mode (see numpy.load)
+            instead of being read into memory.
 
         Returns
         -------
@@ -1103,6 +1686,11 @@ class One(ConversionMixin):
         ...                               collection='alf/probe01', revision='2020-08-31')
         >>> old_spikes = one.load_dataset(eid, 'alf/probe01/#2020-08-31#/spikes.times.npy')
 
+        Memory-map a large dataset, reading only the parts that are accessed
+
+        >>> spike_times = one.load_dataset(eid, 'spikes.times.npy', collection='alf/probe01',
+        ...                                mmap_mode='r')
+
         Raises
         ------
         ValueError
@@ -1137,7 +1725,8 @@ class One(ConversionMixin):
             raise ValueError(
                 'collection and revision kwargs must be None when dataset is a relative path')
         datasets = util.filter_datasets(datasets, dataset, collection, revision,
-                                        wildcards=self.wildcards, assert_unique=assert_unique)
+                                        wildcards=self.wildcards, assert_unique=assert_unique,
+                                        index=self._index)
         if len(datasets) == 0:
             raise alferr.ALFObjectNotFound(f'Dataset "{dataset}" not found')
 
@@ -1149,7 +1738,7 @@ class One(ConversionMixin):
             raise alferr.ALFObjectNotFound('Dataset not found')
         elif download_only:
             return file
-        return alfio.load_file_content(file)
+        return alfio.load_file_content(file, mmap_mode=mmap_mode)
 
     @util.refresh
     @util.parse_id
@@ -1161,7 +1750,8 @@ class One(ConversionMixin):
                       query_type: Optional[str] = None,
                       assert_present=True,
                       download_only: bool = False,
-                      check_hash: bool = True) -> Any:
+                      check_hash: bool = True,
+                      mmap_mode: Optional[str] = None) -> Any:
         """
         Load datasets for a given session id.
 
@@ -1195,6 +1785,9 @@ class One(ConversionMixin):
         check_hash : bool
             Consider dataset missing if local file hash does not match. In online mode, the dataset
             will be re-downloaded.
+        mmap_mode : {None, 'r+', 'r', 'w+', 'c'}
+            If not None, npy datasets are memory-mapped using the given mode (see numpy.load)
+            instead of being read into memory.
 
         Returns
         -------
@@ -1306,8 +1899,8 @@ class One(ConversionMixin):
 
         # If collections provided in datasets list, e.g. [collection/x.y.z], do not assert unique
         # If not a dataframe, use revision last before (we've asserted no revision in rel_path)
-        ops = dict(
-            wildcards=self.wildcards, assert_unique=True, revision_last_before=not is_rel_paths)
+        ops = dict(wildcards=self.wildcards, assert_unique=True,
+                   revision_last_before=not is_rel_paths, index=self._index)
         slices = [util.filter_datasets(all_datasets, x, y, z, **ops)
                   for x, y, z in zip(datasets, collections, revisions)]
         present = [len(x) == 1 for x in slices]
@@ -1338,7 +1931,27 @@ class One(ConversionMixin):
 
         # Check files exist / download remote files
         offline = None if query_type == 'auto' else self.mode == 'local'
-        files = self._check_filesystem(present_datasets, offline=offline, check_hash=check_hash)
+        if download_only:
+            files = self._check_filesystem(
+                present_datasets, offline=offline, check_hash=check_hash)
+        else:
+            # Load the files as they become available while any others are downloading
+            located = []  # The position and path of each file in the order they are loaded
+
+            def available_files():
+                for i, file in self._iter_filesystem(present_datasets, offline=offline,
+                                                     check_hash=check_hash,
+                                                     include_missing=assert_present):
+                    if file is None:  # Stop loading as soon as a dataset is known to be missing
+                        rel_path = present_datasets['rel_path'].iloc[i]
+                        raise alferr.ALFObjectNotFound(
+                            f'The following datasets were not downloaded: {rel_path}')
+                    located.append((i, file))
+                    yield file
+            loaded = alfio.load_file_contents(available_files(), mmap_mode=mmap_mode)
+            files, contents = [None] * len(present_datasets), [None] * len(present_datasets)
+            for (i, file), content in zip(located, loaded):
+                files[i], contents[i] = file, content
 
         if any(x is None for x in files):
             missing_list = ', '.join(x for x, y in zip(present_datasets.rel_path, files) if not y)
@@ -1359,7 +1972,7 @@ class One(ConversionMixin):
         records = [None if not here else records.pop(0) for here in present]
         if download_only:
             return files, records
-        return [alfio.load_file_content(x) for x in files], records
+        return [None if not here else contents.pop(0) for here in present], records
 
     @util.refresh
     def load_dataset_from_id(self,
@@ -1392,11 +2005,12 @@ class One(ConversionMixin):
         elif not isinstance(dset_id, str):
             dset_id, = parquet.np2str(dset_id)
         try:
-            dataset = self._cache['datasets'].loc[(slice(None), dset_id), :].squeeze()
+            dataset = self._cache['datasets'].loc[(slice(None), self._to_index(dset_id)), :]
+            dataset = util.cache_ids2str(dataset).squeeze()
             assert isinstance(dataset, pd.Series) or len(dataset) == 1
         except AssertionError:
             raise alferr.ALFMultipleObjectsFound('Duplicate dataset IDs')
-        except KeyError:
+        except (KeyError, ValueError):  # ValueError if not a valid UUID when int_ids is true
             raise alferr.ALFObjectNotFound('Dataset not found')
 
         filepath, = self._check_filesystem(dataset, check_hash=check_hash)
@@ -1418,6 +2032,7 @@ class One(ConversionMixin):
                         query_type: Optional[str] = None,
                         download_only: bool = False,
                         check_hash: bool = True,
+                        mmap_mode: Optional[str] = None,
                         **kwargs) -> Union[Bunch, List[Path]]:
         """
         Load all objects in an ALF collection from a Session ID.  Any datasets with matching object
@@ -1446,6 +2061,9 @@ class One(ConversionMixin):
         check_hash : bool
             Consider dataset missing if local file hash does not match. In online mode, the dataset
             will be re-downloaded.
+        mmap_mode : {None, 'r+', 'r', 'w+', 'c'}
+            If not None, npy datasets are memory-mapped using the given mode (see numpy.load)
+            instead of being read into memory.
         kwargs
             Additional filters for datasets, including namespace and timescale. For full list
             see the one.alf.spec.describe function.
@@ -1477,7 +2095,8 @@ class One(ConversionMixin):
 
         dataset = {'object': object, **kwargs}
         datasets = util.filter_datasets(datasets, dataset, revision,
-                                        assert_unique=False, wildcards=self.wildcards)
+                                        assert_unique=False, wildcards=self.wildcards,
+                                        index=self._index)
 
         # Validate result before loading
         if len(datasets) == 0:
@@ -1496,7 +2115,7 @@ class One(ConversionMixin):
             return files
 
         unique_objects = set(x[3] or '' for x in parts)
-        kwargs.update(wildcards=self.wildcards)
+        kwargs.update(wildcards=self.wildcards, mmap_mode=mmap_mode)
         collection = {
             obj: alfio.load_object([x for x, y in zip(files, parts) if y[3] == obj], **kwargs)
             for obj in unique_objects
@@ -1543,6 +2162,12 @@ class One(ConversionMixin):
         return One(cache_dir, mode='local')
 
 
+def _release_shared_memory(shm):
+    """Close and remove a block of shared memory (see One.share_cache)."""
+    shm.close()
+    shm.unlink()
+
+
 @lru_cache(maxsize=1)
 def ONE(*, mode='auto', wildcards=True, **kwargs):
     """ONE API factory.
@@ -1600,6 +2225,10 @@ def ONE(*, mode='auto', wildcards=True, **kwargs):
 
 class OneAlyx(One):
     """An API for searching and loading data through the Alyx database."""
+    incremental_sync = False
+    """bool: whether to update expired cache tables with the records modified since they were
+    created, instead of downloading the full tables."""
+
     def __init__(self, username=None, password=None, base_url=None, cache_dir=None,
                  mode='auto', wildcards=True, tables_dir=None, **kwargs):
         """An API for searching and loading data through the Alyx database.
@@ -1735,6 +2364,9 @@ class OneAlyx(One):
                 warnings.warn(
                     'Downloading cache tables from another origin '
                     f'("{origin}" instead of "{", ".join(prev_origin)}")')
+            elif self.incremental_sync and local_created and not different_tag:
+                if self._sync_cache(local_created, remote_created):
+                    return
 
             # Download the remote cache files
             _logger.info('Downloading remote caches...')
@@ -1758,6 +2390,58 @@ class OneAlyx(One):
                 'or run ONE.setup to update the default directory.'
             )
 
+    def _sync_cache(self, since, date_created):
+        """
+        Update the cache tables with the dataset records modified on Alyx since they were created.
+
+        The datasets modified since SYNC_MARGIN before the tables were created, and any of their
+        sessions missing from the sessions table, are merged into the cache tables.  The merged
+        rows are saved as modifications of the table files, along with the creation time of the
+        remote tables ('date_synced'), which is used as the creation time of the local tables
+        when next loaded.  NB: Datasets deleted from the database are not removed from the tables
+        until the full tables are next downloaded.
+
+        Parameters
+        ----------
+        since : datetime.datetime
+            The creation time of the local cache tables, in the time zone of the database.
+        date_created : datetime.datetime
+            The creation time of the remote cache tables.
+
+        Returns
+        -------
+        bool
+            True if the tables were updated; False if more than SYNC_MAX_RECORDS datasets were
+            modified, in which case the full tables should be downloaded instead.
+        """
+        # Allow for the time taken to generate the tables and the minute precision of their date
+        since = (since - SYNC_MARGIN).isoformat(timespec='seconds')
+        records = self.alyx.rest('datasets', 'list', django=f'auto_datetime__gte,{since}')
+        if len(records) > SYNC_MAX_RECORDS:
+            _logger.info(f'{len(records)} datasets modified; downloading remote caches')
+            return False
+        _logger.info(f'Synchronizing {len(records)} modified datasets...')
+        datasets = util.datasets2records(list(records))
+        # Fetch the records of new sessions
+        eids = datasets.index.unique('eid')
+        eids = eids[~pd.Index(self._to_index(eids)).isin(self._cache['sessions'].index)].tolist()
+        sessions = []
+        N = 100  # Number of UUIDs per query
+        for i in range(0, len(eids), N):
+            records = self.alyx.rest('sessions', 'list', django=f'id__in,{eids[i:i + N]}')
+            sessions.extend(util.ses2records(x)[0] for x in records)
+        sessions = pd.DataFrame(sessions).rename_axis('id') if sessions else None
+        self._update_cache_from_records(sessions=sessions, datasets=datasets)
+
+        # The tables are now as recent as the remote ones
+        meta = self._cache['_meta']
+        for table, metadata in meta['raw'].items():
+            metadata['date_synced'] = date_created.isoformat(sep=' ', timespec='minutes')
+            self._set_modified(table, [])  # Save the sync time even if no rows were modified
+        meta['created_time'], meta['expired'] = date_created, False
+        self._save_cache(save_dir=self._tables_dir)
+        return True
+
     @property
     def alyx(self):
         """one.webclient.AlyxClient: The Alyx Web client"""
@@ -2320,7 +3004,8 @@ class OneAlyx(One):
             _logger.debug(ex)
         return self._download_dataset(dsets, **kwargs)
 
-    def _download_aws(self, dsets, update_exists=True, keep_uuid=None, **_) -> List[Path]:
+    def _download_aws(self, dsets, update_exists=True, keep_uuid=None, callback=None,
+                      **_) -> List[Path]:
         """
         Download datasets from an AWS S3 instance using boto3.
 
@@ -2334,6 +3019,9 @@ class OneAlyx(One):
         keep_uuid : bool
             If false, the dataset UUID is removed from the downloaded filename. If None, the
             `uuid_filenames` attribute determined whether the UUID is kept (default is false).
+        callback : function, optional
+            A function called with the position of the dataset in `dsets` and its local file path
+            as soon as each dataset has downloaded.
 
         Returns
         -------
@@ -2361,15 +3049,17 @@ class OneAlyx(One):
             )
         remote_records = sorted(remote_records, key=lambda x: uuids.index(x['url'].split('/')[-1]))
         out_files = []
-        for dset, uuid, record in zip(dsets, uuids, remote_records):
+        for i, (dset, uuid, record) in enumerate(zip(dsets, uuids, remote_records)):
             # Fetch file record path
             record = next((x for x in record['file_records']
                            if x['data_repository'].startswith('aws') and x['exists']), None)
             if not record:
                 if update_exists and 'exists_aws' in self._cache['datasets']:
                     _logger.debug('Updating exists field')
-                    self._cache['datasets'].loc[(slice(None), uuid), 'exists_aws'] = False
-                    self._cache['_meta']['modified_time'] = datetime.now()
+                    self._ensure_writable('datasets')
+                    did = self._to_index(uuid)
+                    self._cache['datasets'].loc[(slice(None), did), 'exists_aws'] = False
+                    self._set_modified('datasets', [did])
                 out_files.append(None)
                 continue
             assert record['relative_path'].endswith(dset['rel_path']), \
@@ -2383,6 +3073,8 @@ class OneAlyx(One):
             local_path.parent.mkdir(exist_ok=True, parents=True)
             out_files.append(aws.s3_download_file(
                 source_path, local_path, s3=s3, bucket_name=bucket_name, overwrite=update_exists))
+            if callback and out_files[-1]:
+                callback(i, out_files[-1])
         return out_files
 
     def _dset2url(self, dset, update_cache=True):
@@ -2440,8 +3132,10 @@ class OneAlyx(One):
             _logger.debug('Updating cache')
             # NB: This will be considerably easier when IndexSlice supports Ellipsis
             idx = [slice(None)] * int(self._cache['datasets'].index.nlevels / 2)
-            self._cache['datasets'].loc[(*idx, *ensure_list(did)), 'exists'] = False
-            self._cache['_meta']['modified_time'] = datetime.now()
+            self._ensure_writable('datasets')
+            did = ensure_list(self._to_index(did))
+            self._cache['datasets'].loc[(*idx, *did), 'exists'] = False
+            self._set_modified('datasets', did)
 
         return url
 
@@ -2476,7 +3170,19 @@ class OneAlyx(One):
         valid_urls = list(filter(None, url))
         if not valid_urls:
             return [None] * len(url)
-
+        if kwargs.get('callback'):
+            # Map the valid URL indices back to the dataset positions
+            positions = [i for i, x in enumerate(url) if x]
+            callback = kwargs['callback']
+            kwargs['callback'] = lambda i, file: callback(positions[i], file)
+
+        if 'file_size' not in kwargs and 'file_size' in getattr(dset, 'columns', []):
+            # The expected file sizes are used to verify the downloads and set their timeouts
+            kwargs['file_size'] = [
+                int(x) if pd.notna(x) and x else None for x, u in zip(dset['file_size'], url) if u]
+        if 'hash' not in kwargs and 'hash' in getattr(dset, 'columns', []):
+            kwargs['hash'] = [
+                x if isinstance(x, str) else None for x, u in zip(dset['hash'], url) if u]
         target_dir = []
         for x in valid_urls:
             _path = urllib.parse.urlsplit(x, allow_fragments=False).path.strip('/')
@@ -2504,7 +3210,8 @@ class OneAlyx(One):
                     f'Failed to tag remote file record mismatch: {ex}\n'
                     'Please contact the database administrator.')
 
-    def _download_file(self, url, target_dir, keep_uuid=None, file_size=None, hash=None):
+    def _download_file(self, url, target_dir, keep_uuid=None, file_size=None, hash=None,
+                       callback=None):
         """
         Downloads a single file or multitude of files from an HTTP webserver.
         The webserver in question is set by the AlyxClient object.
@@ -2521,6 +3228,9 @@ class OneAlyx(One):
             The expected file size or list of file sizes to compare with downloaded file.
         hash : str, list
             The expected file hash or list of file hashes to compare with downloaded file.
+        callback : function, optional
+            A function called with the index of the URL and the final file path as soon as each
+            file has downloaded and been verified.  NB: This is called from the download thread.
 
         Returns
         -------
@@ -2536,25 +3246,51 @@ class OneAlyx(One):
         # Ensure all target directories exist
         [Path(x).mkdir(parents=True, exist_ok=True) for x in set(ensure_list(target_dir))]
 
-        # download file(s) from url(s), returns file path(s) with UUID
-        local_path, md5 = self.alyx.download_file(url, target_dir=target_dir, return_md5=True)
-
         # check if url, hash, and file_size are lists
         if isinstance(url, (tuple, list)):
             assert (file_size is None) or len(file_size) == len(url)
             assert (hash is None) or len(hash) == len(url)
-        for args in zip(*map(ensure_list, (file_size, md5, hash, local_path, url))):
+        keep_uuid = keep_uuid is True or (keep_uuid is None and self.uuid_filenames)
+
+        if callback and isinstance(url, (tuple, list)):
+            def nth(x, i):
+                return x[i] if isinstance(x, (tuple, list)) else x
+
+            def on_download(i, output):
+                """Verify and rename each file as soon as it downloads."""
+                path, md5 = output
+                self._check_hash_and_file_size_mismatch(
+                    nth(file_size, i), md5, nth(hash, i), path, url[i])
+                callback(i, path if keep_uuid else path.replace(alfiles.remove_uuid_string(path)))
+
+            local_path, _ = self.alyx.download_file(
+                url, target_dir=target_dir, return_md5=True, file_size=file_size, hash=hash,
+                callback=on_download)
+            return [x if keep_uuid else alfiles.remove_uuid_string(x) for x in local_path]
+
+        # download file(s) from url(s), returns file path(s) with UUID
+        local_path, md5 = self.alyx.download_file(
+            url, target_dir=target_dir, return_md5=True, file_size=file_size, hash=hash)
+
+        n = len(url) if isinstance(url, (tuple, list)) else 1
+        file_size, hash = ([None] * n if x is None else ensure_list(x) for x in (file_size, hash))
+        md5, local_paths, urls = map(ensure_list, (md5, local_path, url))
+        for args in zip(file_size, md5, hash, local_paths, urls):
             self._check_hash_and_file_size_mismatch(*args)
 
         # check if we are keeping the uuid on the list of file names
-        if keep_uuid is True or (keep_uuid is None and self.uuid_filenames):
+        if keep_uuid:
+            if callback:
+                callback(0, local_path)
             return local_path
 
         # remove uuids from list of file names
         if isinstance(local_path, (list, tuple)):
             return [x.replace(alfiles.remove_uuid_string(x)) for x in local_path]
-        else:
-            return local_path.replace(alfiles.remove_uuid_string(local_path))
+        local_path = local_path.replace(alfiles.remove_uuid_string(local_path))
+        if callback:
+            callback(0, local_path)
+        return local_path
 
     def _check_hash_and_file_size_mismatch(self, file_size, hash, expected_hash, local_path, url):
         """
@@ -2565,28 +3301,28 @@ class OneAlyx(One):
         file_size : int
             The expected file size to compare with downloaded file
         hash : str
+            The hash of the downloaded file, computed as it was written
+        expected_hash : str
             The expected file hash to compare with downloaded file
         local_path: str
             The path of the downloaded file
         url : str
             An absolute or relative URL for a remote dataset
         """
-        # verify hash size
-        hash = hash or hashfile.md5(local_path)
-        hash_mismatch = hash and hash != expected_hash
+        # verify hash; the file is only re-read if no hash was computed during download
+        if expected_hash and not hash:
+            hash = hashfile.md5(local_path)
+        hash_mismatch = expected_hash and expected_hash != hash
         # verify file size
         file_size_mismatch = file_size and Path(local_path).stat().st_size != file_size
         # check if there is a mismatch in hash or file_size
         if hash_mismatch or file_size_mismatch:
             # post download, if there is a mismatch between Alyx and the newly downloaded file size
             # or hash, flag the offending file record in Alyx for database for maintenance
-            hash_mismatch = expected_hash and expected_hash != hash
-            file_size_mismatch = file_size and Path(local_path).stat().st_size != file_size
-            if hash_mismatch or file_size_mismatch:
-                url = url or self.path2url(local_path)
-                _logger.debug(f'Tagging mismatch for {url}')
-                # tag the mismatched file records
-                self._tag_mismatched_file_record(url)
+            url = url or self.path2url(local_path)
+            _logger.debug(f'Tagging mismatch for {url}')
+            # tag the mismatched file records
+            self._tag_mismatched_file_record(url)
 
     @staticmethod
     def setup(base_url=None, **kwargs):
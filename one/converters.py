@@ -20,7 +20,7 @@ from iblutil.util import Bunch
 
 from one.alf.spec import is_session_path, is_uuid_string
 from one.alf.path import get_session_path, add_uuid_string, session_path_parts, get_alf_path
-from .util import Listable
+from .util import Listable, int2uuid, cache_ids2str
 
 
 def recurse(func):
@@ -98,12 +98,10 @@ class ConversionMixin:
                cache_dir: Optional[Union[str, Path]] = None) -> Listable(str):
         """Given any kind of experiment identifier, return a corresponding eid string.
 
-        NB: Currently does not support integer IDs.
-
         Parameters
         ----------
-        id : str, pathlib.Path, UUID, dict, tuple, list
-            An experiment identifier
+        id : str, pathlib.Path, UUID, int, dict, tuple, list
+            An experiment identifier; integers are 128-bit integer UUIDs (see One.int_ids)
         cache_dir : pathlib.Path, str
             An optional cache directory path for intermittent conversion to path
 
@@ -117,13 +115,12 @@ class ConversionMixin:
         ValueError
             Input ID invalid
         """
-        # TODO Could add np2str here
-        # if isinstance(id, (list, tuple)):  # Recurse
-        #     return [self.to_eid(i, cache_dir) for i in id]
         if id is None:
             return
         elif isinstance(id, UUID):
             return str(id)
+        elif isinstance(id, int):
+            return int2uuid(id)
         elif self.is_exp_ref(id):
             return self.ref2eid(id)
         elif isinstance(id, dict):
@@ -172,7 +169,7 @@ class ConversionMixin:
 
         # load path from cache
         try:
-            ses = self._cache['sessions'].loc[eid].squeeze()
+            ses = self._cache['sessions'].loc[self._to_index(eid)].squeeze()
             assert isinstance(ses, pd.Series), 'Duplicate eids in sessions table'
             return session_record2path(ses.to_dict(), self.cache_dir)
         except KeyError:
@@ -212,7 +209,7 @@ class ConversionMixin:
         assert len(sessions) == 1
 
         eid, = sessions.index.values
-        return eid
+        return self._from_index(eid)
 
     @recurse
     def path2record(self, path) -> pd.Series:
@@ -242,7 +239,7 @@ class ConversionMixin:
                 (df['number'] == int(number)) &
                 (df['date'] == datetime.date.fromisoformat(date))
             ]
-            return None if rec.empty else rec.squeeze()
+            return None if rec.empty else cache_ids2str(rec).squeeze()
 
         # Deal with dataset path
         if isinstance(path, str):
@@ -251,7 +248,8 @@ class ConversionMixin:
         name_parts = path.stem.split('.')
         if is_uuid_string(uuid := name_parts[-1]):
             try:
-                return self._cache['datasets'].loc[pd.IndexSlice[:, uuid], :].squeeze()
+                rec = self._cache['datasets'].loc[pd.IndexSlice[:, self._to_index(uuid)], :]
+                return cache_ids2str(rec).squeeze()
             except KeyError:
                 return
 
@@ -31,7 +31,8 @@ def default():
            'ALYX_LOGIN': 'intbrainlab',
            'HTTP_DATA_SERVER': 'https://ibl.flatironinstitute.org/public',
            'HTTP_DATA_SERVER_LOGIN': None,
-           'HTTP_DATA_SERVER_PWD': None}
+           'HTTP_DATA_SERVER_PWD': None,
+           'HTTP_DL_THREADS': None}
     return iopar.from_dict(par)
 
 
@@ -143,13 +144,22 @@ def setup(client=None, silent=False, make_default=None, username=None, cache_dir
             # Check whether user erroneously entered quotation marks
             # Prompting the user here (hopefully) corrects them before they input a password
             # where the use of quotation marks may be legitimate
-            if par[k] and len(par[k]) >= 2 and par[k][0] in quotes and par[k][-1] in quotes:
+            if isinstance(par[k], str) and len(par[k]) >= 2 and \
+                    par[k][0] in quotes and par[k][-1] in quotes:
                 warnings.warn('Do not use quotation marks with input answers', UserWarning)
                 ans = input('Strip quotation marks from response? [Y/n]:').strip() or 'y'
                 if ans.lower()[0] == 'y':
                     par[k] = par[k].strip(quotes)
             if k == 'ALYX_URL':
                 client = par[k]
+            elif k == 'HTTP_DL_THREADS' and isinstance(par[k], str) and par[k] != 'auto':
+                # The number of concurrent downloads is an int or 'auto' (see AlyxClient)
+                if par[k].isdigit() and int(par[k]) > 0:
+                    par[k] = int(par[k])
+                else:
+                    warnings.warn(f'{k} must be a positive integer or "auto"; '
+                                  f'keeping current value ({cpar})', UserWarning)
+                    par[k] = cpar
 
         cpar = _get_current_par('HTTP_DATA_SERVER_PWD', par_current)
         prompt = f'Enter the FlatIron HTTP password for {par["HTTP_DATA_SERVER_LOGIN"]} '\
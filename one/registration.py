@@ -22,7 +22,6 @@ import shutil
 
 import requests.exceptions
 
-from iblutil.io import hashfile
 from iblutil.util import Bunch, ensure_list
 
 import one.alf.io as alfio
@@ -551,9 +550,12 @@ class RegistrationClient:
             file_sizes = [session_path.joinpath(fn).stat().st_size for fn in files]
             # computing the md5 can be very long, so this is an option to skip if the file is
             # bigger than a certain threshold
-            md5s = [hashfile.md5(session_path.joinpath(fn))
-                    if (max_md5_size is None or sz < max_md5_size) else None
-                    for fn, sz in zip(files, file_sizes)]
+            to_hash = [i for i, sz in enumerate(file_sizes)
+                       if max_md5_size is None or sz < max_md5_size]
+            md5s = [None] * len(files)
+            hashes = alfio.md5_files([session_path.joinpath(files[i]) for i in to_hash])
+            for i, md5 in zip(to_hash, hashes):
+                md5s[i] = md5
 
             _logger.info('Registering ' + str(files))
 
@@ -6,6 +6,9 @@ import tempfile
 from pathlib import Path
 import shutil
 import json
+import os
+import threading
+import time
 import uuid
 import yaml
 
@@ -13,7 +16,7 @@ import numpy as np
 import numpy.testing
 import pandas as pd
 
-from iblutil.io import jsonable
+from iblutil.io import jsonable, hashfile
 
 import one.alf.io as alfio
 from one.alf.exceptions import ALFObjectNotFound
@@ -290,6 +293,60 @@ class TestsAlf(unittest.TestCase):
         # globing with list: an empty part should return true as well
         self.assertTrue(alfio.exists(self.tmpdir, 'object', extra=['']))
 
+    def test_file_sizes(self):
+        """Test for one.alf.io.file_sizes"""
+        files = [self.object_files[0], str(self.object_files[-1]),
+                 self.tmpdir / 'foo.bar.npy',  # missing file
+                 self.tmpdir / 'missing' / 'foo.bar.npy',  # missing folder
+                 self.tmpdir]  # not a file
+        sizes = alfio.file_sizes(files)
+        self.assertIsInstance(sizes, np.ndarray)
+        expected = [Path(files[0]).stat().st_size, Path(files[1]).stat().st_size, -1, -1, -1]
+        np.testing.assert_array_equal(sizes, expected)
+        # Each folder should be listed only once
+        with unittest.mock.patch('one.alf.io.os.scandir', wraps=os.scandir) as scandir:
+            alfio.file_sizes(self.object_files)
+            scandir.assert_called_once()
+        self.assertEqual(0, alfio.file_sizes([]).size)
+
+    def test_map_threads(self):
+        """Test for one.alf.io.map_threads"""
+        def func(x):
+            time.sleep(.01 * (3 - x))  # later items finish first
+            if x < 0:
+                raise ValueError(x)
+            return x * 2
+        self.assertEqual([0, 2, 4], alfio.map_threads(func, range(3), n_threads=3))
+        self.assertEqual([0, 2, 4], alfio.map_threads(func, [0, 1, 2], n_threads=1))
+        self.assertEqual([], alfio.map_threads(func, []))
+        # The first exception in input order should be raised
+        with self.assertRaises(ValueError) as ex:
+            alfio.map_threads(func, [0, -1, -2], n_threads=3)
+        self.assertEqual(-1, ex.exception.args[0])
+
+    def test_md5_files(self):
+        """Test for one.alf.io.md5_files"""
+        expected = [hashfile.md5(f) for f in self.object_files]
+        self.assertEqual(expected, alfio.md5_files(self.object_files, n_threads=1))
+        # Check that the total size of the files hashed at once never exceeds the budget
+        max_bytes = max(f.stat().st_size for f in self.object_files) + 1
+        in_flight, peak, lock = [], [0], threading.Lock()
+
+        def md5(file):
+            with lock:
+                in_flight.append(file.stat().st_size)
+                peak[0] = max(peak[0], sum(in_flight))
+            time.sleep(.01)
+            with lock:
+                in_flight.remove(file.stat().st_size)
+            return hashfile.md5(file)
+
+        hashes = alfio.md5_files(self.object_files, n_threads=4,
+                                 max_bytes=max_bytes, hash_func=md5)
+        self.assertEqual(expected, hashes)
+        self.assertLessEqual(peak[0], max_bytes)
+        self.assertEqual([], alfio.md5_files([]))
+
     def test_metadata_columns(self):
         # simple test with meta data to label columns
         file_alf = self.tmpdir / '_ns_object.attribute.npy'
@@ -357,6 +414,22 @@ class TestsAlf(unittest.TestCase):
         obj = alfio.load_object(self.tmpdir, 'neuveu')
         self.assertTrue(obj.keys() == expected_keys)
         self.assertTrue(all([obj[o].shape == (5,) for o in obj]))
+        # Check serial loading
+        obj = alfio.load_object(self.tmpdir, 'neuveu', n_threads=1)
+        self.assertTrue(obj.keys() == expected_keys)
+        # Check loading from an iterator, e.g. files yielded as they download
+        files = [x for x in self.object_files if x.name.startswith('neuveu')]
+        obj = alfio.load_object(iter(reversed(files)))
+        self.assertTrue(obj.keys() == expected_keys)
+        expected = alfio.load_object(sorted(files, key=str))
+        self.assertEqual(list(expected.keys()), list(obj.keys()))
+        # Check memory-mapped loading
+        obj = alfio.load_object(self.tmpdir, 'neuveu', mmap_mode='r')
+        self.assertTrue(obj.keys() == expected_keys)
+        self.assertIsInstance(obj['riri'], np.memmap)
+        self.assertIsInstance(obj['foobar_matlab'], np.memmap)
+        self.assertTrue(all([obj[o].shape == (5,) for o in obj]))
+        del obj
         # providing directory without object will return all ALF files
         with self.assertRaises(ValueError) as context:
             alfio.load_object(self.tmpdir)
@@ -562,6 +635,56 @@ class TestsLoadFile(unittest.TestCase):
         self.assertIsInstance(loaded, np.lib.npyio.NpzFile, 'failed to return npz array')
         self.assertEqual(loaded['arr_0'].shape, (5,))
 
+    def test_load_file_contents(self):
+        """Test for one.alf.io.load_file_contents"""
+        files = [self.npy, None, self.json1, self.empty, self.yaml]
+        for n_threads in (1, 4):
+            with self.subTest(n_threads=n_threads):
+                loaded = alfio.load_file_contents(files, n_threads=n_threads)
+                self.assertEqual(len(files), len(loaded))
+                np.testing.assert_array_equal(np.load(self.npy), loaded[0])
+                self.assertIsNone(loaded[1])
+                self.assertCountEqual(loaded[2].keys(), ['a', 'b'])
+                self.assertIsNone(loaded[3])
+                self.assertCountEqual(loaded[4].keys(), ['a', 'b'])
+                # Errors should be propagated
+                with self.assertRaises(FileNotFoundError):
+                    alfio.load_file_contents(files + ['foo.bar.npy'], n_threads=n_threads)
+        self.assertEqual([], alfio.load_file_contents([]))
+        # Check loading from a generator
+        loaded = alfio.load_file_contents(x for x in files[:3])
+        self.assertEqual(3, len(loaded))
+        np.testing.assert_array_equal(np.load(self.npy), loaded[0])
+        self.assertIsNone(loaded[1])
+        self.assertCountEqual(loaded[2].keys(), ['a', 'b'])
+
+        # Errors raised by the generator should be propagated
+        def files_until_error():
+            yield self.npy
+            raise RuntimeError
+        with self.assertRaises(RuntimeError):
+            alfio.load_file_contents(files_until_error())
+        loaded, = alfio.load_file_contents([self.npy], mmap_mode='r')
+        self.assertIsInstance(loaded, np.memmap)
+        del loaded
+
+    def test_load_file_content_mmap(self):
+        """Test for one.alf.io.load_file_content with mmap_mode"""
+        loaded = alfio.load_file_content(self.npy, mmap_mode='r')
+        self.assertIsInstance(loaded, np.memmap)
+        np.testing.assert_array_equal(loaded, np.load(self.npy))
+        # Single column arrays should be flattened without reading into memory
+        np.save(self.npy, np.random.rand(5, 1))
+        loaded = alfio.load_file_content(self.npy, mmap_mode='r')
+        self.assertIsInstance(loaded, np.memmap)
+        self.assertEqual((5,), loaded.shape)
+        # Arrays of Python objects can't be memory-mapped and should be read into memory
+        np.save(self.npy, np.array([{'a': 1}, None]), allow_pickle=True)
+        loaded = alfio.load_file_content(self.npy, mmap_mode='r')
+        self.assertNotIsInstance(loaded, np.memmap)
+        self.assertEqual({'a': 1}, loaded[0])
+        del loaded
+
     def tearDown(self) -> None:
         self.tmpdir.cleanup()
 
@@ -697,6 +820,27 @@ class TestALFFolders(unittest.TestCase):
         self.assertEqual(self.session_path, next(valid_sessions))
         valid_sessions = alfio.iter_sessions(subjects_path, pattern='*/Subjects/*/????-??-??/*')
         self.assertFalse(next(valid_sessions, False))
+        # Folders that can not match the pattern should not be scanned
+        other = Path(self.tempdir.name, 'fakelab', 'other', 'subject')
+        other.mkdir(parents=True)
+        pattern = '*/Subjects/*/????-??-??/*'
+        with unittest.mock.patch('one.alf.io._scan_folder', wraps=alfio._scan_folder) as scan:
+            self.assertEqual([self.session_path],
+                             list(alfio.iter_sessions(self.tempdir.name, pattern, n_threads=2)))
+            scanned = [Path(x.args[0]) for x in scan.call_args_list]
+            self.assertIn(self.session_path.parent, scanned)
+            self.assertNotIn(self.session_path, scanned)
+            self.assertNotIn(other.parent, scanned)
+        # Sessions within session folders should be found
+        nested = self.session_path.joinpath('nested', '2021-01-01', '001')
+        nested.mkdir(parents=True)
+        self.assertEqual([self.session_path, nested],
+                         list(alfio.iter_sessions(self.tempdir.name, n_threads=2)))
+        self.assertEqual([self.session_path, nested],
+                         list(alfio.iter_sessions(self.session_path)))
+        self.assertEqual([self.session_path],
+                         list(alfio.iter_sessions(self.tempdir.name, pattern)))
+        self.assertEqual([nested], list(alfio.iter_sessions(self.tempdir.name, '**/nested/*/*')))
 
     def test_iter_datasets(self):
         """Test for one.alf.io.iter_datasets."""
@@ -4,13 +4,19 @@ import tempfile
 from pathlib import Path
 import shutil
 import datetime
+import itertools
+import json
+import uuid
+from unittest import mock
 
 import pandas as pd
 from pandas.testing import assert_frame_equal
 
-from iblutil.io import parquet
+from iblutil.io import parquet, hashfile
 import one.alf.cache as apt
+from one.alf.path import rel_path_parts
 from one.tests.util import revisions_datasets_table
+from one.util import filter_datasets, QC_TYPE
 
 
 class TestsONEParquet(unittest.TestCase):
@@ -70,6 +76,50 @@ class TestsONEParquet(unittest.TestCase):
         assert_frame_equal(df, df2)
         self.assertTrue(metadata == metadata2)
 
+    def test_load_table(self):
+        """Test load_table function"""
+        df = pd.DataFrame({'eid': ['e1', 'e2'], 'id': ['d1', 'd2'], 'hash': ['h1', 'h2'],
+                           'file_size': [1, 2]}).set_index(['eid', 'id'])
+        metadata = apt._metadata('dbname')
+        filename = self.tmpdir.resolve() / 'datasets.pqt'
+        parquet.save(filename, df, metadata=metadata)
+        df2, metadata2 = apt.load_table(filename, exclude=['hash', 'id'])
+        assert_frame_equal(df.drop('hash', axis=1), df2)
+        self.assertEqual(metadata, metadata2)
+        df2, _ = apt.load_table(filename, columns=['hash', 'foo'])
+        assert_frame_equal(df[['hash']], df2)
+        # Tables saved without an index
+        parquet.save(filename, df.reset_index(), metadata=metadata)
+        df2, _ = apt.load_table(filename, columns=['file_size'])
+        assert_frame_equal(df.reset_index()[['eid', 'id', 'file_size']], df2)
+        # Check table revision read from metadata
+        self.assertEqual(metadata['date_created'], apt.table_revision(filename))
+        parquet.save(filename, df, metadata={**metadata, 'revision': 'abc'})
+        self.assertEqual('abc', apt.table_revision(filename))
+        self.assertIsNone(apt.table_revision(filename.with_name('foo.pqt')))
+
+    def test_snapshot(self):
+        """Test snapshot_key, save_snapshot and load_snapshot functions"""
+        df = pd.DataFrame({'id': ['d1', 'd2'], 'file_size': [1, 2]}).set_index('id')
+        parquet.save(self.tmpdir / 'datasets.pqt', df, metadata=apt._metadata('dbname'))
+        key = apt.snapshot_key(self.tmpdir, '1.0.0')
+        self.assertNotEqual(key, apt.snapshot_key(self.tmpdir, '2.0.0'))
+        self.assertEqual((None, None), apt.load_snapshot(self.tmpdir, key))
+        file = apt.save_snapshot(self.tmpdir, key, {'datasets': df}, {'foo': 'bar'})
+        self.assertEqual(self.tmpdir / apt.SNAPSHOT_FILENAME, file)
+        tables, metadata = apt.load_snapshot(self.tmpdir, key)
+        assert_frame_equal(df, tables['datasets'])
+        self.assertEqual({'foo': 'bar'}, metadata)
+        # Modifying a table file should change the key
+        apt.save_delta(self.tmpdir, 'datasets', df.iloc[:1], 'revision')
+        key2 = apt.snapshot_key(self.tmpdir, '1.0.0')
+        self.assertNotEqual(key, key2)
+        self.assertEqual((None, None), apt.load_snapshot(self.tmpdir, key2))
+        # Failure to save should be ignored
+        with mock.patch('one.alf.cache.os.replace', side_effect=PermissionError):
+            self.assertIsNone(apt.save_snapshot(self.tmpdir, key2, {'datasets': df}))
+        self.assertEqual([file], list(self.tmpdir.glob(f'{apt.SNAPSHOT_FILENAME}*')))
+
     def test_sessions_df(self):
         df = apt._make_sessions_df(self.tmpdir)
         print('Sessions dataframe')
@@ -126,6 +176,77 @@ class TestsONEParquet(unittest.TestCase):
         # Check ID fields in both dataframes
         self.assertTrue(ses.index.nlevels == 1 and ses.index.name == 'id')
         self.assertTrue(dsets.index.nlevels == 2 and tuple(dsets.index.names) == ('eid', 'id'))
+        # IDs should be the same each time for a given origin
+        (ses2, _), (dsets2, _) = map(parquet.load, apt.make_parquet_db(self.tmpdir, hash_ids=True))
+        assert_frame_equal(ses, ses2)
+        assert_frame_equal(dsets, dsets2)
+        fn_ses, _ = apt.make_parquet_db(self.tmpdir, hash_ids=True, origin='foo')
+        ses3, metadata = parquet.load(fn_ses)
+        self.assertEqual('foo', metadata['origin'])
+        self.assertFalse(ses3.index.isin(ses.index).any())
+        expected = uuid.uuid3(uuid.uuid3(uuid.NAMESPACE_URL, 'foo'), self.ses_info['id'])
+        self.assertIn(str(expected), ses3.index)
+
+    def test_uuid3(self):
+        """Test the vectorized uuid3 function"""
+        ns = uuid.uuid1()
+        names = ['mylab/mysub/2021-02-28/001', 'alf/spikes.times.npy', 'ünïcode']
+        expected = [str(uuid.uuid3(ns, x)) for x in names]
+        self.assertEqual(expected, apt._uuid3(names, ns).tolist())
+        self.assertEqual(0, apt._uuid3([], ns).size)
+
+    def test_incremental(self):
+        """Test make_parquet_db with incremental=True"""
+        (ses, _), (dsets, _) = map(parquet.load, apt.make_parquet_db(self.tmpdir, hash_files=True))
+        self.assertTrue(self.tmpdir.joinpath(apt.MANIFEST_FILENAME).exists())
+        # With no changes, no files should be re-indexed
+        with mock.patch('one.alf.cache._get_dataset_info') as get_info, \
+                mock.patch('one.alf.cache.md5') as md5:
+            fn_ses, fn_dsets = apt.make_parquet_db(
+                self.tmpdir, hash_files=True, incremental=True)
+            get_info.assert_not_called()
+            md5.assert_not_called()
+        assert_frame_equal(ses, parquet.load(fn_ses)[0])
+        assert_frame_equal(dsets, parquet.load(fn_dsets)[0])
+
+        # Add a dataset to one session and a new session
+        self.full_ses_path.joinpath('alf', 'spikes.amps.npy').write_text('mock3')
+        new_session = self.full_ses_path.parent.joinpath('003')
+        new_session.joinpath('alf').mkdir(parents=True)
+        new_session.joinpath('alf', 'trials.table.pqt').touch()
+        with mock.patch('one.alf.cache.md5', side_effect=hashfile.md5) as md5:
+            (ses2, _), (dsets2, _) = map(parquet.load, apt.make_parquet_db(
+                self.tmpdir, hash_files=True, incremental=True))
+            # Only the new files should be hashed
+            self.assertEqual(2, md5.call_count)
+        self.assertEqual(len(ses) + 1, len(ses2))
+        self.assertEqual(len(dsets) + 2, len(dsets2))
+        # The IDs of existing sessions and datasets should be unchanged
+        assert_frame_equal(ses, ses2.loc[ses.index])
+        assert_frame_equal(dsets, dsets2.loc[dsets.index])
+        self.assertFalse(dsets2['hash'].isna().any())
+
+        # Remove a session
+        shutil.rmtree(new_session)
+        (ses3, _), (dsets3, _) = map(parquet.load, apt.make_parquet_db(
+            self.tmpdir, hash_files=True, incremental=True))
+        assert_frame_equal(ses, ses3)
+        self.assertEqual(len(dsets) + 1, len(dsets3))
+
+    def test_incremental_hash_files(self):
+        """Test make_parquet_db with incremental=True and a different hash_files option"""
+        (ses, _), (dsets, _) = map(parquet.load, apt.make_parquet_db(self.tmpdir))
+        self.assertTrue(dsets['hash'].isna().all())
+        # All sessions should be re-indexed and hashed, keeping their IDs
+        (ses2, _), (dsets2, _) = map(parquet.load, apt.make_parquet_db(
+            self.tmpdir, hash_files=True, incremental=True))
+        self.assertFalse(dsets2['hash'].isna().any())
+        assert_frame_equal(ses, ses2)
+        assert_frame_equal(dsets.drop(columns='hash'), dsets2.drop(columns='hash'))
+        # With hashing unchanged, no files should be re-indexed
+        with mock.patch('one.alf.cache._get_dataset_info') as get_info:
+            apt.make_parquet_db(self.tmpdir, hash_files=True, incremental=True)
+            get_info.assert_not_called()
 
     def test_remove_missing_datasets(self):
         # Add a session that will only contains missing datasets
@@ -173,5 +294,167 @@ class TestsONEParquet(unittest.TestCase):
         shutil.rmtree(self.tmpdir)
 
 
+class TestDatasetIndex(unittest.TestCase):
+    """Tests for the DatasetIndex class"""
+
+    def setUp(self) -> None:
+        fixture = Path(__file__).parents[1].joinpath('fixtures', 'datasets.pqt')
+        self.datasets, _ = parquet.load(fixture)
+        self.datasets['qc'] = pd.Categorical(['NOT_SET'] * len(self.datasets), dtype=QC_TYPE)
+        self.datasets = pd.concat([self.datasets, revisions_datasets_table()])
+        self.index = apt.DatasetIndex(self.datasets['rel_path'])
+
+    def test_update(self):
+        """Test DatasetIndex.update method"""
+        n = self.datasets['rel_path'].nunique()
+        self.assertEqual(n, len(self.index))
+        self.assertIn(self.datasets['rel_path'].iloc[0], self.index)
+        self.assertEqual(0, self.index.update(self.datasets['rel_path']))
+        self.assertEqual(1, self.index.update(['alf/foo.bar.npy', 'alf/foo.bar.npy']))
+        self.assertEqual(n + 1, len(self.index))
+
+    def test_match(self):
+        """Test DatasetIndex.match returns the same result as filter_datasets without an index"""
+        collections = (None, '', 'alf', 'alf/probe00', 'alf*', 'raw_.*_data', ['alf', ''])
+        filenames = (
+            None, 'spikes.times.npy', '_ibl_trials.*', '.*intervals.*', dict(object='trials'),
+            dict(object='ibl_trials'), dict(namespace='ibl', object='trials'),
+            dict(object='spikes', attribute=['times', 'clusters']), dict(extension='npy'),
+            dict(attribute='times', timescale='bpod'), dict(namespace='[a-z]*', object='spikes'),
+            dict(object='[a-z]*spikes', attribute='times'), ['spikes.times.npy', '_ibl_wheel.*']
+        )
+        for collection, filename, wildcards in itertools.product(
+                collections, filenames, (True, False)):
+            kwargs = dict(collection=collection, filename=filename, wildcards=wildcards,
+                          revision='2020-01-08', revision_last_before=False, assert_unique=False)
+            with self.subTest(**kwargs):
+                expected = filter_datasets(self.datasets, **kwargs)
+                kwargs['revision'] = None
+                expected_all = filter_datasets(self.datasets, **kwargs)
+                kwargs['revision'] = '2020-01-08'
+                for _ in range(2):  # Second call uses memoized result
+                    actual = filter_datasets(self.datasets, index=self.index, **kwargs)
+                    assert_frame_equal(expected, actual)
+                kwargs['revision'] = None
+                actual = filter_datasets(self.datasets, index=self.index, **kwargs)
+                assert_frame_equal(expected_all, actual)
+
+        # Paths missing from the index should be matched directly
+        datasets = self.datasets.copy()
+        datasets.iloc[0, datasets.columns.get_loc('rel_path')] = 'alf/_ibl_trials.foo.npy'
+        self.assertNotIn('alf/_ibl_trials.foo.npy', self.index)
+        kwargs = dict(collection='alf', filename='_ibl_trials.*',
+                      revision_last_before=False, assert_unique=False)
+        expected = filter_datasets(datasets, **kwargs)
+        self.assertIn('alf/_ibl_trials.foo.npy', expected['rel_path'].values)
+        assert_frame_equal(expected, filter_datasets(datasets, index=self.index, **kwargs))
+
+    def test_decompose(self):
+        """Test DatasetIndex.decompose method"""
+        rel_paths = pd.concat([self.datasets['rel_path'], pd.Series(['foo/bar.npy'])])
+        parts = self.index.decompose(rel_paths)
+        self.assertEqual(self.index.fields, tuple(parts.columns))
+        self.assertTrue(all(isinstance(x, pd.CategoricalDtype) for x in parts.dtypes))
+        self.assertTrue(parts.index.equals(rel_paths.index))
+        expected = [tuple(x or '' for x in rel_path_parts(p, assert_valid=False))
+                    for p in rel_paths]
+        self.assertEqual(expected, list(parts.astype(object).itertuples(index=False, name=None)))
+        # Invalid path parts should be empty strings
+        self.assertEqual({''}, set(parts.iloc[-1]))
+        # Check empty input
+        parts = self.index.decompose(pd.Series([], dtype=object))
+        self.assertEqual((0, len(self.index.fields)), parts.shape)
+
+    def test_contains(self):
+        """Test DatasetIndex.contains method"""
+        rel_paths = self.datasets['rel_path']
+        for pattern, regex in itertools.product(
+                ('spikes.times', 'trials', '^alf/.*\\.npy$', '#', 'foo'), (True, False)):
+            with self.subTest(pattern=pattern, regex=regex):
+                expected = rel_paths.str.contains(pattern, regex=regex)
+                pd.testing.assert_series_equal(
+                    expected, self.index.contains(rel_paths, pattern, regex=regex))
+        # Paths missing from the index should be tested directly
+        rel_paths = pd.Series(['alf/foo.bar.npy', 'alf/spikes.times.npy'])
+        pd.testing.assert_series_equal(
+            pd.Series([True, False]), self.index.contains(rel_paths, 'foo'))
+
+
+class TestFileHashCache(unittest.TestCase):
+    """Tests for the FileHashCache class"""
+
+    def setUp(self) -> None:
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmpdir = Path(tmp.name)
+        self.file = self.tmpdir / 'obj.attr.npy'
+        self.file.write_bytes(b'foo')
+
+    def test_md5(self):
+        """Test FileHashCache.md5 method"""
+        hashes = apt.FileHashCache(self.tmpdir / apt.FileHashCache.filename)
+        expected = hashfile.md5(self.file)
+        with mock.patch('one.alf.cache.md5', side_effect=hashfile.md5) as md5:
+            self.assertEqual(expected, hashes.md5(self.file))
+            self.assertEqual(expected, hashes.md5(str(self.file)))
+            md5.assert_called_once()
+            # A modified file should be re-hashed
+            self.file.write_bytes(b'bar')
+            self.assertEqual(hashfile.md5(self.file), hashes.md5(self.file))
+            self.assertEqual(2, md5.call_count)
+
+    def test_md5_files(self):
+        """Test FileHashCache.md5_files method"""
+        hashes = apt.FileHashCache()
+        files = [self.file, self.tmpdir / 'obj.foo.npy', self.tmpdir / 'obj.bar.npy']
+        for i, file in enumerate(files[1:]):
+            file.write_bytes(bytes(i))
+        hashes.md5(self.file)
+        with mock.patch('one.alf.cache.md5', side_effect=hashfile.md5) as md5:
+            self.assertEqual(list(map(hashfile.md5, files)), hashes.md5_files(files, n_threads=2))
+            # Only the files not already hashed should be read
+            self.assertCountEqual(files[1:], [x.args[0] for x in md5.call_args_list])
+
+    def test_save(self):
+        """Test FileHashCache.save method"""
+        hashes = apt.FileHashCache(self.tmpdir / apt.FileHashCache.filename)
+        hashes.save()  # Nothing to save
+        self.assertFalse(hashes.path.exists())
+        expected = hashes.md5(self.file)
+        hashes.save()
+        self.assertTrue(hashes.path.exists())
+        # Hashes should be loaded from disk
+        hashes = apt.FileHashCache(hashes.path)
+        with mock.patch('one.alf.cache.md5') as md5:
+            self.assertEqual(expected, hashes.md5(self.file))
+            md5.assert_not_called()
+        # Hashes saved concurrently by another instance should be merged
+        other = apt.FileHashCache(hashes.path)
+        other._load()  # Loaded before the first instance saves
+        new_file = self.tmpdir / 'obj.foo.npy'
+        new_file.write_bytes(b'bar')
+        hashes.md5(new_file)
+        hashes.save()
+        another_file = self.tmpdir / 'obj.bar.npy'
+        another_file.write_bytes(b'baz')
+        other.md5(another_file)
+        other.save()
+        saved = json.loads(hashes.path.read_text())
+        self.assertCountEqual(map(str, (self.file, new_file, another_file)), saved)
+        # Files that no longer exist should be removed
+        new_file.unlink()
+        other.md5(self.file.rename(self.tmpdir / 'obj.attr.2.npy'))
+        other.save()
+        saved = json.loads(hashes.path.read_text())
+        self.assertCountEqual(map(str, (self.tmpdir / 'obj.attr.2.npy', another_file)), saved)
+        self.assertFalse(hashes.path.with_name(hashes.path.name + '.lock').exists())
+        self.file.write_bytes(b'foo')
+        # Without a path the hashes are not persisted
+        hashes = apt.FileHashCache()
+        hashes.md5(self.file)
+        hashes.save()
+        self.assertEqual(1, len(list(self.tmpdir.glob('.*'))))
+
+
 if __name__ == '__main__':
     unittest.main(exit=False)
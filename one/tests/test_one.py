@@ -27,16 +27,21 @@ Note ONE and AlyxClient use caching:
 
 """
 import datetime
+import gc
 import logging
+import os
 import time
+import threading
 from pathlib import Path
 from itertools import permutations, combinations_with_replacement
 from functools import partial
 import unittest
 from unittest import mock
 import tempfile
+import shutil
 from uuid import UUID, uuid4
 import io
+from multiprocessing import shared_memory
 
 import numpy as np
 import pandas as pd
@@ -45,10 +50,13 @@ from iblutil.io import parquet
 from iblutil.util import Bunch
 
 from one import __version__
-from one.api import ONE, One, OneAlyx
+from one.api import ONE, One, OneAlyx, SYNC_MARGIN
+from one.alf.cache import (
+    delta_files, load_table, share_tables, attach_tables, SNAPSHOT_FILENAME)
 from one.util import (
     ses2records, validate_date_range, index_last_before, filter_datasets, _collection_spec,
-    filter_revision_last_before, parse_id, autocomplete, LazyId, datasets2records, ensure_list
+    filter_revision_last_before, parse_id, autocomplete, LazyId, datasets2records, ensure_list,
+    file_lock, uuid_int2str, cache_int2str, cache_ids2str
 )
 import one.params
 import one.alf.exceptions as alferr
@@ -141,6 +149,8 @@ class TestONECache(unittest.TestCase):
             'cf264653-2deb-44cb-aa84-89b82507028a'
         ]
         self.assertEqual(eids, expected)
+        # All datasets must be present in a session
+        self.assertEqual([], one.search(dataset=[query, 'foo.bar']))
 
         # Search QC + dataset
         query = ['spikes.depths', 'spikes.times']
@@ -539,6 +549,12 @@ class TestONECache(unittest.TestCase):
         datasets = self.one._cache['datasets'].loc[eids]
         files = self.one._check_filesystem(datasets)
         self.assertEqual(53, len(files))
+        # File hashes should be saved and unchanged files not re-hashed
+        self.assertTrue(self.one._file_hashes.path.exists())
+        self.assertEqual(self.one._tables_dir, self.one._file_hashes.path.parent)
+        with mock.patch('one.alf.cache.md5') as md5:
+            self.assertEqual(files, self.one._check_filesystem(datasets))
+            md5.assert_not_called()
 
         # Expect same number of unique session paths as eids
         session_paths = set(map(lambda p: p.parents[1], files))
@@ -581,6 +597,48 @@ class TestONECache(unittest.TestCase):
         finally:
             self.one.uuid_filenames = False
 
+    def test_iter_filesystem(self):
+        """Test for One._iter_filesystem and the One._check_filesystem callback."""
+        eid = self.one._cache['datasets'].index.get_level_values(0)[0]
+        datasets = self.one._cache['datasets'].loc[[eid]].iloc[:5]
+        paths = self.one._check_filesystem(datasets)
+        paths[2].unlink()
+        # Check the callback is called for each existing file only
+        found = []
+        files = self.one._check_filesystem(datasets, callback=lambda *x: found.append(x))
+        self.assertIsNone(files[2])
+        self.assertEqual([(i, x) for i, x in enumerate(files) if x], found)
+        # In offline mode the files should be yielded with their positions
+        self.assertEqual(found, list(self.one._iter_filesystem(datasets)))
+        # Missing files should be yielded first if include_missing is True
+        out = list(self.one._iter_filesystem(datasets, include_missing=True))
+        self.assertEqual([(2, None)] + found, out)
+
+        # In online mode missing files are downloaded in a separate thread
+        def download(dsets, callback=None, **_):
+            self.assertEqual(1, len(dsets))
+            self.assertNotEqual(threading.current_thread(), threading.main_thread())
+            paths[2].touch()
+            callback(0, paths[2])
+            return [paths[2]]
+        with mock.patch.object(One, 'offline', new_callable=mock.PropertyMock) as offline, \
+                mock.patch.object(self.one, '_download_datasets', create=True,
+                                  side_effect=download):
+            offline.return_value = False
+            out = list(self.one._iter_filesystem(datasets, check_hash=False))
+        self.assertCountEqual(enumerate(paths), out)
+        self.assertEqual((2, paths[2]), out[-1])
+
+        # Check errors raised in the thread are propagated
+        paths[2].unlink()
+        with mock.patch.object(One, 'offline', new_callable=mock.PropertyMock) as offline, \
+                mock.patch.object(self.one, '_download_datasets', create=True,
+                                  side_effect=RuntimeError):
+            offline.return_value = False
+            with self.assertRaises(RuntimeError):
+                list(self.one._iter_filesystem(datasets, check_hash=False))
+        paths[2].touch()
+
     def test_load_dataset(self):
         """Test One.load_dataset"""
         eid = 'KS005/2019-04-02/001'
@@ -592,6 +650,11 @@ class TestONECache(unittest.TestCase):
         np.save(str(file), np.arange(3))  # Make sure we have something to load
         dset = self.one.load_dataset(eid, '_ibl_wheel.position.npy')
         self.assertTrue(np.all(dset == np.arange(3)))
+        # Check memory-mapped loading
+        dset = self.one.load_dataset(eid, '_ibl_wheel.position.npy', mmap_mode='r')
+        self.assertIsInstance(dset, np.memmap)
+        self.assertTrue(np.all(dset == np.arange(3)))
+        del dset
 
         # Check collection filter
         file = self.one.load_dataset(eid, '_iblrig_leftCamera.timestamps.ssv',
@@ -675,6 +738,13 @@ class TestONECache(unittest.TestCase):
                 self.one.load_datasets(eid, dsets, collections='alf', assert_present=False)
             with self.assertRaises(alferr.ALFObjectNotFound):
                 self.one.load_datasets(eid, dsets, collections='alf', assert_present=True)
+        # No file should be loaded when a dataset is missing and assert_present is True
+        with mock.patch.object(self.one, '_check_filesystem',
+                               side_effect=lambda x, **kwargs: [files[0], None]), \
+                mock.patch('one.alf.io.load_file_content') as load, \
+                self.assertRaises(alferr.ALFObjectNotFound):
+            self.one.load_datasets(eid, dsets, collections='alf', assert_present=True)
+        load.assert_not_called()
 
         # Check loading without extensions
         # Check download only
@@ -880,6 +950,50 @@ class TestONECache(unittest.TestCase):
         with self.assertRaises(ValueError):
             self.one.refresh_cache('double')
 
+    def test_background_refresh(self):
+        """Test One.refresh_cache with background_refresh set"""
+        self.one.background_refresh = True
+        self.one.cache_expiry = datetime.timedelta()  # Immediately expire
+        datasets = self.one._cache.datasets = self.one._cache.datasets.iloc[0:0].copy()
+        meta, hashes = self.one._cache['_meta'], self.one._file_hashes
+        prev_loaded = meta['loaded_time']
+        loading, load_cache = threading.Event(), One.load_cache
+        staging = []
+
+        def slow_load(one, *args, **kwargs):
+            staging.append(one)
+            loading.wait()
+            return load_cache(one, *args, **kwargs)
+
+        with mock.patch.object(One, 'load_cache', side_effect=slow_load, autospec=True):
+            # The current tables should be used until the new ones are loaded
+            self.assertEqual(prev_loaded, self.one.refresh_cache('auto'))
+            self.assertIs(datasets, self.one._cache.datasets)
+            thread = self.one._refresh_thread
+            self.assertTrue(thread.is_alive())
+            self.assertIs(thread, self.one._refresh_in_background())  # Already refreshing
+            # The tables should be loaded into separate objects
+            self.assertIsNot(self.one, staging[0])
+            self.assertIsNot(meta, staging[0]._cache['_meta'])
+            self.assertIsNot(self.one._cache_lock, staging[0]._cache_lock)
+            # The tables should be swapped in once no other thread holds the cache lock
+            with self.one._cache_lock:
+                loading.set()
+                thread.join(timeout=.5)
+                self.assertTrue(thread.is_alive())
+                self.assertIs(datasets, self.one._cache.datasets)
+            thread.join()
+        self.assertTrue(len(self.one._cache.datasets))
+        self.assertTrue(self.one._cache['_meta']['loaded_time'] > prev_loaded)
+        self.assertEqual(prev_loaded, meta['loaded_time'])
+        self.assertIs(hashes, self.one._file_hashes)
+        # Errors should be logged and the current tables kept
+        cache = self.one._cache
+        with mock.patch.object(One, 'load_cache', side_effect=OSError), \
+                self.assertLogs('one.api', 'ERROR'):
+            self.one._refresh_in_background().join()
+        self.assertIs(cache, self.one._cache)
+
     def test_save_cache(self):
         """Test one.util.save_cache"""
         self.one._cache['_meta'].pop('modified_time', None)
@@ -895,17 +1009,310 @@ class TestONECache(unittest.TestCase):
             raw_modified = One(cache_dir=tdir)._cache['_meta']['raw']['datasets']['date_modified']
             expected = self.one._cache['_meta']['modified_time'].strftime('%Y-%m-%d %H:%M')
             self.assertEqual(raw_modified, expected)
-            # Test file lock
-            t_now = time.time()
-            with mock.patch('one.api.time') as time_mock:
-                lock_file = Path(self.one.cache_dir).joinpath('.cache.lock')
-                lock_file.touch()
-                # We expect the process to sleep at first, then after skipping time,
-                # the stale lock file should be removed.
-                time_mock.time.side_effect = (t_now, t_now + 30)
-                self.one._save_cache(save_dir=tdir, force=True)  # force flag ignores modified time
-            self.assertFalse(lock_file.exists(), 'failed to remove stale lock file')
-            time_mock.sleep.assert_called()
+            # Only modified tables should be saved
+            self.one._cache['_meta']['modified_time'] = datetime.datetime.now()
+            self.one._cache['_meta']['modified_tables'] = {'sessions': None}
+            with mock.patch('one.api.parquet.save', wraps=parquet.save) as save:
+                self.one._save_cache(save_dir=tdir)
+                save.assert_called_once()
+                self.assertIs(self.one._cache['sessions'], save.call_args.args[1])
+            self.assertFalse(self.one._cache['_meta']['modified_tables'])
+            # Tables should be replaced atomically, leaving no temporary files
+            self.assertEqual(['datasets.pqt', 'sessions.pqt'],
+                             sorted(x.name for x in Path(tdir).iterdir()))
+            # Test file lock: saving should wait for the lock to be released
+            lock_file = Path(self.one.cache_dir).joinpath('.cache.lock')
+            released = threading.Event()
+
+            def save():
+                self.one._save_cache(save_dir=tdir, force=True)
+                released.set()
+
+            with file_lock(lock_file):
+                saver = threading.Thread(target=save)
+                saver.start()
+                self.assertFalse(released.wait(.2), 'failed to wait for lock')
+            saver.join(timeout=5)
+            self.assertTrue(released.is_set())
+            self.assertFalse(lock_file.exists(), 'failed to remove lock file')
+
+    def test_save_cache_deltas(self):
+        """Test One._save_cache and One.load_cache with table modification files"""
+        tables_dir = Path(self.one._tables_dir)
+        self.one._cache['_meta']['modified_tables'].clear()
+        # Modify a dataset record
+        dataset = self.one._cache.datasets.iloc[[0]].copy()
+        dataset['exists'] = ~dataset['exists']
+        self.one._update_cache_from_records(datasets=dataset)
+        self.assertEqual({'datasets'}, set(self.one._cache['_meta']['modified_tables']))
+        mtime = tables_dir.joinpath('datasets.pqt').stat().st_mtime_ns
+        self.one._save_cache(save_dir=tables_dir)
+        # Table file should not be rewritten
+        self.assertEqual(mtime, tables_dir.joinpath('datasets.pqt').stat().st_mtime_ns)
+        self.assertEqual(1, len(delta_files(tables_dir, 'datasets')))
+        # The modification should be applied when the tables are loaded
+        one = One(cache_dir=self.one.cache_dir, mode='local')
+        self.assertEqual(len(self.one._cache.datasets), len(one._cache.datasets))
+        self.assertEqual(dataset['exists'].iloc[0],
+                         one._cache.datasets.loc[dataset.index, 'exists'].item())
+        # A modification file for a different table revision should be ignored
+        table, metadata = parquet.load(tables_dir / 'datasets.pqt')
+        metadata['date_created'] = '2020-01-01 00:00'
+        parquet.save(tables_dir / 'datasets.pqt', table, metadata)
+        one.load_cache()
+        self.assertNotEqual(dataset['exists'].iloc[0],
+                            one._cache.datasets.loc[dataset.index, 'exists'].item())
+        # The table should be rewritten once there are too many modification files
+        self.one._set_modified('datasets', dataset.index.get_level_values(-1))
+        with mock.patch('one.api.MAX_DELTAS', 1):
+            self.one._save_cache(save_dir=tables_dir)
+        self.assertEqual([], delta_files(tables_dir, 'datasets'))
+        one.load_cache()
+        self.assertEqual(dataset['exists'].iloc[0],
+                         one._cache.datasets.loc[dataset.index, 'exists'].item())
+
+    def test_save_cache_concurrent(self):
+        """Test One._save_cache when the tables are modified by other processes"""
+        tables_dir = Path(self.one._tables_dir)
+        self.one._cache['_meta']['modified_tables'].clear()
+        other = One(cache_dir=self.one.cache_dir, mode='local')
+        datasets = self.one._cache.datasets.iloc[:2].copy()
+        datasets['exists'] = ~datasets['exists']
+        # Modifications saved by another process should not be lost when the table is rewritten
+        self.one._update_cache_from_records(datasets=datasets.iloc[[0]].copy())
+        self.one._save_cache(save_dir=tables_dir)
+        other._update_cache_from_records(datasets=datasets.iloc[[1]].copy())
+        other._save_cache(save_dir=tables_dir, force=True)
+        self.assertEqual([], delta_files(tables_dir, 'datasets'))
+        one = One(cache_dir=self.one.cache_dir, mode='local')
+        pd.testing.assert_frame_equal(
+            datasets[['exists']], one._cache.datasets.loc[datasets.index, ['exists']])
+        # Modifications of a table rewritten by another process should apply to the new table
+        datasets['exists'] = ~datasets['exists']
+        self.one._update_cache_from_records(datasets=datasets.iloc[[0]].copy())
+        with self.assertLogs('one.api', 'WARNING'):
+            self.one._save_cache(save_dir=tables_dir)
+        one.load_cache()
+        self.assertEqual(datasets['exists'].iloc[0],
+                         one._cache.datasets.loc[datasets.index[0], 'exists'].item())
+        self.assertNotEqual(datasets['exists'].iloc[1],
+                            one._cache.datasets.loc[datasets.index[1], 'exists'].item())
+        # Removing rows should rewrite the table
+        one._cache['_meta']['modified_tables'].clear()
+        one._cache['datasets'] = one._cache['datasets'].drop(datasets.index[:1])
+        one._set_modified('datasets', datasets.index.get_level_values(-1)[:1])
+        one._save_cache(save_dir=tables_dir)
+        self.assertEqual([], delta_files(tables_dir, 'datasets'))
+        one.load_cache()
+        self.assertNotIn(datasets.index[0], one._cache.datasets.index)
+        self.assertEqual(len(other._cache.datasets) - 1, len(one._cache.datasets))
+
+    def test_lazy_columns(self):
+        """Test One.load_cache and One._load_columns with lazy_columns set"""
+        tables_dir = Path(self.one._tables_dir)
+        # Save a modification file to check it is applied to the lazily loaded columns
+        dataset = self.one._cache.datasets.iloc[[0]].copy()
+        dataset['file_size'] = 1024
+        self.one._cache['_meta']['modified_tables'].clear()
+        self.one._update_cache_from_records(datasets=dataset)
+        self.one._save_cache(save_dir=tables_dir)
+        expected = One(cache_dir=self.one.cache_dir, mode='local')._cache.datasets
+
+        with mock.patch.object(One, 'lazy_columns', ('hash', 'file_size', 'foo')):
+            one = One(cache_dir=self.one.cache_dir, mode='local')
+        self.assertNotIn('hash', one._cache.datasets.columns)
+        self.assertNotIn('file_size', one._cache.datasets.columns)
+        unloaded = one._cache['_meta']['unloaded_columns']['datasets']
+        self.assertEqual(['hash', 'file_size', 'foo'], unloaded)
+        # Columns should be loaded when checking the filesystem
+        dsets = one._cache.datasets.iloc[:2]
+        one._check_filesystem(dsets, offline=True, check_hash=False)
+        self.assertNotIn('hash', one._cache.datasets.columns)
+        self.assertEqual(['hash', 'foo'], one._cache['_meta']['unloaded_columns']['datasets'])
+        np.testing.assert_array_equal(expected['file_size'], one._cache.datasets['file_size'])
+        self.assertEqual(1024, one._cache.datasets.loc[dataset.index, 'file_size'].item())
+        # Loading columns should not change which modification files were applied
+        applied = one._cache['_meta']['delta_files']['datasets']
+        self.assertEqual({x.name for x in delta_files(tables_dir, 'datasets')}, applied)
+        # Only the columns present in the records should be loaded before updating the table
+        dataset['file_size'] = 2048
+        one._cache['_meta']['modified_tables'].clear()
+        one._update_cache_from_records(datasets=dataset.drop(columns='hash'))
+        self.assertEqual(['hash', 'foo'], one._cache['_meta']['unloaded_columns']['datasets'])
+        # Unloaded columns should be copied from the table file when saving
+        one._save_cache(save_dir=tables_dir)  # saves a modification file
+        self.assertEqual(['hash', 'foo'], one._cache['_meta']['unloaded_columns']['datasets'])
+        one._save_cache(save_dir=tables_dir, force=True)  # rewrites the table
+        self.assertNotIn('hash', one._cache.datasets.columns)
+        self.assertEqual([], delta_files(tables_dir, 'datasets'))
+        expected.loc[dataset.index, 'file_size'] = 2048
+        datasets = One(cache_dir=self.one.cache_dir, mode='local')._cache.datasets
+        pd.testing.assert_frame_equal(expected, datasets[expected.columns])
+        # Remaining columns should be loaded
+        one._load_columns('datasets')
+        self.assertEqual([], one._cache['_meta']['unloaded_columns']['datasets'])
+        self.assertNotIn('foo', one._cache.datasets.columns)
+        pd.testing.assert_frame_equal(expected, one._cache.datasets[expected.columns])
+
+    def test_snapshot_tables(self):
+        """Test One.load_cache with snapshot_tables set"""
+        tables_dir = Path(self.one._tables_dir)
+        snapshot = tables_dir / SNAPSHOT_FILENAME
+        expected = One(cache_dir=self.one.cache_dir, mode='local')._cache
+        with mock.patch.object(One, 'snapshot_tables', True):
+            one = One(cache_dir=self.one.cache_dir, mode='local')
+            self.assertTrue(snapshot.exists())
+            # Subsequent loads should not read the table files
+            with mock.patch('one.api.load_table') as load:
+                one.load_cache()
+                load.assert_not_called()
+            for table in ('datasets', 'sessions'):
+                pd.testing.assert_frame_equal(expected[table], one._cache[table])
+            self.assertEqual(expected['_meta']['raw'], one._cache['_meta']['raw'])
+            # Modifying the table files should invalidate the snapshot
+            dataset = one._cache.datasets.iloc[[0]].copy()
+            dataset['exists'] = ~dataset['exists']
+            one._update_cache_from_records(datasets=dataset)
+            one._save_cache(save_dir=tables_dir)
+            with mock.patch('one.api.load_table', wraps=load_table) as load:
+                one.load_cache()
+                load.assert_called()
+            self.assertEqual(dataset['exists'].iloc[0],
+                             one._cache.datasets.loc[dataset.index, 'exists'].item())
+
+    def test_int_ids(self):
+        """Test One methods with int_ids set"""
+        expected, key = self.one._cache, self.one._snapshot_key()
+        with mock.patch.object(One, 'int_ids', True):
+            one = One(cache_dir=self.one.cache_dir, mode='local')
+        one.int_ids = True  # Keep flag set for this instance
+        self.assertNotEqual(key, one._snapshot_key())
+        # Tables should be indexed by integers
+        self.assertIsInstance(one._cache.sessions.index[0], int)
+        self.assertTrue(all(isinstance(x[0], int) for x in one._cache.datasets.index.levels))
+        pd.testing.assert_frame_equal(
+            expected.datasets[['rel_path']], cache_ids2str(one._cache.datasets[['rel_path']]))
+
+        # Methods should take and return str UUIDs
+        eid = 'd3372b15-f696-4279-9be5-98f15783b5bb'
+        self.assertEqual(self.one.search(), one.search())
+        self.assertEqual(eid, one.to_eid(UUID(eid).int))
+        self.assertEqual(eid, one.path2eid(one.eid2path(eid)))
+        self.assertEqual(eid, one.get_details(eid).name)
+        dsets = one.list_datasets(eid, details=True)
+        pd.testing.assert_frame_equal(self.one.list_datasets(eid, details=True), dsets)
+        self.assertEqual(self.one.list_datasets(eid), one.list_datasets(eid))
+        did = dsets.index[0]
+        file = one.eid2path(eid) / dsets['rel_path'].iloc[0]
+        self.assertEqual(did, one.path2record(file).name[1])
+        self.assertEqual(file, one.load_dataset_from_id(did, download_only=True))
+        with self.assertRaises(alferr.ALFObjectNotFound):
+            one.load_dataset_from_id('foo')
+        self.assertEqual(
+            self.one.load_object(eid, 'trials', download_only=True),
+            one.load_object(eid, 'trials', download_only=True))
+
+        # Modified records should be saved with str UUIDs
+        dataset = dsets.iloc[[0]].copy()
+        dataset['file_size'] = 1024
+        one._update_cache_from_records(datasets=pd.concat({eid: dataset}, names=['eid']))
+        idx = (UUID(eid).int, UUID(did).int)
+        self.assertEqual(1024, one._cache.datasets.loc[idx, 'file_size'].item())
+        one._save_cache(save_dir=one._tables_dir)
+        reloaded = One(cache_dir=self.one.cache_dir, mode='local')._cache.datasets
+        self.assertEqual(1024, reloaded.loc[(eid, did), 'file_size'].item())
+
+    def test_sync_cache(self):
+        """Test OneAlyx._sync_cache with a mock Web client"""
+        tables_dir = Path(self.one._tables_dir)
+        with mock.patch('one.api.wc.AlyxClient') as client:
+            client.return_value.cache_dir = Path(self.one.cache_dir)
+            one = OneAlyx(mode='local', cache_dir=self.one.cache_dir)
+        since = one._cache['_meta']['created_time']
+        created = datetime.datetime.now().replace(second=0, microsecond=0)
+        # A modified dataset of a new session
+        eid, did = str(uuid4()), str(uuid4())
+        base_url = 'https://alyx.example.org'
+        data_url = f'https://example.org/lab/Subjects/sub/2020-01-01/001/alf/obj.attr.{did}.npy'
+        dataset = {
+            'url': f'{base_url}/datasets/{did}', 'session': f'{base_url}/sessions/{eid}',
+            'file_size': 1024, 'hash': 'abc', 'default_dataset': True, 'qc': 'PASS',
+            'file_records': [{'exists': True, 'data_url': data_url}]}
+        session = {'url': f'{base_url}/sessions/{eid}', 'subject': 'sub', 'lab': 'lab',
+                   'start_time': '2020-01-01T10:00:00', 'number': 1, 'task_protocol': '',
+                   'projects': ['foo']}
+        one.alyx.rest.side_effect = lambda x, *_, **__: [dataset] if x == 'datasets' else [session]
+        table_files = {x: x.stat().st_mtime_ns for x in tables_dir.glob('*.pqt')}
+
+        self.assertTrue(one._sync_cache(since, created))
+        # Datasets should be queried from a margin before the tables were created
+        expected = (since - SYNC_MARGIN).isoformat(timespec='seconds')
+        (_, kwargs), (_, ses_kwargs) = one.alyx.rest.call_args_list
+        self.assertEqual(f'auto_datetime__gte,{expected}', kwargs['django'])
+        self.assertIn(eid, ses_kwargs['django'])
+        rel_path = one._cache.datasets.loc[(eid, did), 'rel_path']
+        self.assertEqual('alf/obj.attr.npy', rel_path.item())
+        self.assertEqual('sub', one._cache.sessions.loc[eid, 'subject'])
+        self.assertEqual(created, one._cache['_meta']['created_time'])
+        # The synchronized rows should be saved as modifications of the table files
+        self.assertEqual(table_files, {x: x.stat().st_mtime_ns for x in table_files})
+        self.assertEqual(1, len(delta_files(tables_dir, 'datasets')))
+        self.assertEqual(1, len(delta_files(tables_dir, 'sessions')))
+        saved = One(cache_dir=self.one.cache_dir, mode='local')
+        self.assertIn(did, saved._cache.datasets.index.get_level_values('id'))
+        self.assertEqual(created, saved._cache['_meta']['created_time'])
+        self.assertFalse(saved._cache['_meta']['expired'])
+        # When too many datasets have been modified, the tables should not be updated
+        with mock.patch('one.api.SYNC_MAX_RECORDS', 0):
+            self.assertFalse(one._sync_cache(created, created))
+
+    def test_share_cache(self):
+        """Test One.share_cache and One.load_cache with shared cache tables"""
+        owner = One(cache_dir=self.one.cache_dir, mode='local')
+        name = owner.share_cache()
+        self.assertNotIn('ONE_SHARED_CACHE', os.environ)
+        with mock.patch.dict(os.environ, {'ONE_SHARED_CACHE': name}):
+            with mock.patch('one.api.load_table') as load, \
+                    mock.patch('one.alf.cache.resource_tracker.unregister') as unregister:
+                one = One(cache_dir=self.one.cache_dir, mode='local')
+                load.assert_not_called()
+                unregister.assert_not_called()  # created by this process
+            for table in ('datasets', 'sessions'):
+                pd.testing.assert_frame_equal(owner._cache[table], one._cache[table])
+            self.assertEqual({'datasets', 'sessions'}, one._cache['_meta']['shared_tables'])
+            self.assertFalse(one._cache.datasets['file_size'].values.flags.writeable)
+            sessions = one._cache.sessions
+            # Modifying the tables should copy them
+            dataset = one._cache.datasets.iloc[[0]].copy()
+            dataset['file_size'] = 1024
+            one._update_cache_from_records(datasets=dataset)
+            self.assertEqual({'sessions'}, one._cache['_meta']['shared_tables'])
+            self.assertEqual(1024, one._cache.datasets.loc[dataset.index, 'file_size'].item())
+            self.assertNotEqual(
+                1024, owner._cache.datasets.loc[dataset.index, 'file_size'].item())
+            # Shared tables should be ignored once the table files change
+            one._save_cache(save_dir=self.one._tables_dir)
+            with mock.patch('one.api.load_table', wraps=load_table) as load:
+                one.load_cache()
+                load.assert_called()
+            self.assertEqual(set(), one._cache['_meta']['shared_tables'])
+        # The shared memory should be released with the instance
+        del owner
+        gc.collect()
+        with self.assertRaises(FileNotFoundError):
+            shared_memory.SharedMemory(name)
+        # Attached tables should remain valid
+        pd.testing.assert_frame_equal(self.one._cache.sessions, sessions)
+
+        # Memory created by another process should be removed from the resource tracker
+        shm = share_tables('key', {})
+        self.addCleanup(shm.unlink)
+        self.addCleanup(shm.close)
+        with mock.patch('one.alf.cache._created_memory', set()), \
+                mock.patch('one.alf.cache.resource_tracker.unregister') as unregister:
+            self.assertEqual((None, None), attach_tables(shm.name, 'other key'))
+            if os.name == 'posix':
+                unregister.assert_called_once_with(f'/{shm.name}', 'shared_memory')
 
     def test_update_cache_from_records(self):
         """Test One._update_cache_from_records"""
@@ -965,6 +1372,20 @@ class TestONECache(unittest.TestCase):
         self.assertEqual(self.one._cache.datasets.squeeze().name, dataset.name)
         self.assertCountEqual(self.one._cache.datasets.squeeze().to_dict(), dataset.to_dict())
 
+    def test_insert_rows(self):
+        """Test One._insert_rows"""
+        datasets = self.one._cache.datasets
+        datasets = datasets[~datasets.index.duplicated()]
+        # Take every other row as new rows, including the first and last
+        table, rows = datasets.iloc[1::2], datasets.iloc[::2].sample(frac=1, random_state=0)
+        merged = One._insert_rows(table, rows)
+        self.assertTrue(merged.index.is_monotonic_increasing)
+        pd.testing.assert_frame_equal(datasets, merged)
+        # An empty or unsorted table
+        pd.testing.assert_frame_equal(datasets, One._insert_rows(datasets.iloc[:0], datasets))
+        merged = One._insert_rows(table.iloc[::-1], rows)
+        pd.testing.assert_frame_equal(datasets, merged)
+
     def test_save_loaded_ids(self):
         """Test One.save_loaded_ids and logic within One._check_filesystem"""
         self.one.record_loaded = True  # Turn on saving UUIDs
@@ -1304,6 +1725,57 @@ class TestOneAlyx(unittest.TestCase):
             self.one.mode = 'auto'
             self.one.alyx.silent = True
 
+    def test_sync_cache(self):
+        """Test OneAlyx.load_cache with incremental_sync set"""
+        tables_dir = Path(self.tempdir.name, 'sync')
+        tables_dir.mkdir()
+        for file in self.one.cache_dir.glob('*.pqt'):
+            shutil.copy(file, tables_dir)
+        with mock.patch('one.params.iopar.getfile',
+                        new=partial(util.get_file, self.tempdir.name)):
+            one = OneAlyx(**TEST_DB_1, cache_dir=self.tempdir.name, tables_dir=tables_dir,
+                          mode='local')
+        one.mode, one.incremental_sync = 'auto', True
+        created = datetime.datetime.now().replace(second=0, microsecond=0)
+        cache_info = {'date_created': created.isoformat(), 'min_api_version': __version__,
+                      'origin': one._cache['_meta']['raw']['datasets'].get('origin')}
+        # A modified dataset of a new session
+        eid, did = str(uuid4()), str(uuid4())
+        base_url = one.alyx.base_url
+        data_url = f'https://example.org/lab/Subjects/sub/2020-01-01/001/alf/obj.attr.{did}.npy'
+        dataset = {
+            'url': f'{base_url}/datasets/{did}', 'session': f'{base_url}/sessions/{eid}',
+            'file_size': 1024, 'hash': 'abc', 'default_dataset': True, 'qc': 'PASS',
+            'file_records': [{'exists': True, 'data_url': data_url}]}
+        session = {'url': f'{base_url}/sessions/{eid}', 'subject': 'sub', 'lab': 'lab',
+                   'start_time': '2020-01-01T10:00:00', 'number': 1, 'task_protocol': '',
+                   'projects': ['foo']}
+
+        def rest(endpoint, action, **kwargs):
+            return [dataset] if endpoint == 'datasets' else [session]
+
+        with mock.patch.object(one.alyx, 'get', return_value=cache_info), \
+                mock.patch.object(one.alyx, 'rest', side_effect=rest) as rest_mock, \
+                mock.patch.object(one.alyx, 'download_cache_tables') as download:
+            one.load_cache(clobber=True)
+            download.assert_not_called()
+            self.assertIn('auto_datetime__gte', rest_mock.call_args_list[0].kwargs['django'])
+            self.assertIn(eid, rest_mock.call_args_list[1].kwargs['django'])
+            rel_path = one._cache.datasets.loc[(eid, did), 'rel_path']
+            self.assertEqual('alf/obj.attr.npy', rel_path.item())
+            self.assertEqual('sub', one._cache.sessions.loc[eid, 'subject'])
+            self.assertEqual(created, one._cache['_meta']['created_time'])
+            # The synchronized tables should have been saved
+            saved = One(cache_dir=self.tempdir.name, tables_dir=tables_dir, mode='local')
+            self.assertIn(did, saved._cache.datasets.index.get_level_values('id'))
+            self.assertEqual(created, saved._cache['_meta']['created_time'])
+            # When too many datasets have been modified, the full tables should be downloaded
+            one._cache['_meta']['created_time'] -= datetime.timedelta(days=1)
+            download.return_value = list(tables_dir.glob('*.pqt'))
+            with mock.patch('one.api.SYNC_MAX_RECORDS', 0):
+                one.load_cache(clobber=True)
+            download.assert_called_once()
+
     def test_check_filesystem(self):
         """Test for One._check_filesystem.
         Most is already covered by other tests, this just checks that it can deal with dataset
@@ -1930,6 +2402,8 @@ class TestOneSetup(unittest.TestCase):
                 return Path(self.tempdir.name).joinpath('downloads').as_posix()
             elif 'url' in prompt.lower():
                 return url
+            elif 'http_dl_threads' in prompt.lower():
+                return '4'
             else:
                 return 'mock_input'
         one.params.input = mock_input
@@ -1942,6 +2416,7 @@ class TestOneSetup(unittest.TestCase):
                               password=TEST_DB_1['password'])
             pars = one.params.get(url)
             self.assertFalse('ALYX_PWD' in pars.as_dict())
+            self.assertEqual(4, pars.HTTP_DL_THREADS)
         self.assertEqual(one_obj.alyx._par.ALYX_URL, url)
         client = f'.{one_obj.alyx.base_url.split("/")[-1]}'.replace(':', '_')
         client_pars = Path(self.tempdir.name).rglob(client)
@@ -2171,3 +2646,18 @@ class TestOneMisc(unittest.TestCase):
         with self.assertWarns(DeprecationWarning):
             self.assertEqual(['123'], ensure_list('123'))
             self.assertIs(x := ['123'], ensure_list(x))
+
+    def test_uuid_int2str(self):
+        """Test one.util.uuid_int2str and one.util.cache_int2str"""
+        uuids = [str(uuid4()) for _ in range(5)]
+        uuids += uuids[:2]
+        ints = parquet.str2np(uuids)
+        converted = uuid_int2str(ints)
+        self.assertEqual(uuids, converted.tolist())
+        self.assertIs(converted[0], converted[-2])  # Repeated UUIDs share the same object
+        self.assertEqual(0, uuid_int2str(ints[:0]).size)
+        # Check cache table conversion
+        table = pd.DataFrame(ints, columns=['id_0', 'id_1']).assign(foo=range(len(uuids)))
+        table = cache_int2str(table.set_index(['id_0', 'id_1']))
+        self.assertEqual(['id'], table.index.names)
+        self.assertEqual(uuids, table.index.tolist())
@@ -53,6 +53,24 @@ class TestParamSetup(unittest.TestCase):
         par = one.params.get(self.url, silent=True)
         self.assertEqual('https://' + self.url, par.ALYX_URL)
         self.assertEqual('mock_pwd', par.HTTP_DATA_SERVER_PWD)
+        self.assertIsNone(par.HTTP_DL_THREADS)
+
+        # Check number of download threads parsed
+        resp_map = {'HTTP_DL_THREADS': '4', 'settings correct?': 'Y'}
+        with mock.patch('one.params.input', new=partial(self._mock_input, **resp_map)):
+            one.params.setup()
+            self.assertEqual(4, one.params.get(self.url, silent=True).HTTP_DL_THREADS)
+        # An invalid answer should warn and keep the current value
+        for answer in ('many', '0'):
+            resp_map['HTTP_DL_THREADS'] = answer
+            with mock.patch('one.params.input', new=partial(self._mock_input, **resp_map)), \
+                    self.assertWarnsRegex(UserWarning, 'HTTP_DL_THREADS'):
+                one.params.setup('https://' + self.url)
+            self.assertEqual(4, one.params.get(self.url, silent=True).HTTP_DL_THREADS)
+        resp_map['HTTP_DL_THREADS'] = 'auto'
+        with mock.patch('one.params.input', new=partial(self._mock_input, **resp_map)):
+            one.params.setup()
+            self.assertEqual('auto', one.params.get(self.url, silent=True).HTTP_DL_THREADS)
 
         # Check verification prompt
         resp_map = {'ALYX_LOGIN': 'mistake', 'settings correct?': 'N'}
@@ -0,0 +1,251 @@
+"""Offline unit tests for the file download functions of the one.webclient module.
+
+These use a mock requests session or download function so that no server is required.
+"""
+import unittest
+from unittest import mock
+import re
+import json
+import hashlib
+import tempfile
+from pathlib import Path
+from urllib.error import URLError, HTTPError
+
+import requests
+from iblutil.io import hashfile
+import iblutil.io.params as iopar
+
+import one.params
+import one.webclient as wc
+
+
+class TestDownloads(unittest.TestCase):
+    """Tests for one.webclient downloads with a mock session"""
+    def test_http_download_file_list(self):
+        """Test for one.webclient.http_download_file_list with a mock download function."""
+        tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tdir.cleanup)
+        files = [Path(tdir.name, f'obj.attr{i}.npy') for i in range(10)]
+        for file in files:
+            file.write_bytes(b'0' * 10)
+        links = ['https://example.com/' + f.name for f in files]
+        downloads = dict(zip(links, files))
+        failed = set()
+
+        def flaky(link, **_):
+            """Fail on the first download attempt of each file."""
+            if link not in failed:
+                failed.add(link)
+                raise URLError('connection reset')
+            return downloads[link]
+
+        with mock.patch('one.webclient.http_download_file', side_effect=flaky) as download:
+            # Check errors raised when not in adaptive mode
+            self.assertRaises(URLError, wc.http_download_file_list, links, n_threads=2)
+            # In adaptive mode, failed downloads should be retried
+            failed.clear()
+            download.reset_mock()
+            self.assertEqual(files, wc.http_download_file_list(links, n_threads='auto'))
+            self.assertEqual(len(links) * 2, download.call_count)
+            self.assertIsNone(download.call_args.kwargs['timeout'])
+            # Check timeouts from file sizes
+            wc.http_download_file_list(links, n_threads=1, file_size=[1e8] * len(links))
+            self.assertEqual(wc.download_timeout(1e8), download.call_args.kwargs['timeout'])
+            # Check explicit timeout used for every file
+            wc.http_download_file_list(
+                links, n_threads=1, file_size=[1e8] * len(links), timeout=5)
+            self.assertEqual(5, download.call_args.kwargs['timeout'])
+
+    def test_download_file(self):
+        """Test for AlyxClient.download_file download kwargs with a mock client."""
+        par = one.params.default().set('CACHE_DIR', tempfile.gettempdir())
+        alyx = mock.Mock(spec=wc.AlyxClient, _par=par, silent=True)
+        alyx._validate_file_url.side_effect = lambda x: x
+        url = par.HTTP_DATA_SERVER + '/path/to/file.npy'
+        session = mock.Mock(spec=requests.Session)
+        with mock.patch('one.webclient.http_download_file') as download:
+            # Check timeout set from file size
+            wc.AlyxClient.download_file(alyx, url, file_size=1e8, session=session)
+            self.assertEqual(wc.download_timeout(1e8), download.call_args.kwargs['timeout'])
+            # Check user timeout not overwritten
+            wc.AlyxClient.download_file(alyx, url, file_size=1e8, timeout=5, session=session)
+            self.assertEqual(5, download.call_args.kwargs['timeout'])
+            # Check user timeout passed to each download of a list
+            files = wc.AlyxClient.download_file(
+                alyx, [url, url], file_size=[1e8, 1e8], timeout=5, session=session)
+            self.assertEqual(2, len(files))
+            self.assertEqual(5, download.call_args.kwargs['timeout'])
+        # Check number of threads taken from parameters
+        alyx._par = par.set('HTTP_DL_THREADS', 'auto')
+        with mock.patch('one.webclient.http_download_file_list') as download:
+            wc.AlyxClient.download_file(alyx, [url], session=session)
+            self.assertEqual('auto', download.call_args.kwargs['n_threads'])
+            wc.AlyxClient.download_file(alyx, [url], n_threads=2, session=session)
+            self.assertEqual(2, download.call_args.kwargs['n_threads'])
+
+    def test_http_download_file(self):
+        """Test for one.webclient.http_download_file with a mock session."""
+        tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tdir.cleanup)
+        session = mock.Mock(spec=requests.Session)
+        response = session.get.return_value
+        response.__enter__ = mock.Mock(return_value=response)
+        response.__exit__ = mock.Mock(return_value=None)
+        response.ok, response.headers = True, {'Content-Length': '6'}
+        response.iter_content.return_value = [b'foo', b'bar']
+        url = 'https://example.com/path/obj.attr#1#.npy'
+        file, md5 = wc.http_download_file(url, target_dir=tdir.name, session=session,
+                                          username='user', password='pwd', chunks=(0, 6),
+                                          return_md5=True, silent=True)
+        self.assertEqual(b'foobar', file.read_bytes())
+        self.assertEqual(hashfile.md5(file), md5)
+        (url_, ), kwargs = session.get.call_args
+        self.assertEqual('https://example.com/path/obj.attr%231%23.npy', url_)
+        self.assertEqual(('user', 'pwd'), kwargs['auth'])
+        self.assertEqual('bytes=0-5', kwargs['headers']['Range'])
+        # Check HTTP errors raised
+        response.ok, response.status_code, response.reason = False, 401, 'Unauthorized'
+        with self.assertRaises(HTTPError) as ex, self.assertLogs(wc._logger, 'ERROR'):
+            wc.http_download_file(url, target_dir=tdir.name, session=session, clobber=True)
+        self.assertEqual(401, ex.exception.code)
+
+        # Check existing files of the expected size are not re-downloaded or re-hashed
+        session.reset_mock()
+        with mock.patch('one.webclient.hashfile.md5') as md5_mock:
+            out = wc.http_download_file(url, target_dir=tdir.name, session=session,
+                                        file_size=6, hash='abc', return_md5=True)
+            self.assertEqual((file, 'abc'), out)
+            md5_mock.assert_not_called()
+        session.get.assert_not_called()
+        # Existing files of a different size should be re-downloaded
+        response.ok, response.status_code = True, 200
+        wc.http_download_file(url, target_dir=tdir.name, session=session, file_size=10)
+        session.get.assert_called_once()
+
+    def test_http_download_file_resume(self):
+        """Test resumed and segmented downloads in one.webclient.http_download_file."""
+        tdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tdir.cleanup)
+        data = bytes(range(256)) * 40
+        url = 'https://example.com/path/obj.attr.npy'
+        file = Path(tdir.name, 'obj.attr.npy')
+        part_file = file.with_name('.obj.attr.npy.part')
+        progress_file = part_file.with_name(part_file.name + '.json')
+
+        def get(url, headers=None, **_):
+            """Return a mock response for the requested byte range of the data."""
+            start, end = re.match(r'bytes=(\d+)-(\d*)', headers.get('Range', 'bytes=0-')).groups()
+            body = data[int(start):int(end or len(data) - 1) + 1]
+            response = mock.MagicMock(ok=True, status_code=206 if 'Range' in headers else 200)
+            response.headers = {'Content-Length': str(len(body)), 'Accept-Ranges': 'bytes'}
+            response.__enter__.return_value = response
+            response.iter_content.return_value = [
+                body[i:i + 1000] for i in range(0, len(body), 1000)]
+            return response
+        session = mock.Mock(get=mock.Mock(side_effect=get))
+        kwargs = dict(target_dir=tdir.name, session=session, return_md5=True, silent=True)
+
+        # Check resumes from partial file
+        part_file.write_bytes(data[:3000])
+        expected = (file, hashlib.md5(data).hexdigest())
+        self.assertEqual(expected, wc.http_download_file(url, **kwargs))
+        self.assertEqual(data, file.read_bytes())
+        self.assertFalse(part_file.exists())
+        self.assertEqual('bytes=3000-', session.get.call_args.kwargs['headers']['Range'])
+
+        # Check large files downloaded in segments
+        session.get.reset_mock()
+        with mock.patch.object(wc, 'LARGE_FILE_SIZE', 1000):
+            _, md5 = wc.http_download_file(url, clobber=True, **kwargs)
+        self.assertEqual(hashlib.md5(data).hexdigest(), md5)
+        self.assertEqual(data, file.read_bytes())
+        self.assertEqual(1 + wc.N_SEGMENTS, session.get.call_count)
+        self.assertFalse(progress_file.exists())
+
+        # Check resumes interrupted segmented download
+        file.unlink()
+        session.get.reset_mock()
+        wc._init_segments(part_file, progress_file, len(data), 2)
+        with open(part_file, 'r+b') as f:
+            f.write(data[:len(data) // 2])
+        progress = json.loads(progress_file.read_text())
+        progress['next'][0] = len(data) // 2
+        progress_file.write_text(json.dumps(progress))
+        _, md5 = wc.http_download_file(url, **kwargs)
+        self.assertEqual(hashlib.md5(data).hexdigest(), md5)
+        self.assertEqual(data, file.read_bytes())
+        session.get.assert_called_once()
+        expected = f'bytes={len(data) // 2}-{len(data) - 1}'
+        self.assertEqual(expected, session.get.call_args.kwargs['headers']['Range'])
+
+        # Check progress saved when a segment is interrupted between saves
+        file.unlink()
+        wc._init_segments(part_file, progress_file, len(data), 2)
+
+        def first_block(blocks):
+            """Yield the first block then fail, as if the connection dropped."""
+            yield blocks[0]
+            raise IOError('connection reset')
+
+        def interrupted(url, headers=None, **kwargs):
+            """Interrupt the download of the second segment."""
+            response = get(url, headers=headers, **kwargs)
+            if headers['Range'] != f'bytes=0-{len(data) // 2 - 1}':
+                response.iter_content.return_value = first_block(
+                    response.iter_content.return_value)
+            return response
+        session.get.side_effect = interrupted
+        with mock.patch.object(wc, 'PROGRESS_INTERVAL', float('inf')), \
+                self.assertRaises(IOError):
+            wc.http_download_file(url, **kwargs)
+        progress = json.loads(progress_file.read_text())
+        self.assertEqual([len(data) // 2, len(data) // 2 + 1000], progress['next'])
+
+        # Check stale progress file discarded when partial file missing
+        session.get.side_effect = get
+        session.get.reset_mock()
+        part_file.unlink()
+        _, md5 = wc.http_download_file(url, **kwargs)
+        self.assertEqual(hashlib.md5(data).hexdigest(), md5)
+        self.assertFalse(progress_file.exists())
+        self.assertNotIn('Range', session.get.call_args.kwargs['headers'])
+
+    def test_download_session(self):
+        """Test for AlyxClient.download_session property."""
+        alyx = mock.Mock(spec=wc.AlyxClient, _download_session=None, _par=iopar.from_dict({}))
+        session = wc.AlyxClient.download_session.fget(alyx)
+        self.assertIsInstance(session, requests.Session)
+        adapter = session.get_adapter('https://example.com')
+        self.assertEqual(max(wc.MAX_THREADS, wc.N_THREADS), adapter._pool_maxsize)
+
+    def test_download_limit(self):
+        """Test for one.webclient._DownloadLimit class."""
+        limit = wc._DownloadLimit(2, 4, adaptive=True)
+        with limit:
+            self.assertEqual(1, limit.active)
+        self.assertEqual(0, limit.active)
+        # Limit should increase after the first window
+        limit.record(100)
+        self.assertEqual(2, limit.limit)
+        limit.record(100)
+        self.assertEqual(3, limit.limit)
+        # Limit should halve on error
+        limit.record(error=True)
+        self.assertEqual(1, limit.limit)
+        # Limit shouldn't change when not adaptive
+        limit = wc._DownloadLimit(2)
+        limit.record(error=True)
+        self.assertEqual(2, limit.limit)
+        self.assertEqual(2, limit.maximum)
+
+    def test_download_timeout(self):
+        """Test for one.webclient.download_timeout function."""
+        self.assertIsNone(wc.download_timeout(None))
+        self.assertIsNone(wc.download_timeout(0))
+        expected = wc.DOWNLOAD_MIN_TIMEOUT + 1e8 / wc.DOWNLOAD_MIN_SPEED
+        self.assertEqual(expected, wc.download_timeout(1e8))
+        self.assertTrue(wc.download_timeout(1e9) > wc.download_timeout(1e8))
+
+
+if __name__ == '__main__':
+    unittest.main(exit=False, verbosity=2)
@@ -1,19 +1,27 @@
 """Decorators and small standalone functions for api module."""
+import os
 import re
 import logging
 import urllib.parse
 import fnmatch
 import warnings
 from functools import wraps, partial
+from contextlib import contextmanager
+from pathlib import Path
 from typing import Sequence, Union, Iterable, Optional, List
 from collections.abc import Mapping
 from datetime import datetime
+from uuid import UUID
 
 import pandas as pd
-from iblutil.io import parquet
 from iblutil.util import ensure_list as _ensure_list
 import numpy as np
 from packaging import version
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+    import msvcrt
 
 import one.alf.exceptions as alferr
 from one.alf.path import rel_path_parts, get_session_path, get_alf_path, remove_uuid_string
@@ -24,6 +32,9 @@ logger = logging.getLogger(__name__)
 QC_TYPE = pd.CategoricalDtype(categories=[e.name for e in sorted(QC)], ordered=True)
 """pandas.api.types.CategoricalDtype: The cache table QC column data type."""
 
+_HEX = np.array([f'{i:02x}' for i in range(256)], dtype='S2')
+"""numpy.ndarray: The hexadecimal characters of each byte value."""
+
 
 def Listable(t):
     """Return a typing.Union if the input and sequence of input."""
@@ -168,6 +179,17 @@ def refresh(method):
     return wrapper
 
 
+def cache_locked(method):
+    """Hold the cache lock of a One instance while the method modifies its cache tables."""
+
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._cache_lock:
+            return method(self, *args, **kwargs)
+
+    return wrapper
+
+
 def validate_date_range(date_range) -> (pd.Timestamp, pd.Timestamp):
     """
     Validates and arrange date range in a 2 elements list.
@@ -290,7 +312,7 @@ def _file_spec(**kwargs):
 
 def filter_datasets(
         all_datasets, filename=None, collection=None, revision=None, revision_last_before=True,
-        qc=QC.FAIL, ignore_qc_not_set=False, assert_unique=True, wildcards=False):
+        qc=QC.FAIL, ignore_qc_not_set=False, assert_unique=True, wildcards=False, index=None):
     """
     Filter the datasets cache table by the relative path (dataset name, collection and revision).
     When None is passed, all values will match.  To match on empty parts, use an empty string.
@@ -322,6 +344,10 @@ def filter_datasets(
         When true an error is raised if multiple collections or datasets are found.
     wildcards : bool
         If true, use unix shell style matching instead of regular expressions.
+    index : one.alf.cache.DatasetIndex, optional
+        An index of dataset relative paths.  If provided, the relative paths are matched and
+        decomposed via the index instead of parsing each row of the table.  The output is
+        unaffected.
 
     Returns
     -------
@@ -403,6 +429,9 @@ def filter_datasets(
     # If matching revision name, add to regex string
     if not revision_last_before:
         regex_args.update(revision=revision)
+    # The raw part values, used to narrow down an index query.  A filename pattern may match
+    # across parts so is only resolved by the regular expression.
+    parts = regex_args.copy() if isinstance(filename, dict) else {}
 
     for k, v in regex_args.items():
         if v is None:
@@ -415,7 +444,10 @@ def filter_datasets(
 
     # Build regex string
     pattern = alf_regex('^' + spec_str, **regex_args)
-    path_match = all_datasets['rel_path'].str.match(pattern)
+    if index is None:
+        path_match = all_datasets['rel_path'].str.match(pattern)
+    else:
+        path_match = index.match(all_datasets['rel_path'], pattern, wildcards, **parts)
 
     # Test on QC outcome
     qc = QC.validate(qc)
@@ -429,10 +461,18 @@ def filter_datasets(
         return match
 
     # Extract revision to separate column
+    if index is not None:
+        parts = index.decompose(match['rel_path'])
     if 'revision' not in match.columns:
-        match['revision'] = match.rel_path.map(lambda x: rel_path_parts(x)[1] or '')
+        if index is None:
+            match['revision'] = match.rel_path.map(lambda x: rel_path_parts(x)[1] or '')
+        else:
+            match['revision'] = parts['revision'].to_numpy(object)
     if assert_unique:
-        collections = set(rel_path_parts(x)[0] or '' for x in match.rel_path.values)
+        if index is None:
+            collections = set(rel_path_parts(x)[0] or '' for x in match.rel_path.values)
+        else:
+            collections = set(parts['collection'].unique())
         if len(collections) > 1:
             _list = '"' + '", "'.join(collections) + '"'
             raise alferr.ALFMultipleCollectionsFound(_list)
@@ -636,6 +676,38 @@ class LazyId(Mapping):
             return ses.get('id', None) or ses['url'].split('/').pop()
 
 
+def uuid_int2str(ids) -> np.ndarray:
+    """Convert UUIDs stored as pairs of int64 to strings.
+
+    A vectorized equivalent of iblutil.io.parquet.np2str.  Each unique UUID is converted once
+    and repeated UUIDs share the same str object, which reduces the memory used by columns such
+    as the datasets table eid.
+
+    Parameters
+    ----------
+    ids : numpy.ndarray
+        An N by 2 int64 array of UUIDs, as returned by iblutil.io.parquet.str2np.
+
+    Returns
+    -------
+    numpy.ndarray
+        An object array of N UUID strings.
+
+    Examples
+    --------
+    >>> uuid_int2str(parquet.str2np(['b8f6fb2d-2a2a-4ff4-83b4-5b9b4ab5b2ab']))
+    array(['b8f6fb2d-2a2a-4ff4-83b4-5b9b4ab5b2ab'], dtype=object)
+    """
+    ids = np.ascontiguousarray(ids, dtype=np.int64).reshape(-1, 2)
+    uniques, inverse = np.unique(ids, axis=0, return_inverse=True)
+    # Hex encode the 16 bytes of each UUID and insert the hyphens
+    chars = _HEX[uniques.view(np.uint8)].view(np.uint8).reshape(-1, 32)
+    uuids = np.full((len(uniques), 36), ord('-'), dtype=np.uint8)
+    uuids[:, np.r_[0:8, 9:13, 14:18, 19:23, 24:36]] = chars
+    uuids = uuids.view('S36').ravel().astype(str).astype(object)
+    return uuids[inverse.ravel()]
+
+
 def cache_int2str(table: pd.DataFrame) -> pd.DataFrame:
     """Convert int ids to str ids for cache table.
 
@@ -653,11 +725,143 @@ def cache_int2str(table: pd.DataFrame) -> pd.DataFrame:
     assert not len(int_cols) % 2, 'expected even number of columns ending in _0 or _1'
     names = sorted(set(c.rsplit('_', 1)[0] for c in int_cols.values))
     for i, name in zip(range(0, len(int_cols), 2), names):
-        table[name] = parquet.np2str(table[int_cols[i:i + 2]])
+        table[name] = uuid_int2str(table[int_cols[i:i + 2]].values)
     table = table.drop(int_cols, axis=1).set_index(names)
     return table
 
 
+def uuid2int(uuids):
+    """Convert UUIDs to 128-bit integers.
+
+    Each unique UUID is converted once.  Integers are returned unchanged.
+
+    Parameters
+    ----------
+    uuids : str, uuid.UUID, int, iterable
+        One or more UUIDs.
+
+    Returns
+    -------
+    int, numpy.ndarray
+        The integer value of each UUID (i.e. uuid.UUID.int); an object array if an iterable was
+        passed.
+
+    Examples
+    --------
+    >>> uuid2int('b8f6fb2d-2a2a-4ff4-83b4-5b9b4ab5b2ab')
+    245860350714751440796458922694310998699
+
+    See Also
+    --------
+    int2uuid
+    """
+    def convert(x):
+        return x if isinstance(x, int) else int(str(x).replace('-', ''), 16)
+    if isinstance(uuids, (str, UUID, int)):
+        return convert(uuids)
+    codes, uniques = pd.factorize(np.asarray(list(uuids), dtype=object))
+    ints = np.empty(len(uniques), dtype=object)
+    ints[:] = [convert(x) for x in uniques]
+    return ints[codes]
+
+
+def int2uuid(ids):
+    """Convert 128-bit integers to UUID strings.
+
+    Each unique integer is converted once.  Strings are returned unchanged.
+
+    Parameters
+    ----------
+    ids : int, str, iterable
+        One or more integer UUIDs, as returned by uuid2int.
+
+    Returns
+    -------
+    str, numpy.ndarray
+        The UUID string of each integer; an object array if an iterable was passed.
+
+    Examples
+    --------
+    >>> int2uuid(245860350714751440796458922694310998699)
+    'b8f6fb2d-2a2a-4ff4-83b4-5b9b4ab5b2ab'
+
+    See Also
+    --------
+    uuid2int
+    """
+    if isinstance(ids, (int, str)):
+        return ids if isinstance(ids, str) else str(UUID(int=ids))
+    ids = np.asarray(list(ids), dtype=object)
+    is_int = np.fromiter((isinstance(x, int) for x in ids), dtype=bool, count=len(ids))
+    if is_int.any():
+        # Split into big-endian 64-bit halves, whose bytes are those of the UUID
+        ints = ids[is_int]
+        halves = np.c_[ints >> 64, ints & (2 ** 64 - 1)].astype(np.uint64).astype('>u8')
+        ids[is_int] = uuid_int2str(halves.view(np.int64))
+    return ids
+
+
+def _convert_id_levels(table, func, from_type):
+    """Apply a conversion to the index levels of a table that contain a given type of value."""
+    def convert(level):
+        if level.dtype == object and len(level) and isinstance(level[0], from_type):
+            return pd.Index(func(level), name=level.name, dtype=object)
+        return level
+    index = table.index
+    if isinstance(index, pd.MultiIndex):
+        # The converted values are unique and sort in the same order as the originals
+        new_index = index.set_levels([convert(x) for x in index.levels], verify_integrity=False)
+    else:
+        new_index = convert(index)
+    if new_index is index:
+        return table
+    table = table.copy(deep=False)
+    table.index = new_index
+    return table
+
+
+def cache_ids2int(table: pd.DataFrame) -> pd.DataFrame:
+    """Convert the str UUID index of a cache table to 128-bit integers.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        A cache table (from One._cache) or records of one.
+
+    Returns
+    -------
+    pd.DataFrame
+        The table with its str UUID index levels converted (a shallow copy), or the input table if
+        there are none.
+
+    See Also
+    --------
+    cache_ids2str, One.int_ids
+    """
+    return _convert_id_levels(table, uuid2int, str)
+
+
+def cache_ids2str(table: pd.DataFrame) -> pd.DataFrame:
+    """Convert the 128-bit integer UUID index of a cache table to strings.
+
+    Parameters
+    ----------
+    table : pd.DataFrame
+        A cache table (from One._cache) or records of one.
+
+    Returns
+    -------
+    pd.DataFrame
+        The table with its integer UUID index levels converted (a shallow copy), or the input
+        table if there are none.
+
+    See Also
+    --------
+    cache_ids2int, One.int_ids
+    """
+    return _convert_id_levels(table, int2uuid, int)
+
+
 def patch_cache(table: pd.DataFrame, min_api_version=None, name=None) -> pd.DataFrame:
     """Reformat older cache tables to comply with this version of ONE.
 
@@ -684,3 +888,69 @@ def patch_cache(table: pd.DataFrame, min_api_version=None, name=None) -> pd.Data
     if name == 'datasets' and 'session_path' in table.columns:
         table = table.drop('session_path', axis=1)
     return table
+
+
+def _lock(fd):
+    """Block until an exclusive lock is acquired on an open file descriptor."""
+    if fcntl:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        return
+    while True:
+        try:
+            msvcrt.locking(fd, msvcrt.LK_LOCK, 1)  # Retries for 10 seconds before raising
+            return
+        except OSError:
+            continue
+
+
+@contextmanager
+def file_lock(lock_file):
+    """
+    Context manager holding an exclusive, OS-level advisory lock on a file.
+
+    The lock file is created if necessary and removed on release.  Waiting processes are blocked
+    by the operating system rather than polling, and the lock is released automatically should
+    the holding process die.
+
+    Parameters
+    ----------
+    lock_file : str, pathlib.Path
+        The lock file path.
+
+    Yields
+    ------
+    pathlib.Path
+        The lock file path.
+
+    Examples
+    --------
+    >>> with file_lock(Path(one.cache_dir, '.cache.lock')):
+    ...     parquet.save(filename, table)
+    """
+    lock_file = Path(lock_file)
+    while True:
+        fd = os.open(lock_file, os.O_RDWR | os.O_CREAT)
+        try:
+            _lock(fd)
+            # The previous holder may have removed the file while we were waiting
+            if os.path.samestat(os.fstat(fd), os.stat(lock_file)):
+                break
+        except FileNotFoundError:
+            pass
+        except BaseException:
+            os.close(fd)
+            raise
+        os.close(fd)
+    try:
+        yield lock_file
+    finally:
+        if fcntl:  # Remove while still locked so that no waiting process locks a stale file
+            lock_file.unlink(missing_ok=True)
+            os.close(fd)
+        else:  # An open file can not be removed on Windows
+            msvcrt.locking(fd, msvcrt.LK_UNLCK, 1)
+            os.close(fd)
+            try:
+                lock_file.unlink()
+            except OSError:  # Opened by a waiting process that will remove it
+                pass
@@ -31,10 +31,12 @@ Download a remote file, given a local path
 import json
 import logging
 import math
+import os
 import re
 import functools
-import urllib.request
-from urllib.error import HTTPError
+import threading
+import time
+from urllib.error import HTTPError, URLError
 import urllib.parse
 from collections.abc import Mapping
 from typing import Optional
@@ -57,6 +59,22 @@ from iblutil.io.params import set_hidden
 from iblutil.util import ensure_list
 import concurrent.futures
 _logger = logging.getLogger(__name__)
+N_THREADS = int(os.environ.get('ONE_HTTP_DL_THREADS', 4))
+"""int: The default number of concurrent file downloads."""
+MAX_THREADS = 32
+"""int: The maximum number of concurrent file downloads in adaptive mode."""
+MAX_RETRIES = 3
+"""int: The number of times a failed download is retried in adaptive mode."""
+DOWNLOAD_MIN_SPEED = 125_000
+"""int: The slowest expected download speed in bytes per second, used for download timeouts."""
+DOWNLOAD_MIN_TIMEOUT = 60
+"""int: The minimum download timeout in seconds."""
+LARGE_FILE_SIZE = 1024 ** 3
+"""int: Files of at least this many bytes are downloaded in parallel byte-range segments."""
+N_SEGMENTS = 4
+"""int: The default number of parallel byte-range segments for large file downloads."""
+PROGRESS_INTERVAL = 1.
+"""float: The minimum number of seconds between saves of a segmented download's progress."""
 
 
 def _cache_response(method):
@@ -273,18 +291,117 @@ def update_url_params(url: str, params: dict) -> str:
     return parsed_url._replace(query=encoded_get_args).geturl()
 
 
-def http_download_file_list(links_to_file_list, **kwargs):
+def download_timeout(file_size):
+    """
+    Return a download timeout for a file of a given size.
+
+    The timeout allows for a download speed of DOWNLOAD_MIN_SPEED bytes per second, plus the
+    DOWNLOAD_MIN_TIMEOUT for the server to respond.
+
+    Parameters
+    ----------
+    file_size : int, None
+        The expected file size in bytes.
+
+    Returns
+    -------
+    float, None
+        The timeout in seconds, or None if the file size is unknown.
+    """
+    if not file_size:
+        return None
+    return DOWNLOAD_MIN_TIMEOUT + file_size / DOWNLOAD_MIN_SPEED
+
+
+class _DownloadLimit:
+    """
+    Limits the number of concurrent downloads.
+
+    In adaptive mode the limit is additively increased while the measured throughput improves,
+    decreased when it drops, and halved whenever a download fails.
+    """
+
+    def __init__(self, limit, maximum=None, adaptive=False):
+        self.limit = limit
+        self.maximum = maximum or limit
+        self.adaptive = adaptive
+        self.active = 0
+        self._condition = threading.Condition()
+        self._window = (0, 0, time.monotonic())  # number of files, bytes, start time
+        self._rate = None  # throughput of the previous window in bytes per second
+
+    def __enter__(self):
+        with self._condition:
+            self._condition.wait_for(lambda: self.active < self.limit)
+            self.active += 1
+        return self
+
+    def __exit__(self, *_):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def record(self, n_bytes=0, error=False):
+        """
+        Record a completed download, adjusting the limit in adaptive mode.
+
+        Parameters
+        ----------
+        n_bytes : int
+            The number of bytes downloaded.
+        error : bool
+            If true the download failed.
+        """
+        if not self.adaptive:
+            return
+        with self._condition:
+            if error:
+                self.limit = max(1, self.limit // 2)
+                self._window, self._rate = (0, 0, time.monotonic()), None
+                return
+            n, total, start = self._window
+            n, total = n + 1, total + n_bytes
+            if n < self.limit:  # Measure over at least as many files as there are threads
+                self._window = (n, total, start)
+                return
+            rate = total / max(time.monotonic() - start, 1e-3)
+            if self._rate is None or rate > self._rate * 1.1:
+                self.limit = min(self.maximum, self.limit + 1)
+            elif rate < self._rate * .9:
+                self.limit = max(1, self.limit - 1)
+            _logger.debug('%i concurrent downloads at %.0f bytes/s', self.limit, rate)
+            self._window, self._rate = (0, 0, time.monotonic()), rate
+            self._condition.notify_all()
+
+
+def http_download_file_list(links_to_file_list, callback=None, n_threads=None, file_size=None,
+                            hash=None, **kwargs):
     """
     Downloads a list of files from a remote HTTP server from a list of links.
-    Generates up to 4 separate threads to handle downloads.
+    Generates up to N_THREADS separate threads to handle downloads.
     Same options behaviour as http_download_file.
 
     Parameters
     ----------
     links_to_file_list : list
         List of http links to files.
+    callback : function, optional
+        A function called with the index of the link and the output of http_download_file as
+        soon as each download completes, e.g. to process files while others are downloading.
+        NB: This is called from the download thread.
+    n_threads : int, str, optional
+        The number of concurrent downloads.  Defaults to N_THREADS, which may be set with the
+        ONE_HTTP_DL_THREADS environment variable.  If 'auto', the number of concurrent downloads
+        starts at N_THREADS and is adapted to the measured throughput (up to MAX_THREADS), and
+        failed downloads are resumed up to MAX_RETRIES times.
+    file_size : list of int, optional
+        The expected size of each file in bytes, used to set a timeout for each download and to
+        verify existing files.
+    hash : list of str, optional
+        The expected MD5 hash of each file (see http_download_file).
     **kwargs
-        Optional arguments to pass to http_download_file.
+        Optional arguments to pass to http_download_file.  If no timeout is passed, the timeout
+        of each download is derived from its file size (see download_timeout).
 
     Returns
     -------
@@ -292,22 +409,48 @@ def http_download_file_list(links_to_file_list, **kwargs):
         A list of the local full path of the downloaded files.
     """
     links_to_file_list = list(links_to_file_list)  # In case generator was passed
-    n_threads = 4  # Max number of threads
+    adaptive = n_threads == 'auto'
+    n_threads = N_THREADS if adaptive or n_threads is None else int(n_threads)
+    limit = _DownloadLimit(n_threads, MAX_THREADS if adaptive else None, adaptive=adaptive)
     outputs = []
     target_dir = kwargs.pop('target_dir', None)
     # Ensure target dir the length of url list
     if target_dir is None or isinstance(target_dir, (str, Path)):
         target_dir = [target_dir] * len(links_to_file_list)
     assert len(target_dir) == len(links_to_file_list)
+    file_size = file_size or [None] * len(links_to_file_list)
+    hash = hash or [None] * len(links_to_file_list)
+    timeout = kwargs.pop('timeout', None)  # Otherwise derived from each file size
+
+    def _download(i, link, target, size, md5):
+        """Download a file and pass the output to the callback function, if any."""
+        retries = MAX_RETRIES if adaptive else 0
+        while True:
+            try:
+                with limit:
+                    output = http_download_file(
+                        link, target_dir=target, timeout=timeout or download_timeout(size),
+                        file_size=size, hash=md5, **kwargs)
+                break
+            except (URLError, TimeoutError, ConnectionError, requests.ConnectionError,
+                    requests.Timeout, requests.exceptions.ChunkedEncodingError) as ex:
+                # Retry on server and network errors only
+                if retries == 0 or (isinstance(ex, HTTPError) and ex.code < 500):
+                    raise ex
+                _logger.debug('Retrying download of %s: %s', link, ex)
+                limit.record(error=True)
+                retries -= 1  # NB: The download resumes from the partial file
+        file = output[0] if kwargs.get('return_md5', False) else output
+        limit.record(file.stat().st_size if file else 0)
+        if callback:
+            callback(i, output)
+        return output
+
     # using with statement to ensure threads are cleaned up promptly
-    zipped = zip(links_to_file_list, target_dir)
-    with concurrent.futures.ThreadPoolExecutor(max_workers=n_threads) as executor:
+    zipped = enumerate(zip(links_to_file_list, target_dir, file_size, hash))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=limit.maximum) as executor:
         # Multithreading load operations
-        futures = [executor.submit(
-            http_download_file, link, target_dir=target, **kwargs) for link, target in zipped]
-        zip(links_to_file_list, ensure_list(kwargs.pop('target_dir', None)))
-        # TODO Reintroduce variable timeout value based on file size and download speed of 5 Mb/s?
-        # timeout = reduce(lambda x, y: x + (y.get('file_size', 0) or 0), dsets, 0) / 625000 ?
+        futures = [executor.submit(_download, i, *args) for i, args in zipped]
         concurrent.futures.wait(futures, timeout=None)
         # build return list
         for future in futures:
@@ -317,10 +460,18 @@ def http_download_file_list(links_to_file_list, **kwargs):
 
 
 def http_download_file(full_link_to_file, chunks=None, *, clobber=False, silent=False,
-                       username='', password='', target_dir='', return_md5=False, headers=None):
+                       username='', password='', target_dir='', return_md5=False, headers=None,
+                       timeout=None, session=None, segments=N_SEGMENTS, file_size=None,
+                       hash=None):
     """
     Download a file from a remote HTTP server.
 
+    The file is first written to a hidden '.part' file in the target directory, which is renamed
+    once the download completes.  If a previous download was interrupted, the download resumes
+    from the end of the partial file using an HTTP Range request.  Files larger than
+    LARGE_FILE_SIZE are downloaded in parallel byte-range segments, the progress of which is
+    saved so that these too may be resumed.
+
     Parameters
     ----------
     full_link_to_file : str
@@ -328,7 +479,7 @@ def http_download_file(full_link_to_file, chunks=None, *, clobber=False, silent=
     chunks : tuple of ints
         Chunks to download
     clobber : bool
-        If True, force overwrite the existing file
+        If True, force overwrite the existing file and discard any partial download
     silent : bool
         If True, suppress download progress bar
     username : str
@@ -341,11 +492,30 @@ def http_download_file(full_link_to_file, chunks=None, *, clobber=False, silent=
         If True an MD5 hash of the file is additionally returned
     headers : list of dicts
         Additional headers to add to the request (auth tokens etc.)
+    timeout : float, optional
+        The maximum time in seconds to wait for the download to complete.  If None, there is no
+        timeout.
+    session : requests.Session, optional
+        The session with which to make the request.  Sessions reuse connections to the server
+        across downloads (see AlyxClient.download_session).  If None, a new connection is made.
+    segments : int
+        The number of parallel byte-range segments in which to download large files.  Set to 1 to
+        download all files in a single request.
+    file_size : int, optional
+        The expected file size in bytes.  An existing file of a different size is re-downloaded.
+    hash : str, optional
+        The expected MD5 hash of the file.  If an existing file has the expected size, this is
+        returned instead of re-reading the file to hash it.
 
     Returns
     -------
     pathlib.Path
         The full file path of the downloaded file
+
+    Raises
+    ------
+    TimeoutError
+        The download did not complete within the timeout.
     """
     if not full_link_to_file:
         return (None, None) if return_md5 else None
@@ -358,63 +528,214 @@ def http_download_file(full_link_to_file, chunks=None, *, clobber=False, silent=
     if not target_dir:
         target_dir = Path.home().joinpath('Downloads')
 
-    # This should be the base url you wanted to access.
-    base_url, name = full_link_to_file.rsplit('/', 1)
-    file_name = Path(target_dir, name)
+    file_name = Path(target_dir, full_link_to_file.rsplit('/', 1)[-1])
 
     # do not overwrite an existing file unless specified
     if not clobber and file_name.exists():
-        return (file_name, hashfile.md5(file_name)) if return_md5 else file_name
+        if not file_size or file_name.stat().st_size == file_size:
+            if not return_md5:
+                return file_name
+            return file_name, (hash if file_size and hash else hashfile.md5(file_name))
+        _logger.debug('Existing file size mismatch; re-downloading %s', file_name)
+
+    part_file = file_name.with_name(f'.{file_name.name}.part')  # Incomplete download
+    progress_file = part_file.with_name(part_file.name + '.json')  # Segmented download progress
+    if clobber or chunks is not None:
+        part_file.unlink(missing_ok=True)
+        progress_file.unlink(missing_ok=True)
+
+    # add additional headers; request the raw content so that byte ranges and sizes match
+    headers = {'Accept-Encoding': 'identity', **(headers or {})}
+    auth = (username, password) if username and password else None
+    get = functools.partial((session or requests).get, full_link_to_file,
+                            auth=auth, stream=True, timeout=timeout)
+    deadline = None if timeout is None else time.monotonic() + timeout
+    block_sz = 8192 * 64 * 8
 
-    # Create a password manager
-    manager = urllib.request.HTTPPasswordMgrWithDefaultRealm()
-    if username and password:
-        manager.add_password(None, base_url, username, password)
+    if progress_file.exists() and not part_file.exists():
+        _logger.debug('Discarding stale download progress file %s', progress_file)
+        progress_file.unlink()
+    if progress_file.exists():
+        # Resume an interrupted segmented download
+        total_size = json.loads(progress_file.read_text())['bounds'][-1]
+        response = offset = None
+    else:
+        # Support for partial download.
+        offset = part_file.stat().st_size if part_file.exists() else 0
+        if chunks is not None:
+            first_byte, n_bytes = chunks
+            headers['Range'] = 'bytes=%d-%d' % (first_byte, first_byte + n_bytes - 1)
+        elif offset:
+            headers['Range'] = f'bytes={offset}-'
+        # Open the url and get the length
+        response = get(headers=headers)
+        if offset and response.status_code == 416:  # Range not satisfiable; start again
+            response.close()
+            offset = 0
+            response = get(headers={k: v for k, v in headers.items() if k != 'Range'})
+        _raise_for_status(response)
+        if chunks is not None or response.status_code != 206:
+            offset = 0  # Range not requested or not supported by the server
+        total_size = offset + int(response.headers.get('Content-Length', 0))
+        if (chunks is None and offset == 0 and segments > 1 and total_size >= LARGE_FILE_SIZE
+                and response.headers.get('Accept-Ranges') == 'bytes'):
+            response.close()
+            response = None
+            _init_segments(part_file, progress_file, total_size, segments)
 
-    # Create an authentication handler using the password manager
-    auth = urllib.request.HTTPBasicAuthHandler(manager)
+    if not silent:
+        print(f'Downloading: {file_name} Bytes: {total_size}')
 
-    # Create an opener that will replace the default urlopen method on further calls
-    opener = urllib.request.build_opener(auth)
-    urllib.request.install_opener(opener)
+    with tqdm(total=total_size / 1024 / 1024, disable=silent) as pbar:
+        if response is None:
+            md5 = _download_segments(get, headers, part_file, progress_file, block_sz,
+                                     return_md5=return_md5, deadline=deadline, pbar=pbar)
+        else:
+            md5 = hashlib.md5()
+            if offset and return_md5:  # Hash the previously downloaded part
+                with open(part_file, 'rb') as f:
+                    for buffer in iter(functools.partial(f.read, block_sz), b''):
+                        md5.update(buffer)
+            pbar.update(offset / 1024 / 1024)
+            with response, open(part_file, 'ab' if offset else 'wb') as f:
+                for buffer in response.iter_content(block_sz):
+                    f.write(buffer)
+                    if return_md5:
+                        md5.update(buffer)
+                    pbar.update(len(buffer) / 1024 / 1024)
+                    if deadline and time.monotonic() > deadline:
+                        raise TimeoutError(
+                            f'Download of {full_link_to_file} timed out after {timeout}s')
+            if 'Content-Length' in response.headers and part_file.stat().st_size != total_size:
+                raise IOError(f'Incomplete download of {full_link_to_file}')
+    part_file.replace(file_name)
 
-    # Support for partial download.
-    req = urllib.request.Request(full_link_to_file)
-    if chunks is not None:
-        first_byte, n_bytes = chunks
-        req.add_header('Range', 'bytes=%d-%d' % (first_byte, first_byte + n_bytes - 1))
+    return (file_name, md5.hexdigest()) if return_md5 else file_name
 
-    # add additional headers
-    if headers is not None:
-        for k in headers:
-            req.add_header(k, headers[k])
 
-    # Open the url and get the length
-    try:
-        u = urllib.request.urlopen(req)
-    except HTTPError as e:
-        _logger.error(f'{str(e)} {full_link_to_file}')
+def _raise_for_status(response):
+    """Raise an HTTPError if the response has an error status code."""
+    if not response.ok:
+        response.close()
+        e = HTTPError(response.url, response.status_code, response.reason, response.headers, None)
+        _logger.error(f'{str(e)} {response.url}')
         raise e
 
-    file_size = int(u.getheader('Content-length'))
-    if not silent:
-        print(f'Downloading: {file_name} Bytes: {file_size}')
-    block_sz = 8192 * 64 * 8
 
-    md5 = hashlib.md5()
-    f = open(file_name, 'wb')
-    with tqdm(total=file_size / 1024 / 1024, disable=silent) as pbar:
-        while True:
-            buffer = u.read(block_sz)
-            if not buffer:
-                break
-            f.write(buffer)
-            if return_md5:
-                md5.update(buffer)
-            pbar.update(len(buffer) / 1024 / 1024)
-    f.close()
+def _init_segments(part_file, progress_file, file_size, segments):
+    """
+    Allocate a partial download file and save the byte ranges of its segments.
+
+    Parameters
+    ----------
+    part_file : pathlib.Path
+        The partial download file to allocate.
+    progress_file : pathlib.Path
+        The JSON file in which to save the download progress of each segment.
+    file_size : int
+        The size of the file to download in bytes.
+    segments : int
+        The number of segments to split the file into.
+    """
+    bounds = [i * file_size // segments for i in range(segments + 1)]
+    with open(part_file, 'wb') as f:
+        f.truncate(file_size)
+    progress_file.write_text(json.dumps({'bounds': bounds, 'next': bounds[:-1]}))
 
-    return (file_name, md5.hexdigest()) if return_md5 else file_name
+
+def _download_segments(get, headers, part_file, progress_file, block_sz,
+                       return_md5=False, deadline=None, pbar=None):
+    """
+    Download the remaining byte ranges of a segmented download in parallel.
+
+    The next byte to download for each segment is saved to the progress file at most every
+    PROGRESS_INTERVAL seconds, and when a segment stops, so that the download can be resumed if
+    interrupted.  The MD5 hash is updated with
+    each segment, in order, as soon as it completes.
+
+    Parameters
+    ----------
+    get : function
+        A function that makes a GET request for the file, given a headers dict.
+    headers : dict
+        Additional request headers.
+    part_file : pathlib.Path
+        The allocated partial download file.
+    progress_file : pathlib.Path
+        The JSON file containing the byte ranges and progress of each segment.  This file is
+        removed once the download completes.
+    block_sz : int
+        The number of bytes to read at a time.
+    return_md5 : bool
+        If true, the MD5 hash of the file is computed.
+    deadline : float, optional
+        The time by which the download must complete, as returned by time.monotonic.
+    pbar : tqdm.tqdm, optional
+        A progress bar to update, in MB.
+
+    Returns
+    -------
+    hashlib.md5
+        The MD5 hash object, updated with the file content if return_md5 is true.
+    """
+    progress = json.loads(progress_file.read_text())
+    bounds, next_byte = progress['bounds'], progress['next']
+    lock = threading.Lock()
+    last_saved = time.monotonic()
+    if pbar:
+        pbar.update(sum(x - y for x, y in zip(next_byte, bounds)) / 1024 / 1024)
+
+    def save_progress(force=False):
+        """Save the progress of all segments if forced or PROGRESS_INTERVAL seconds elapsed."""
+        nonlocal last_saved
+        with lock:
+            if force or time.monotonic() - last_saved >= PROGRESS_INTERVAL:
+                progress_file.write_text(json.dumps(progress))
+                last_saved = time.monotonic()
+
+    def fetch(i):
+        """Download the remainder of the ith segment."""
+        if next_byte[i] >= bounds[i + 1]:
+            return
+        range_headers = {**headers, 'Range': f'bytes={next_byte[i]}-{bounds[i + 1] - 1}'}
+        response = get(headers=range_headers)
+        _raise_for_status(response)
+        if response.status_code != 206:
+            response.close()
+            raise IOError(f'Server returned status {response.status_code} for segment request')
+        try:
+            with response, open(part_file, 'r+b') as f:
+                f.seek(next_byte[i])
+                for buffer in response.iter_content(block_sz):
+                    f.write(buffer)
+                    f.flush()  # Saved progress must not exceed the bytes written
+                    with lock:
+                        next_byte[i] += len(buffer)
+                    save_progress()
+                    if pbar:
+                        pbar.update(len(buffer) / 1024 / 1024)
+                    if deadline and time.monotonic() > deadline:
+                        raise TimeoutError(f'Segmented download of {part_file} timed out')
+        finally:
+            save_progress(force=True)
+        if next_byte[i] < bounds[i + 1]:
+            raise IOError(f'Incomplete download of segment {i} of {part_file}')
+
+    md5 = hashlib.md5()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=len(next_byte)) as executor:
+        futures = [executor.submit(fetch, i) for i in range(len(next_byte))]
+        for i, future in enumerate(futures):
+            future.result()
+            if return_md5:  # Hash each segment in order while the others are downloading
+                with open(part_file, 'rb') as f:
+                    f.seek(bounds[i])
+                    remaining = bounds[i + 1] - bounds[i]
+                    while remaining > 0:
+                        buffer = f.read(min(block_sz, remaining))
+                        md5.update(buffer)
+                        remaining -= len(buffer)
+    progress_file.unlink()
+    return md5
 
 
 def file_record_to_url(file_records) -> list:
@@ -467,6 +788,7 @@ class AlyxClient:
     """
     _token = None
     _headers = {}  # Headers for REST requests only
+    _download_session = None
     user = None
     """str: The Alyx username."""
     base_url = None
@@ -513,6 +835,24 @@ class AlyxClient:
         self.cache_mode = cache_rest
         self._obj_id = id(self)
 
+    @property
+    def download_session(self):
+        """requests.Session: A session for file downloads, pooling connections across threads.
+
+        The connection pool is large enough for the maximum number of concurrent downloads, so
+        that bulk downloads of many small files reuse the same connections.
+        """
+        if self._download_session is None:
+            n_threads = getattr(self._par, 'HTTP_DL_THREADS', None)
+            pool_size = max(MAX_THREADS, N_THREADS, n_threads if isinstance(n_threads, int) else 0)
+            adapter = requests.adapters.HTTPAdapter(
+                pool_connections=pool_size, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            self._download_session = session
+        return self._download_session
+
     @property
     def rest_schemes(self):
         """dict: The REST endpoints and their parameters."""
@@ -772,6 +1112,16 @@ class AlyxClient:
         ----------
         url : str, list
             Full url(s) of the file(s).
+        file_size : int, list, optional
+            The expected size(s) of the file(s) in bytes, used to set the download timeout(s) and
+            to verify existing files.
+        hash : str, list, optional
+            The expected MD5 hash(es) of the file(s), returned for existing files of the expected
+            size instead of re-hashing them.
+        n_threads : int, str, optional
+            The number of concurrent downloads when downloading a list of files, or 'auto' to
+            adapt the number to the measured throughput.  Defaults to the HTTP_DL_THREADS
+            parameter, if set, otherwise one.webclient.N_THREADS.
         **kwargs
             WebClient.http_download_file parameters.
 
@@ -782,14 +1132,17 @@ class AlyxClient:
         if isinstance(url, str):
             url = self._validate_file_url(url)
             download_fcn = http_download_file
+            kwargs.setdefault('timeout', download_timeout(kwargs.get('file_size')))
         else:
             url = (self._validate_file_url(x) for x in url)
             download_fcn = http_download_file_list
+            kwargs.setdefault('n_threads', getattr(self._par, 'HTTP_DL_THREADS', None))
         pars = dict(
             silent=kwargs.pop('silent', self.silent),
             target_dir=kwargs.pop('target_dir', self._par.CACHE_DIR),
             username=self._par.HTTP_DATA_SERVER_LOGIN,
             password=self._par.HTTP_DATA_SERVER_PWD,
+            session=kwargs.pop('session', self.download_session),
             **kwargs
         )
         try:
@@ -831,7 +1184,8 @@ class AlyxClient:
                                       headers=headers,
                                       silent=self.silent,
                                       target_dir=tmp,
-                                      clobber=True)
+                                      clobber=True,
+                                      session=self.download_session)
             with zipfile.ZipFile(file, 'r') as zipped:
                 files = zipped.namelist()
                 zipped.extractall(destination)